@@ -0,0 +1,34 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+####################################################################################################
+# atomic file writes
+# files that other actions read while they may be rewritten (the codelist bundle, the lib
+# metadata, extracts) are written to a temporary file beside them and moved into place, so a
+# reader never sees a partial file and a failed write leaves the old one
+#
+# NamedTemporaryFile creates its file private to its owner (0600), so before the move the file is
+# given the mode open() would have (0666 less the umask): other users and containers read these
+
+
+# the mode a new file gets from open()
+def default_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# `with atomic_write(path) as f:` writes f to path once the block completes
+@contextmanager
+def atomic_write(path, mode="wb", suffix=None):
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(mode, dir=directory, suffix=suffix, delete=False) as f:
+        try:
+            yield f
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.chmod(f.name, default_mode())
+    os.replace(f.name, path)
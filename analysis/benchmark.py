@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+####################################################################################################
+# benchmark suite
+# times the parts of the pipeline that run on every job or every edit:
+# - cold import of study_definition / codelists (a fresh interpreter) and warm re-import
+# - loading the largest codelists from the compiled bundle
+# - evaluating the jcvi_group / elig_date / atrisk_group rules read from analysis/lib
+# - dummy data generation at 10k to 10M patients
+#
+# every benchmark runs in its own interpreter, so imports and peak RSS are not shared between
+# them; results are written as json named after the git commit, so two runs can be compared
+#
+#   python analysis/benchmark.py                          writes benchmarks/<commit>.json
+#   python analysis/benchmark.py --only dummy --max-rows 1000000
+#   python analysis/benchmark.py --compare benchmarks/<old>.json benchmarks/<new>.json
+
+RESULTS_DIR = "benchmarks"
+STUDY = "study_definition"
+
+# the largest csvs in codelists/
+CODELISTS = ["immrx_primis", "pregdel_primis", "chd_primis", "cns_primis"]
+DUMMY_ROWS = [10_000, 100_000, 1_000_000, 10_000_000]
+RULE_ROWS = 1_000_000
+
+# a slower median than this (relative to the baseline) is reported as a regression
+THRESHOLD = 0.1
+
+
+####################################################################################################
+# benchmarks
+# each takes its parameter, does any setup, and returns the function to time; BENCHMARKS holds
+# (parameters, processes, repeats per process, benchmark)
+
+
+def project_modules():
+    analysis = os.path.abspath("analysis")
+    return [
+        name
+        for name, module in sys.modules.items()
+        if os.path.abspath(getattr(module, "__file__", None) or "").startswith(analysis)
+    ]
+
+
+# first import in a fresh interpreter (the codelist bundle is already built)
+def import_cold(module):
+    import importlib
+
+    return lambda: importlib.import_module(module)
+
+
+# re-import with third-party packages (cohortextractor, pandas, numpy) already loaded
+def import_warm(module):
+    import importlib
+
+    importlib.import_module(module)
+
+    def run():
+        for name in project_modules():
+            del sys.modules[name]
+        importlib.import_module(module)
+
+    return run
+
+
+def codelist_load(name):
+    import codelists
+    from codelist_bundle import open_bundle
+
+    open_bundle()
+    return codelists._definitions[name]
+
+
+def rule_columns(size):
+    import importlib
+
+    from dummy_generator import DummyGenerator
+    from local_backend import study_variables
+    from rules import names_in, parse, read_group_definitions
+
+    study = importlib.import_module(STUDY).study
+    generator = DummyGenerator(
+        study_variables(STUDY), size, getattr(study, "default_expectations", {}), 0, getattr(study, "index_date", None)
+    )
+    str_atrisk, dict_jcvi, dict_elig = read_group_definitions()
+    names = set()
+    for expression in [str_atrisk, *dict_jcvi.values(), *dict_elig.values()]:
+        if expression != "DEFAULT":
+            names |= names_in(parse(expression))
+    return {name: generator.column(name) for name in sorted(names)}, size
+
+
+def rule_evaluation(rule):
+    from rules import compile_categorised_as, compile_satisfying, read_group_definitions
+
+    columns, size = rule_columns(RULE_ROWS)
+    str_atrisk, dict_jcvi, dict_elig = read_group_definitions()
+    if rule == "str_atrisk":
+        compiled = compile_satisfying(str_atrisk)
+    else:
+        compiled = compile_categorised_as({"dict_jcvi": dict_jcvi, "dict_elig": dict_elig}[rule])
+    return lambda: compiled(columns, size)
+
+
+def dummy_generation(rows):
+    import importlib
+
+    from dummy_generator import DummyGenerator
+    from local_backend import study_variables
+    from study_metadata import load_metadata
+
+    study = importlib.import_module(STUDY).study
+    variables = study_variables(STUDY)
+    seed = int(load_metadata().study_parameters["seed"])
+    expectations = getattr(study, "default_expectations", {})
+    index_date = getattr(study, "index_date", None)
+    return lambda: DummyGenerator(variables, rows, expectations, seed, index_date).to_arrow()
+
+
+BENCHMARKS = {
+    "import_cold": ([STUDY, "codelists"], 5, 1, import_cold),
+    "import_warm": ([STUDY, "codelists"], 1, 5, import_warm),
+    "codelist_load": (CODELISTS, 1, 5, codelist_load),
+    "rules": (["dict_jcvi", "dict_elig", "str_atrisk"], 1, 5, rule_evaluation),
+    "dummy": (DUMMY_ROWS, 1, 1, dummy_generation),
+}
+
+
+####################################################################################################
+# running
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# run one benchmark in this interpreter and print its measurements as json
+def measure(name, parameter, repeats):
+    *_, benchmark = BENCHMARKS[name]
+    if isinstance(BENCHMARKS[name][0][0], int):
+        parameter = int(parameter)
+    rss_before = peak_rss()
+    run = benchmark(parameter)
+    rss_setup = peak_rss()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    print(json.dumps({"seconds": seconds, "peak_rss": peak_rss(), "rss_before": rss_before, "rss_setup": rss_setup}))
+
+
+def run_benchmark(name, parameter, processes, repeats):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, ["analysis", env.get("PYTHONPATH")]))
+    seconds = []
+    peak = 0
+    for _ in range(processes):
+        output = subprocess.run(
+            [sys.executable, "analysis/benchmark.py", "--measure", name, str(parameter), str(repeats)],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        seconds += result["seconds"]
+        peak = max(peak, result["peak_rss"])
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "peak_rss": peak,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True)
+        return commit.strip(), bool(dirty.stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def machine():
+    import numpy as np
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_all(only=None, max_rows=None):
+    # built up front so the cold imports don't time the bundle being compiled
+    subprocess.run([sys.executable, "analysis/codelist_bundle.py"], check=True, capture_output=True)
+    commit, dirty = git_commit()
+    results = {}
+    for name, (parameters, processes, repeats, _) in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        for parameter in parameters:
+            if max_rows and isinstance(parameter, int) and parameter > max_rows:
+                continue
+            key = f"{name}[{parameter}]"
+            results[key] = run_benchmark(name, parameter, processes, repeats)
+            print(f"{key:40} {results[key]['median']:9.4f}s  {results[key]['peak_rss'] / 2**20:8.1f} MiB", flush=True)
+    return {"commit": commit, "dirty": dirty, "timestamp": time.time(), "machine": machine(), "results": results}
+
+
+# benchmarks whose median got slower by more than threshold; prints every shared benchmark
+def compare(baseline, current, threshold=THRESHOLD):
+    regressions = []
+    for key in sorted(set(baseline["results"]) & set(current["results"])):
+        before = baseline["results"][key]["median"]
+        after = current["results"][key]["median"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:40} {before:9.4f}s -> {after:9.4f}s  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark imports, codelist loading, rules and dummy data")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--max-rows", type=int, default=None, help="skip dummy data sizes above this")
+    parser.add_argument("--output", default=None, help=f"results file (default {RESULTS_DIR}/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two results files")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--measure", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        name, parameter, repeats = args.measure
+        measure(name, parameter, int(repeats))
+    elif args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+    else:
+        report = run_all(args.only, args.max_rows)
+        output = args.output or os.path.join(RESULTS_DIR, f"{report['commit'][:12]}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {output}")
@@ -0,0 +1,277 @@
+import csv
+import hashlib
+import json
+import mmap
+import os
+
+import numpy as np
+
+from atomic_write import atomic_write
+
+####################################################################################################
+# compiled codelist bundle
+# every csv in codelists/ is compiled once into a single binary file, keyed by the sha of each
+# csv in codelists/codelists.json, and memory-mapped on import instead of re-parsing the csvs
+#
+# build (or rebuild) with:
+#   python analysis/codelist_bundle.py
+# the bundle is also rebuilt automatically whenever a sha no longer matches the manifest
+#
+# layout: MAGIC, uint64 header length, json header, then 8-byte aligned arrays
+# - codes are stored sorted, as int64 where every code is a plain integer (snomed, dm+d)
+#   and otherwise as a string table (icd-10, ctv3)
+# - every other csv column is stored as a category column in the same row order
+# - a string table is a "\n"-joined utf-8 blob plus int32 offsets into it
+
+CODELIST_DIR = "codelists"
+BUNDLE_PATH = "codelists/codelists.bundle"
+MAGIC = b"CODELISTBUNDLE1\n"
+
+# columns holding the codes, in order of preference when a csv has more than one
+CODE_COLUMNS = ("code", "snomedcode", "snomed_id", "dmd_id", "CTV3ID", "CTV3Code", "icd10_code")
+
+
+class BundleError(ValueError):
+    pass
+
+
+# sha of every csv in the codelist directory, from the manifest where listed; other csvs are
+# hashed, unless `known` (filename -> [size, mtime_ns, sha], as kept in the bundle) says the file
+# is unchanged since it was last hashed
+def current_shas(codelist_dir=CODELIST_DIR, known=None):
+    return {filename: sha for filename, (_, sha) in file_shas(codelist_dir, known).items()}
+
+
+# filename -> ([size, mtime_ns], sha) of every csv in the codelist directory
+def file_shas(codelist_dir=CODELIST_DIR, known=None):
+    try:
+        with open(os.path.join(codelist_dir, "codelists.json")) as f:
+            manifest = json.load(f)["files"]
+    except FileNotFoundError:
+        manifest = {}
+    known = known or {}
+    shas = {}
+    for filename in sorted(os.listdir(codelist_dir)):
+        if not filename.endswith(".csv"):
+            continue
+        stat = os.stat(os.path.join(codelist_dir, filename))
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if filename in manifest:
+            shas[filename] = (signature, manifest[filename]["sha"])
+        elif known.get(filename, [None, None])[:2] == signature:
+            shas[filename] = (signature, known[filename][2])
+        else:
+            with open(os.path.join(codelist_dir, filename), "rb") as f:
+                shas[filename] = (signature, hashlib.sha1(f.read()).hexdigest())
+    return shas
+
+
+####################################################################################################
+# build
+
+def is_integer_code(code):
+    return code.isdigit() and (code == "0" or code[0] != "0") and int(code) < 2**63
+
+
+def pick_code_column(fieldnames):
+    for column in CODE_COLUMNS:
+        if column in fieldnames:
+            return column
+    return fieldnames[0]
+
+
+class _Writer:
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        offset = self.size
+        data = array.tobytes()
+        padding = -len(data) % 8
+        self.chunks.append(data + b"\0" * padding)
+        self.size += len(data) + padding
+        return [offset, array.dtype.str, len(array)]
+
+    def add_strings(self, values):
+        if any("\n" in value for value in values):
+            raise BundleError("string table values cannot contain newlines")
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int32)
+        np.cumsum([len(value) + 1 for value in encoded], out=offsets[1:])
+        blob = np.frombuffer(b"\n".join(encoded), dtype=np.uint8)
+        return {"offsets": self.add(offsets), "bytes": self.add(blob)}
+
+
+def compile_csv(path, writer):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        fieldnames = [name for name in reader.fieldnames if name]
+        code_column = pick_code_column(fieldnames)
+        rows = [
+            {name: (row[name] or "").strip() for name in fieldnames}
+            for row in reader
+        ]
+    # blank codes are ignored, as in cohortextractor's codelist_from_csv
+    rows = [row for row in rows if row[code_column]]
+    codes = [row[code_column] for row in rows]
+    entry = {"code_column": code_column, "rows": len(rows), "columns": {}}
+    if all(is_integer_code(code) for code in codes):
+        integers = np.array([int(code) for code in codes], dtype=np.int64)
+        order = np.argsort(integers, kind="stable")
+        entry["kind"] = "int64"
+        entry["codes"] = writer.add(integers[order])
+    else:
+        order = np.array(sorted(range(len(codes)), key=codes.__getitem__), dtype=np.intp)
+        entry["kind"] = "string"
+        entry["codes"] = writer.add_strings([codes[i] for i in order])
+    for name in fieldnames:
+        if name == code_column:
+            continue
+        values = [rows[i][name] for i in order]
+        categories = sorted(set(values))
+        lookup = {category: position for position, category in enumerate(categories)}
+        entry["columns"][name] = {
+            "categories": writer.add_strings(categories),
+            "index": writer.add(np.array([lookup[value] for value in values], dtype=np.int32)),
+        }
+    return entry
+
+
+def build_bundle(codelist_dir=CODELIST_DIR, path=BUNDLE_PATH, write=True, known=None):
+    signatures = file_shas(codelist_dir, known)
+    shas = {filename: sha for filename, (_, sha) in signatures.items()}
+    known = {filename: signature + [sha] for filename, (signature, sha) in signatures.items()}
+    writer = _Writer()
+    files = {}
+    for filename, sha in shas.items():
+        try:
+            entry = compile_csv(os.path.join(codelist_dir, filename), writer)
+        except BundleError:
+            # left to the csv reader
+            continue
+        entry["sha"] = sha
+        files[filename] = entry
+    header = json.dumps({"shas": shas, "known": known, "files": files}).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+    content = b"".join([MAGIC, np.uint64(len(header)).tobytes(), header] + writer.chunks)
+    if write:
+        with atomic_write(path) as f:
+            f.write(content)
+    return content
+
+
+####################################################################################################
+# load
+
+class Bundle:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if bytes(buffer[: len(MAGIC)]) != MAGIC:
+            raise BundleError("not a codelist bundle")
+        start = len(MAGIC) + 8
+        (length,) = np.frombuffer(buffer, dtype=np.uint64, count=1, offset=len(MAGIC))
+        header = json.loads(bytes(buffer[start : start + int(length)]))
+        self.shas = header["shas"]
+        self.known = header.get("known", {})
+        self.files = header["files"]
+        self.data_offset = start + int(length)
+
+    def array(self, spec):
+        offset, dtype, count = spec
+        return np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.data_offset + offset)
+
+    def strings(self, spec):
+        if spec["offsets"][2] == 1:
+            return []
+        return bytes(self.array(spec["bytes"])).decode("utf-8").split("\n")
+
+    def entry(self, filename):
+        return self.files.get(os.path.basename(filename))
+
+    # sorted codes as an int64 array (integer codes) or a list of strings
+    def codes(self, filename):
+        entry = self.entry(filename)
+        if entry["kind"] == "int64":
+            return self.array(entry["codes"])
+        return self.strings(entry["codes"])
+
+    # values of another column, aligned with codes()
+    def column(self, filename, name):
+        column = self.entry(filename)["columns"][name]
+        categories = np.array(self.strings(column["categories"]), dtype=object)
+        return categories[self.array(column["index"])]
+
+    def codelist(self, filename, system, column="code", category_column=None):
+        from cohortextractor import codelist
+
+        codes = self.codes(filename)
+        if isinstance(codes, np.ndarray):
+            codes = codes.astype(str).tolist()
+        if category_column:
+            codes = list(zip(codes, self.column(filename, category_column).tolist()))
+        return codelist(codes, system)
+
+    def has(self, filename, column="code", category_column=None):
+        entry = self.entry(filename)
+        return (
+            entry is not None
+            and entry["code_column"] == column
+            and (category_column is None or category_column in entry["columns"])
+        )
+
+
+_bundles = {}
+
+
+# the bundle for a codelist directory, rebuilt if any csv changed since it was compiled
+def open_bundle(codelist_dir=CODELIST_DIR, path=BUNDLE_PATH):
+    key = (codelist_dir, path)
+    if key in _bundles:
+        return _bundles[key]
+    bundle = None
+    known = None
+    try:
+        with open(path, "rb") as f:
+            bundle = Bundle(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        known = bundle.known
+        if bundle.shas != current_shas(codelist_dir, known):
+            bundle = None
+    except (OSError, ValueError):
+        bundle = None
+    if bundle is None:
+        try:
+            content = build_bundle(codelist_dir, path, known=known)
+        except OSError:
+            # read-only checkout: keep the compiled bundle in memory for this process
+            content = build_bundle(codelist_dir, path, write=False, known=known)
+        bundle = Bundle(memoryview(content))
+    _bundles[key] = bundle
+    return bundle
+
+
+# drop-in replacement for cohortextractor's codelist_from_csv that reads from the bundle;
+# the codelist's `sha` is its csv's sha (plus the columns read), for keying cached results
+def codelist_from_csv(filename, system, column="code", category_column=None):
+    codelist_dir = os.path.dirname(filename) or "."
+    codelist = None
+    if os.path.normpath(codelist_dir) == os.path.normpath(CODELIST_DIR):
+        bundle = open_bundle()
+        shas = bundle.shas
+        if bundle.has(filename, column, category_column):
+            codelist = bundle.codelist(filename, system, column, category_column)
+    else:
+        shas = current_shas(codelist_dir)
+    if codelist is None:
+        from cohortextractor import codelist_from_csv as read_csv
+
+        codelist = read_csv(filename, system=system, column=column, category_column=category_column)
+    sha = shas.get(os.path.basename(filename))
+    if sha:
+        codelist.sha = f"{sha}:{column}:{category_column or ''}"
+    return codelist
+
+
+if __name__ == "__main__":
+    build_bundle()
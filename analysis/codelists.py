@@ -1,116 +1,187 @@
-from cohortextractor import (codelist, codelist_from_csv, combine_codelists)
+from cohortextractor import (codelist, combine_codelists)
+
+# codelists are read from the compiled bundle (see codelist_bundle.py) rather than the csvs
+from codelist_bundle import codelist_from_csv
+
+####################################################################################################
+# codelists below are only registered here: each one is read the first time it is accessed
+# (e.g. `from codelists import ast_primis`) and then kept as a module attribute, so importing
+# this module does not parse codelists that a study never uses
+
+_definitions = {}
+_touched = []
+
+
+def register(name, function):
+    _definitions[name] = function
+
+
+def register_csv(name, filename, system, column="code", category_column=None):
+    register(
+        name,
+        lambda: codelist_from_csv(
+            filename, system=system, column=column, category_column=category_column
+        ),
+    )
+
+
+def load(name):
+    if name in globals():
+        return globals()[name]
+    try:
+        function = _definitions[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = function()
+    _touched.append(name)
+    return value
+
+
+def __getattr__(name):
+    return load(name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_definitions))
+
+
+# codelists read so far, in order of first use
+def touched():
+    return list(_touched)
+
+
+# codelists registered but never read
+def untouched():
+    return [name for name in _definitions if name not in _touched]
+
 
 #######################
 ### for JCVI groups ###
 #######################
 
 # Asthma Diagnosis code
-ast_primis = codelist_from_csv(
+register_csv(
+    "ast_primis",
     "codelists/primis-covid19-vacc-uptake-ast.csv",
     system="snomed",
     column="code",
 )
 
 # Asthma Admission codes
-astadm_primis = codelist_from_csv(
+register_csv(
+    "astadm_primis",
     "codelists/primis-covid19-vacc-uptake-astadm.csv",
     system="snomed",
     column="code",
 )
 
 # Asthma systemic steroid prescription codes
-astrx_primis = codelist_from_csv(
+register_csv(
+    "astrx_primis",
     "codelists/primis-covid19-vacc-uptake-astrx.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic Respiratory Disease
-resp_primis = codelist_from_csv(
+register_csv(
+    "resp_primis",
     "codelists/primis-covid19-vacc-uptake-resp_cov.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic heart disease codes
-chd_primis = codelist_from_csv(
+register_csv(
+    "chd_primis",
     "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic kidney disease diagnostic codes
-ckd_primis = codelist_from_csv(
+register_csv(
+    "ckd_primis",
     "codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic kidney disease codes - all stages
-ckd15_primis = codelist_from_csv(
+register_csv(
+    "ckd15_primis",
     "codelists/primis-covid19-vacc-uptake-ckd15.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic kidney disease codes-stages 3 - 5
-ckd35_primis = codelist_from_csv(
+register_csv(
+    "ckd35_primis",
     "codelists/primis-covid19-vacc-uptake-ckd35.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic Liver disease codes
-cld_primis = codelist_from_csv(
+register_csv(
+    "cld_primis",
     "codelists/primis-covid19-vacc-uptake-cld.csv",
     system="snomed",
     column="code",
 )
 
 # Diabetes diagnosis codes
-diab_primis = codelist_from_csv(
+register_csv(
+    "diab_primis",
     "codelists/primis-covid19-vacc-uptake-diab.csv",
     system="snomed",
     column="code",
 )
 
 # Immunosuppression diagnosis codes
-immdx_primis = codelist_from_csv(
+register_csv(
+    "immdx_primis",
     "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
     system="snomed",
     column="code",
 )
 
 # Immunosuppression medication codes
-immrx_primis = codelist_from_csv(
+register_csv(
+    "immrx_primis",
     "codelists/primis-covid19-vacc-uptake-immrx.csv",
     system="snomed",
     column="code",
 )
 
 # Chronic Neurological Disease including Significant Learning Disorder
-cns_primis = codelist_from_csv(
+register_csv(
+    "cns_primis",
     "codelists/primis-covid19-vacc-uptake-cns_cov.csv",
     system="snomed",
     column="code",
 )
 
 # Asplenia or Dysfunction of the Spleen codes
-spln_primis = codelist_from_csv(
+register_csv(
+    "spln_primis",
     "codelists/primis-covid19-vacc-uptake-spln_cov.csv",
     system="snomed",
     column="code",
 )
 
 # BMI
-bmi_primis = codelist_from_csv(
+register_csv(
+    "bmi_primis",
     "codelists/primis-covid19-vacc-uptake-bmi.csv",
     system="snomed",
     column="code",
 )
 
 # All BMI coded terms
-bmi_stage_primis = codelist_from_csv(
+register_csv(
+    "bmi_stage_primis",
     "codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
     system="snomed",
     column="code",
@@ -118,125 +189,143 @@ bmi_stage_primis = codelist_from_csv(
 )
 
 # Severe Obesity code recorded
-sev_obesity_primis = codelist_from_csv(
+register_csv(
+    "sev_obesity_primis",
     "codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
     system="snomed",
     column="code",
 )
 
 # Diabetes resolved codes
-dmres_primis = codelist_from_csv(
+register_csv(
+    "dmres_primis",
     "codelists/primis-covid19-vacc-uptake-dmres.csv",
     system="snomed",
     column="code",
 )
 
 # Severe Mental Illness codes
-sev_mental_primis = codelist_from_csv(
+register_csv(
+    "sev_mental_primis",
     "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
     system="snomed",
     column="code",
 )
 
 # Remission codes relating to Severe Mental Illness
-smhres_primis = codelist_from_csv(
+register_csv(
+    "smhres_primis",
     "codelists/primis-covid19-vacc-uptake-smhres.csv",
     system="snomed",
     column="code",
 )
 
 # High Risk from COVID-19 code
-shield_primis = codelist_from_csv(
+register_csv(
+    "shield_primis",
     "codelists/primis-covid19-vacc-uptake-shield.csv",
     system="snomed",
     column="code",
 )
 
 # Lower Risk from COVID-19 codes
-nonshield_primis = codelist_from_csv(
+register_csv(
+    "nonshield_primis",
     "codelists/primis-covid19-vacc-uptake-nonshield.csv",
     system="snomed",
     column="code",
 )
 
 # to represent household contact of shielding individual
-hhld_imdef_primis = codelist_from_csv(
+register_csv(
+    "hhld_imdef_primis",
     "codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
     system="snomed",
     column="code",
 )
 
 # Wider Learning Disability
-learndis_primis = codelist_from_csv(
+register_csv(
+    "learndis_primis",
     "codelists/primis-covid19-vacc-uptake-learndis.csv",
     system="snomed",
     column="code",
 )
 
 # Carer codes
-carer_primis = codelist_from_csv(
+register_csv(
+    "carer_primis",
     "codelists/primis-covid19-vacc-uptake-carer.csv",
     system="snomed",
     column="code",
 )
 
 # No longer a carer codes
-notcarer_primis = codelist_from_csv(
+register_csv(
+    "notcarer_primis",
     "codelists/primis-covid19-vacc-uptake-notcarer.csv",
     system="snomed",
     column="code",
 )
 
 # Employed by Care Home codes
-carehome_primis = codelist_from_csv(
+register_csv(
+    "carehome_primis",
     "codelists/primis-covid19-vacc-uptake-carehome.csv",
     system="snomed",
     column="code",
 )
 
 # Employed by nursing home codes
-nursehome_primis = codelist_from_csv(
+register_csv(
+    "nursehome_primis",
     "codelists/primis-covid19-vacc-uptake-nursehome.csv",
     system="snomed",
     column="code",
 )
 
 # Employed by domiciliary care provider codes
-domcare_primis = codelist_from_csv(
+register_csv(
+    "domcare_primis",
     "codelists/primis-covid19-vacc-uptake-domcare.csv",
     system="snomed",
     column="code",
 )
 
 # Patients in long-stay nursing and residential care
-longres_primis = codelist_from_csv(
+register_csv(
+    "longres_primis",
     "codelists/primis-covid19-vacc-uptake-longres.csv",
     system="snomed",
     column="code",
 )
 
 # Patients who are housebound
-housebound = codelist_from_csv(
+register_csv(
+    "housebound",
     "codelists/opensafely-housebound.csv", 
     system="snomed", 
     column="code"
 )
 # No longer housebound
-no_longer_housebound = codelist_from_csv(
+register_csv(
+    "no_longer_housebound",
     "codelists/opensafely-no-longer-housebound.csv", 
     system="snomed", 
     column="code"
 )
 
 # Pregnancy codes 
-preg_primis = codelist_from_csv(
+register_csv(
+    "preg_primis",
     "codelists/primis-covid19-vacc-uptake-preg.csv",
     system="snomed",
     column="code",
 )
 
 # Pregnancy or Delivery codes
-pregdel_primis = codelist_from_csv(
+register_csv(
+    "pregdel_primis",
     "codelists/primis-covid19-vacc-uptake-pregdel.csv",
     system="snomed",
     column="code",
@@ -246,7 +335,8 @@ pregdel_primis = codelist_from_csv(
 ### for demographic variables ###
 #################################
 # Ethnicity codes
-ethnicity_codes_6 = codelist_from_csv(
+register_csv(
+    "ethnicity_codes_6",
     "codelists/opensafely-ethnicity-snomed-0removed.csv",
     system="snomed",
     column="snomedcode",
@@ -262,32 +352,39 @@ ethnicity_codes_6 = codelist_from_csv(
 #############################
 
 ## History of covid
-covid_codes = codelist_from_csv(
+register_csv(
+  "covid_codes",
   "codelists/opensafely-covid-identification.csv",
   system = "icd10",
   column = "icd10_code",
 )
 
 # probable COVID in primary care
-covid_primary_care_positive_test = codelist_from_csv(
+register_csv(
+    "covid_primary_care_positive_test",
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
     system="ctv3",
     column="CTV3ID",
 )
-covid_primary_care_code = codelist_from_csv(
+register_csv(
+    "covid_primary_care_code",
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
     system="ctv3",
     column="CTV3ID",
 )
-covid_primary_care_sequalae = codelist_from_csv(
+register_csv(
+    "covid_primary_care_sequalae",
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
     system="ctv3",
     column="CTV3ID",
 )
-covid_primary_care_probable_combined=combine_codelists(
-    covid_primary_care_positive_test,
-    covid_primary_care_code,
-    covid_primary_care_sequalae,
+register(
+    "covid_primary_care_probable_combined",
+    lambda: combine_codelists(
+        load("covid_primary_care_positive_test"),
+        load("covid_primary_care_code"),
+        load("covid_primary_care_sequalae"),
+    ),
 )
 
 # suspected covid in primary care
@@ -324,7 +421,8 @@ covid_primary_care_probable_combined=combine_codelists(
 # )
 
 # COVID ICD10
-ICD10_I_codes = codelist_from_csv(
+register_csv(
+    "ICD10_I_codes",
     "codelists/opensafely-icd-10-chapter-i.csv",
     system="icd10",
     column="code",
@@ -482,27 +580,32 @@ discharged_to_hospital = codelist(
 #     system="ctv3",
 #     column="CTV3Code",
 # )
-flu_med_codes = codelist_from_csv(
+register_csv(
+    "flu_med_codes",
     "codelists/opensafely-influenza-vaccination.csv",  
     system="snomed",  
     column="snomed_id",
 )
-flu_clinical_given_codes = codelist_from_csv(
+register_csv(
+    "flu_clinical_given_codes",
     "codelists/opensafely-influenza-vaccination-clinical-codes-given.csv",  
     system="ctv3", 
     column="CTV3ID",
 )
-flu_clinical_not_given_codes = codelist_from_csv(
+register_csv(
+    "flu_clinical_not_given_codes",
     "codelists/opensafely-influenza-vaccination-clinical-codes-not-given.csv",  
     system="ctv3", 
     column="CTV3ID",
 )
-eol_codes = codelist_from_csv(
+register_csv(
+    "eol_codes",
     "codelists/nhsd-primary-care-domain-refsets-palcare_cod.csv",
     system="snomed",
     column="code",
 )
-midazolam_codes = codelist_from_csv(
+register_csv(
+    "midazolam_codes",
     "codelists/opensafely-midazolam-end-of-life.csv",
     system="snomed",
     column="dmd_id",   
@@ -0,0 +1,446 @@
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+
+from event_store import MISSING_DATE, EventStore, from_days, to_days
+from local_backend import LocalBackend, chain_gap, period, study_variables
+from rules import Column, names_in, parse
+
+####################################################################################################
+# dummy data generator
+# generates the extract straight from the study definition's return_expectations, in one
+# vectorised pass, with the logic between variables kept consistent:
+# - every age_as_of variable takes the same ages, as the baseline dummy_data.R set age_2 = age_1
+# - dates are drawn inside each variable's period, so e.g. dereg_date is never before elig_date
+# - each dose of a vaccination_date_X chain follows the previous one by about 12 weeks
+# - satisfying / categorised_as variables over other output columns (atrisk_group, jcvi_group,
+#   elig_date) are derived from their formulas; those over hidden columns use their expectations
+#
+# column types are those of the extract cohortextractor writes from expectations with
+# --output-format feather, which process_extract.R's check_dummy_data compares against: dates
+# (categorised_as dates too) as timestamp[ns], categories as dictionaries with pandas' index
+# widths, bools, int64 and float64
+#
+#   python analysis/dummy_generator.py [--population-size N] [--output output/extract/dummy_data.feather]
+
+OUTPUT = "output/extract/dummy_data.feather"
+
+# days between vaccine doses (mean, standard deviation)
+DOSE_INTERVAL = (84, 7)
+
+# uk population by 5-year age band (thousands, ONS 2018), as used by cohortextractor
+AGE_BANDS = [
+    3914, 4139, 3859, 3669, 4185, 4527, 4463, 4372, 3993, 4507, 4674,
+    4294, 3673, 3396, 3252, 2236, 1673, 1024, 448, 123, 13,
+]
+
+RETURNING_TYPES = {
+    "binary_flag": "bool",
+    "date": "date",
+    "date_of_death": "date",
+    "number_of_matches_in_period": "int",
+    "numeric_value": "float",
+    "category": "str",
+    "code": "str",
+    "nuts1_region_name": "str",
+    "stp_code": "str",
+    "msoa": "str",
+    "pseudo_id": "int",
+    # rounded, so treated as categories as cohortextractor does
+    "index_of_multiple_deprivation": "str",
+    "rural_urban_classification": "str",
+}
+
+QUERY_TYPES = {
+    "all": "bool",
+    "sex": "str",
+    "age_as_of": "int",
+    "registered_as_of": "bool",
+    "registered_with_one_practice_between": "bool",
+    "date_deregistered_from_all_supported_practices": "date",
+}
+
+
+# cohortextractor's column type for a variable
+def column_type(query_type, query_args):
+    if query_type in QUERY_TYPES:
+        return QUERY_TYPES[query_type]
+    if query_type == "categorised_as":
+        labels = list(query_args["category_definitions"])
+        if set(labels) <= {0, 1}:
+            return "bool"
+        if all(isinstance(label, int) for label in labels):
+            return "int"
+        if all(isinstance(label, float) for label in labels):
+            return "float"
+        if all(isinstance(label, str) and re.match(r"\d\d\d\d-\d\d-\d\d", label) for label in labels):
+            return "date"
+        return "str"
+    return RETURNING_TYPES[query_args.get("returning", "binary_flag")]
+
+
+# merge return_expectations over the study's default_expectations
+def merge(defaults, expectations):
+    merged = dict(defaults)
+    for key, value in (expectations or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = {**merged[key], **value}
+        merged[key] = value
+    return merged
+
+
+def parse_date(value):
+    if value == "today":
+        return int(np.datetime64("today", "D").astype(np.int64))
+    return int(np.datetime64(value, "D").astype(np.int64))
+
+
+# ages drawn from the uk population distribution
+def population_ages(rng, size, max_age=110):
+    weights = np.repeat(np.array(AGE_BANDS, dtype=float), 5)
+    # the last band is 100 and over
+    weights = np.concatenate([weights, np.full(max(max_age - len(weights), 0), AGE_BANDS[-1])])[:max_age]
+    return rng.choice(max_age, size=size, p=weights / weights.sum())
+
+
+####################################################################################################
+# random streams
+# every (variable, purpose, block of STREAM_BLOCK patient rows) gets its own Philox stream seeded
+# from the study seed, so a variable's values for a patient depend only on the seed, the variable's
+# name and the patient's row: not on the order variables are generated in, on which other variables
+# exist, or on how the population is split between processes
+
+STREAM_BLOCK = 1 << 16
+
+
+def stream_key(text):
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+
+
+class Streams:
+    def __init__(self, seed, first, size):
+        self.seed = int(seed)
+        self.first = first
+        self.size = size
+
+    def generator(self, name, purpose, block):
+        sequence = np.random.SeedSequence(self.seed, spawn_key=(stream_key(name), stream_key(purpose), block))
+        return np.random.Generator(np.random.Philox(sequence))
+
+    # draw(rng, n) for rows first .. first + size; whole blocks are always drawn, so any range of
+    # rows sees the same values
+    def draw(self, name, purpose, draw):
+        if self.size == 0:
+            return draw(self.generator(name, purpose, 0), 0)
+        first_block = self.first // STREAM_BLOCK
+        last_block = (self.first + self.size - 1) // STREAM_BLOCK
+        values = np.concatenate(
+            [draw(self.generator(name, purpose, block), STREAM_BLOCK) for block in range(first_block, last_block + 1)]
+        )
+        start = self.first - first_block * STREAM_BLOCK
+        return values[start : start + self.size]
+
+
+class DummyGenerator(LocalBackend):
+    def __init__(self, variables, population_size, default_expectations=None, seed=0, index_date=None, first_patient=0):
+        patient_ids = np.arange(first_patient + 1, first_patient + population_size + 1)
+        store = EventStore({"patients": {"patient_id": patient_ids}})
+        super().__init__(store, variables, index_date)
+        self.default_expectations = default_expectations or {}
+        self.streams = Streams(seed, first_patient, population_size)
+        self.ages = None
+
+    def expectations(self, name):
+        return merge(self.default_expectations, self.definitions[name][1].get("return_expectations"))
+
+    # categorised_as variables are derived from their formulas when every column they refer to
+    # is in the output, and otherwise generated from their expectations like any other column
+    def derived(self, name):
+        _, query_args = self.definitions[name]
+        referenced = set()
+        for definition in query_args["category_definitions"].values():
+            referenced |= names_in(parse(definition))
+        return all(
+            reference in self.definitions and not self.definitions[reference][1].get("hidden")
+            for reference in referenced
+        )
+
+    def column(self, name):
+        if name not in self.results:
+            query_type, query_args = self.definitions[name]
+            if query_type in ("all", "value_from", "fixed_value") or (
+                query_type == "categorised_as" and self.derived(name)
+            ):
+                result = super().column(name)
+            elif query_type == "age_as_of":
+                result = self.dummy_age(name, query_args)
+            elif name in self.chains and self.chains[name][0] != name:
+                result = self.dummy_dose(name, query_args)
+            else:
+                result = self.generate(name, query_type, query_args)
+            self.results[name] = result
+        return self.results[name]
+
+    ################################################################################################
+    # generators
+
+    def generate(self, name, query_type, query_args):
+        expectations = self.expectations(name)
+        kind = column_type(query_type, query_args)
+        rate = expectations.get("rate", "exponential_increase")
+        incidence = 1.0 if rate == "universal" else expectations.get("incidence", 1.0)
+        present = self.streams.draw(name, "present", lambda rng, n: rng.random(n)) < incidence
+
+        if query_type == "categorised_as" and kind == "date":
+            # drawn from the category ratios like any other categorised_as
+            return self.dummy_categories(name, expectations, present)
+        if "date" in expectations:
+            days, in_period = self.dummy_dates(name, expectations["date"], rate, query_args)
+            present &= in_period
+            self.match_dates[name] = np.where(present, days, MISSING_DATE)
+        elif kind == "date":
+            raise ValueError(f"No date expectations defined for {name}")
+
+        if kind == "bool":
+            return Column(present, np.zeros(self.size, dtype=bool))
+        if kind == "date":
+            return Column(from_days(self.match_dates[name]), ~present)
+        if kind == "str":
+            return self.dummy_categories(name, expectations, present)
+        if kind == "int" and "category" in expectations:
+            values, missing = self.dummy_categories(name, expectations, present)
+            return Column(np.where(missing, 0, values).astype(np.int64), missing)
+        if kind == "int":
+            return Column(np.where(present, self.dummy_numbers(name, expectations, "int"), 0), ~present)
+        if kind == "float":
+            return Column(np.where(present, self.dummy_numbers(name, expectations, "float"), 0.0), ~present)
+        raise ValueError(f"Cannot generate a {kind} column for {name}")
+
+    # dates in the expected range and inside the variable's period; where the two don't overlap
+    # the patient gets no date
+    def dummy_dates(self, name, date_expectations, rate, query_args):
+        lower, upper = self.period_bounds(query_args)
+        earliest = parse_date(date_expectations.get("earliest", "1900-01-01"))
+        latest = parse_date(date_expectations.get("latest", "today"))
+        lower = np.maximum(np.asarray(lower, dtype=np.int64), earliest)
+        upper = np.minimum(np.asarray(upper, dtype=np.int64), latest)
+        lower, upper = np.broadcast_arrays(lower, upper)
+        in_period = lower <= upper
+        span = np.where(in_period, upper - lower, 0) + 1
+        draws = self.streams.draw(name, "date", lambda rng, n: rng.random(n))
+        if rate == "exponential_increase":
+            # increasingly common towards the end of the range, as in cohortextractor
+            offsets = -np.log1p(-draws * (1 - np.exp(-10.0))) / 10.0
+            days = upper - np.minimum((offsets * span).astype(np.int64), span - 1)
+        else:
+            days = lower + (draws * span).astype(np.int64)
+        return days, in_period
+
+    def dummy_categories(self, name, expectations, present):
+        if "category" not in expectations:
+            raise ValueError(f"No category expectations defined for {name}")
+        ratios = expectations["category"]["ratios"]
+        labels = list(ratios)
+        p = np.array([ratios[label] for label in labels], dtype=float)
+        chosen = self.streams.draw(name, "category", lambda rng, n: rng.choice(len(labels), size=n, p=p / p.sum()))
+        if all(isinstance(label, (int, np.integer)) for label in labels):
+            table = np.array(labels, dtype=np.int64)
+        else:
+            table = np.array([str(label) for label in labels])
+        values = table[chosen]
+        return Column(np.where(present, values, values.dtype.type()), ~present)
+
+    def dummy_numbers(self, name, expectations, kind):
+        if kind not in expectations:
+            raise ValueError(f"No {kind} expectations defined for {name}")
+        distribution = expectations[kind]
+        if distribution["distribution"] == "normal":
+            values = self.streams.draw(name, kind, lambda rng, n: rng.normal(distribution["mean"], distribution["stddev"], n))
+        elif distribution["distribution"] == "poisson":
+            values = self.streams.draw(name, kind, lambda rng, n: rng.poisson(distribution["mean"], n))
+        elif distribution["distribution"] == "population_ages":
+            values = self.streams.draw(name, kind, population_ages)
+        else:
+            raise ValueError(f"Unsupported distribution for {name}: {distribution['distribution']}")
+        return values.astype(np.int64) if kind == "int" else values
+
+    # one age per patient, drawn from the first age variable's expectations and shared by the rest
+    def dummy_age(self, name, query_args):
+        _, reference_missing = self.date_expression(query_args["reference_date"])
+        if self.ages is None:
+            expectations = self.expectations(name)
+            if expectations.get("int", {}).get("distribution", "population_ages") == "population_ages":
+                self.ages = self.streams.draw(name, "age", population_ages).astype(np.int64)
+            else:
+                self.ages = np.maximum(self.dummy_numbers(name, expectations, "int"), 0)
+        return Column(self.ages.copy(), np.broadcast_to(reference_missing, self.size).copy())
+
+    # a later dose in a vaccination_date_X chain: about DOSE_INTERVAL after the previous dose and
+    # never closer than the chain's gap
+    def dummy_dose(self, name, query_args):
+        names = self.chains[name]
+        previous = names[names.index(name) - 1]
+        self.column(previous)
+        previous_dates = self.match_dates[previous].astype(np.int64)
+        expectations = self.expectations(name)
+        incidence = 1.0 if expectations.get("rate") == "universal" else expectations.get("incidence", 1.0)
+        _, gap = chain_gap(period(query_args)[0])
+        mean, stddev = DOSE_INTERVAL
+        intervals = self.streams.draw(name, "interval", lambda rng, n: rng.normal(mean, stddev, n))
+        intervals = np.maximum(np.round(intervals).astype(np.int64), gap)
+        days = previous_dates + intervals
+        latest = parse_date(expectations.get("date", {}).get("latest", "today"))
+        draws = self.streams.draw(name, "present", lambda rng, n: rng.random(n))
+        present = (previous_dates != MISSING_DATE) & (draws < incidence) & (days <= latest)
+        self.match_dates[name] = np.where(present, days, MISSING_DATE)
+        if column_type("with_tpp_vaccination_record", query_args) == "bool":
+            return Column(present, np.zeros(self.size, dtype=bool))
+        return Column(from_days(self.match_dates[name]), ~present)
+
+    ################################################################################################
+    # output
+
+    # the dummy extract as an arrow table typed as cohortextractor's expectations output: bools,
+    # ints and floats (0 where missing), categories as dictionaries and dates as timestamps at the
+    # start of their date_format's period
+    def to_arrow(self, names=None):
+        import pyarrow as pa
+
+        names = self.output_names() if names is None else names
+        rows = self.population()
+        arrays = {"patient_id": pa.array(self.store.patient_ids[rows])}
+        for name in names:
+            query_type, query_args = self.definitions[name]
+            values, missing = self.column(name)
+            values, missing = values[rows], missing[rows]
+            kind = query_args.get("column_type") or column_type(query_type, query_args)
+            if kind == "date":
+                # categorised_as dates are always full dates
+                date_format = "YYYY-MM-DD" if query_type == "categorised_as" else query_args.get("date_format")
+                arrays[name] = timestamps(values, missing, date_format)
+            elif kind == "str":
+                if values.dtype.kind not in "iu":
+                    values = values.astype(str)
+                arrays[name] = sorted_dictionary(pa.array(values, mask=missing))
+            elif kind == "bool":
+                arrays[name] = pa.array(values.astype(bool) & ~missing)
+            elif kind == "int":
+                arrays[name] = pa.array(np.where(missing, 0, values).astype(np.int64))
+            else:
+                arrays[name] = pa.array(np.where(missing, 0.0, values).astype(float))
+        return pa.table(arrays)
+
+
+# a category column as a dictionary with its categories in sorted order and indices as narrow as
+# pandas makes a categorical's codes, so the encoding doesn't depend on which rows were generated
+# together
+def sorted_dictionary(array):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pa.types.is_dictionary(array.type):
+        array = array.cast(array.type.value_type)
+    if isinstance(array, pa.ChunkedArray):
+        array = pa.concat_arrays(array.chunks) if array.num_chunks else pa.array([], type=array.type)
+    categories = pa.array(sorted(pc.unique(array.drop_null()).to_pylist()), type=array.type)
+    if len(categories) < 2**7:
+        index_type = pa.int8()
+    elif len(categories) < 2**15:
+        index_type = pa.int16()
+    else:
+        index_type = pa.int32()
+    return pa.DictionaryArray.from_arrays(pc.index_in(array, categories).cast(index_type), categories)
+
+
+# generate rows first .. first + size (for a worker process)
+def generate_rows(variables, first, size, default_expectations, seed, index_date=None):
+    generator = DummyGenerator(variables, size, default_expectations, seed, index_date, first_patient=first)
+    return generator.to_arrow()
+
+
+# generate the population in chunks across worker processes; the result is the same as
+# generating it in one go, since every value depends only on its patient's row
+def generate_parallel(
+    variables, population_size, default_expectations, seed, index_date=None, workers=None, chunk_size=4 * STREAM_BLOCK
+):
+    import pyarrow as pa
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                generate_rows,
+                variables,
+                first,
+                min(chunk_size, population_size - first),
+                default_expectations,
+                seed,
+                index_date,
+            )
+            for first in range(0, population_size, chunk_size)
+        ]
+        table = pa.concat_tables([future.result() for future in futures])
+    for position, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(position, field.name, sorted_dictionary(table[field.name]))
+    return table.combine_chunks()
+
+
+# dates (or date strings) as timestamp[ns], the first day of their period when the date_format has
+# no day or month, as cohortextractor reads them back
+def timestamps(values, missing, date_format=None):
+    import pyarrow as pa
+
+    units = {"YYYY-MM-DD": "D", "YYYY-MM": "M"}.get(date_format, "Y")
+    days = to_days(values)
+    missing = missing | (days == MISSING_DATE)
+    dates = from_days(np.where(missing, 0, days)).astype(f"datetime64[{units}]").astype("datetime64[ns]")
+    return pa.array(dates, mask=missing)
+
+
+# the population size set for dummy data in project.yaml
+def expectations_population_size(path="project.yaml"):
+    with open(path) as f:
+        match = re.search(r"population_size:\s*(\d+)", f.read())
+    return int(match.group(1)) if match else 1000
+
+
+if __name__ == "__main__":
+    import argparse
+    import importlib
+
+    import pyarrow as pa
+    from pyarrow import feather
+
+    from study_metadata import load_metadata
+
+    parser = argparse.ArgumentParser(description="Generate dummy data from a study definition's expectations")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument("--population-size", type=int, default=None)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--workers", type=int, default=1, help="processes to generate patient chunks in")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    if os.getenv("OPENSAFELY_BACKEND", "") not in ("", "expectations"):
+        # dummy data isn't needed on the server; write an empty file to keep project.yaml happy
+        feather.write_feather(pa.table({}), args.output)
+        sys.exit(0)
+
+    study_parameters = load_metadata().study_parameters
+    study = importlib.import_module(args.study).study
+    arguments = (
+        study_variables(args.study),
+        args.population_size or expectations_population_size(),
+        getattr(study, "default_expectations", {}),
+        int(study_parameters["seed"]),
+        getattr(study, "index_date", None),
+    )
+    if args.workers > 1:
+        table = generate_parallel(*arguments, workers=args.workers)
+    else:
+        table = DummyGenerator(*arguments).to_arrow()
+    feather.write_feather(table, args.output)
@@ -4,43 +4,55 @@ from cohortextractor import (
     patients, 
 )
 
-# import codelists.py script
-from codelists import *
+# import codelists (each codelist is only read when imported here)
+from codelists import (
+    ast_primis,
+    astadm_primis,
+    astrx_primis,
+    bmi_primis,
+    bmi_stage_primis,
+    chd_primis,
+    ckd15_primis,
+    ckd35_primis,
+    ckd_primis,
+    cld_primis,
+    cns_primis,
+    diab_primis,
+    dmres_primis,
+    immdx_primis,
+    immrx_primis,
+    learndis_primis,
+    longres_primis,
+    nonshield_primis,
+    resp_primis,
+    sev_mental_primis,
+    sev_obesity_primis,
+    shield_primis,
+    smhres_primis,
+    spln_primis,
+)
 
 from functions import *
 
-# import json module
-import json
+# study design metadata written by the design action (read without pandas)
+from study_metadata import load_metadata
 
-import pandas as pd
+metadata = load_metadata()
 
 ### import groups and dates
 # atrisk_group
-atrisk_group = pd.read_csv(
-    filepath_or_buffer='./analysis/lib/atrisk_group.csv',
-    dtype=str
-)
-str_atrisk = atrisk_group['atrisk_group'][0]
+str_atrisk = metadata.atrisk_group
 
 # jcvi_groups
-jcvi_groups = pd.read_csv(
-    filepath_or_buffer='./analysis/lib/jcvi_groups.csv',
-    dtype=str
-)
-dict_jcvi = { jcvi_groups['group'][i] : jcvi_groups['definition'][i] for i in jcvi_groups.index }
-ratio_jcvi = { jcvi_groups['group'][i] : 1/len(jcvi_groups.index) for i in jcvi_groups.index }
+dict_jcvi = metadata.dict_jcvi
+ratio_jcvi = metadata.ratio_jcvi
 
 # elig_dates
-elig_dates = pd.read_csv(
-    filepath_or_buffer='./analysis/lib/elig_dates.csv',
-    dtype=str
-)
-dict_elig = { elig_dates['date'][i] : elig_dates['description'][i] for i in elig_dates.index }
-ratio_elig = { elig_dates['date'][i] : 1/len(elig_dates.index) for i in elig_dates.index }
+dict_elig = metadata.dict_elig
+ratio_elig = metadata.ratio_elig
 
 #study_parameters
-with open("./analysis/lib/study_parameters.json") as f:
-  study_parameters = json.load(f)
+study_parameters = metadata.study_parameters
 
 # set seed so that dummy data can be reproduced
 import numpy as np
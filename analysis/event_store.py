@@ -0,0 +1,299 @@
+import hashlib
+import os
+
+import numpy as np
+
+####################################################################################################
+# local columnar event store
+# a stand-in for the backend tables the study definition queries, held as numpy columns
+# and sorted by patient_id then date so per-patient results can be read off contiguous runs
+#
+# dates are int32 days since 1970-01-01; MISSING_DATE marks a NULL date and spells that are
+# still open end on OPEN_END_DATE (9999-12-31), as in the TPP registration tables
+
+MISSING_DATE = np.iinfo(np.int32).min
+OPEN_END_DATE = int(np.datetime64("9999-12-31", "D").astype(np.int64))
+
+# the tables the local backend knows about, with their date columns (the first one is the sort key)
+TABLES = {
+    # one row per patient
+    "patients": {
+        "columns": ["patient_id", "date_of_birth", "sex", "date_of_death"],
+        "dates": ["date_of_birth", "date_of_death"],
+    },
+    # coded events (snomed); numeric_value is 0 where nothing was recorded
+    "clinical_events": {
+        "columns": ["patient_id", "date", "code", "numeric_value"],
+        "dates": ["date"],
+    },
+    # medication issues (dm+d)
+    "medications": {
+        "columns": ["patient_id", "date", "code"],
+        "dates": ["date"],
+    },
+    # tpp vaccination records
+    "vaccinations": {
+        "columns": ["patient_id", "date", "target_disease", "product_name"],
+        "dates": ["date"],
+    },
+    # practice registration spells
+    "registrations": {
+        "columns": ["patient_id", "start_date", "end_date", "pseudo_id", "nuts1_region_name", "stp_code", "msoa"],
+        "dates": ["start_date", "end_date"],
+    },
+    # address spells; index_of_multiple_deprivation is -1 where no postcode was recorded
+    "addresses": {
+        "columns": ["patient_id", "start_date", "end_date", "index_of_multiple_deprivation", "msoa", "rural_urban_classification"],
+        "dates": ["start_date", "end_date"],
+    },
+}
+
+
+def to_days(dates):
+    dates = np.asarray(dates)
+    if dates.dtype.kind == "M":
+        days = dates.astype("datetime64[D]").astype(np.int64)
+        days[np.isnat(dates)] = MISSING_DATE
+        return days.astype(np.int32)
+    if dates.dtype.kind in "US" or dates.dtype.kind == "O":
+        return to_days(np.array([date or "NaT" for date in dates], dtype="datetime64[D]"))
+    return dates.astype(np.int32)
+
+
+def from_days(days):
+    days = np.asarray(days)
+    dates = days.astype(np.int64).astype("datetime64[D]")
+    dates[days == MISSING_DATE] = np.datetime64("NaT")
+    return dates
+
+
+class Table:
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = dict(columns)
+        dates = TABLES.get(name, {}).get("dates", [])
+        for column in dates:
+            if column in self.columns:
+                self.columns[column] = to_days(self.columns[column])
+        if "end_date" in self.columns:
+            end_date = self.columns["end_date"]
+            end_date[end_date == MISSING_DATE] = OPEN_END_DATE
+        self.sort(dates[0] if dates and name != "patients" else None)
+
+    def sort(self, date_column):
+        patient_id = self.columns["patient_id"]
+        keys = [patient_id] if date_column is None else [self.columns[date_column], patient_id]
+        if is_sorted(keys):
+            return
+        order = np.lexsort(keys)
+        self.columns = {name: values[order] for name, values in self.columns.items()}
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __len__(self):
+        return len(self.columns["patient_id"])
+
+
+# are rows already ordered by keys (last key most significant, as for np.lexsort)
+def is_sorted(keys):
+    if len(keys[0]) < 2:
+        return True
+    ordered = np.ones(len(keys[0]) - 1, dtype=bool)
+    tied = np.ones(len(keys[0]) - 1, dtype=bool)
+    for key in reversed(keys):
+        step = np.diff(key.astype(np.int64)) if key.dtype.kind in "iub" else None
+        if step is None:
+            return False
+        ordered &= ~tied | (step >= 0)
+        tied &= step == 0
+    return bool(ordered.all())
+
+
+class EventStore:
+    def __init__(self, tables):
+        self.tables = {name: Table(name, columns) for name, columns in tables.items()}
+        self.patient_ids = self.tables["patients"]["patient_id"]
+        self._rows = {}
+        self._histograms = {}
+        self._fingerprint = None
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    @property
+    def size(self):
+        return len(self.patient_ids)
+
+    # digest of the store's contents, for keying cached results; stores read from a directory
+    # use the files' names, sizes and modification times instead of hashing every column
+    def fingerprint(self):
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for name, table in sorted(self.tables.items()):
+                digest.update(name.encode())
+                for column, values in sorted(table.columns.items()):
+                    digest.update(f"{column}:{values.dtype.str}:{len(values)}".encode())
+                    if values.dtype.kind == "O":
+                        digest.update("\0".join(map(str, values)).encode())
+                    else:
+                        digest.update(np.ascontiguousarray(values).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    # row of each table record's patient in the patients table (cached per table)
+    def patient_rows(self, name):
+        if name not in self._rows:
+            self._rows[name] = np.searchsorted(self.patient_ids, self.tables[name]["patient_id"])
+        return self._rows[name]
+
+    # events per code of an event table, from its code column (cached per table)
+    def code_histogram(self, name):
+        if name not in self._histograms:
+            self._histograms[name] = CodeHistogram.from_codes(self.tables[name]["code"])
+        return self._histograms[name]
+
+    # read <name>.feather for each known table in a directory
+    @classmethod
+    def from_directory(cls, path):
+        tables, digest = open_tables(path)
+        store = cls({name: arrow_columns(table) for name, table in tables.items()})
+        store._fingerprint = digest
+        return store
+
+    def to_directory(self, path):
+        import pyarrow as pa
+        from pyarrow import feather
+
+        os.makedirs(path, exist_ok=True)
+        for name, table in self.tables.items():
+            dates = TABLES.get(name, {}).get("dates", [])
+            arrays = {}
+            for column, values in table.columns.items():
+                if column in dates:
+                    arrays[column] = pa.array(from_days(values), type=pa.date32())
+                else:
+                    arrays[column] = pa.array(values)
+            # uncompressed, so open_tables can memory-map the files
+            feather.write_feather(
+                pa.table(arrays), os.path.join(path, f"{name}.feather"), compression="uncompressed"
+            )
+
+
+# memory-map <name>.feather for each known table in a directory; returns the arrow tables and a
+# digest of the files' names, sizes and modification times
+def open_tables(path):
+    import pyarrow as pa
+    from pyarrow import feather
+
+    tables = {}
+    digest = hashlib.sha256()
+    for name in TABLES:
+        filename = os.path.join(path, f"{name}.feather")
+        if not os.path.exists(filename):
+            continue
+        stat = os.stat(filename)
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        tables[name] = feather.read_table(pa.memory_map(filename))
+    return tables, digest.hexdigest()
+
+
+# numpy columns of an arrow table, with NULL dates as NaT
+def arrow_columns(table):
+    from rules import column_from_arrow
+
+    columns = {}
+    for column in table.column_names:
+        values, missing = column_from_arrow(table[column])
+        if values.dtype.kind == "M":
+            values = values.copy()
+            values[missing] = np.datetime64("NaT")
+        columns[column] = values
+    return columns
+
+
+####################################################################################################
+# multi-codelist code index
+# every codelist used against a table gets one bit; a single hash probe per event then says which
+# codelists the event's code belongs to, so the event table is scanned once for all variables
+
+class CodeIndex:
+    def __init__(self, codelists, dtype):
+        import pandas as pd
+
+        self.slots = len(codelists)
+        self.words = max(1, -(-self.slots // 64))
+        codes = [as_codes(codes, dtype) for codes in codelists]
+        unique = np.unique(np.concatenate(codes)) if codes else np.array([], dtype=dtype)
+        self.index = pd.Index(unique)
+        self.bits = np.zeros((len(unique), self.words), dtype=np.uint64)
+        for slot, slot_codes in enumerate(codes):
+            word, bit = divmod(slot, 64)
+            self.bits[self.index.get_indexer(slot_codes), word] |= np.uint64(1) << np.uint64(bit)
+
+    # codelist bitmask of each code, zero for codes in no codelist
+    def masks(self, codes):
+        position = self.index.get_indexer(codes)
+        masks = self.bits[np.maximum(position, 0)]
+        masks[position < 0] = 0
+        return masks
+
+
+# a codelist's codes as an array comparable with an event table's code column
+def as_codes(codes, dtype):
+    codes = [code[0] if isinstance(code, tuple) else code for code in codes]
+    if np.dtype(dtype).kind in "iu":
+        return np.array([int(code) for code in codes if str(code).isdigit()], dtype=dtype)
+    return np.array(codes, dtype=object)
+
+
+class Scan:
+    def __init__(self, rows, masks, slots):
+        self.rows = rows
+        self.masks = masks
+        self.slots = slots
+
+    # event rows (in table order) whose code is in the codelist at `slot`
+    def rows_for(self, slot):
+        word, bit = divmod(slot, 64)
+        hit = (self.masks[:, word] >> np.uint64(bit)) & np.uint64(1)
+        return self.rows[hit.astype(bool)]
+
+
+# scan a table's codes once against every codelist, keeping only rows that hit at least one
+def scan_codes(table, codelists):
+    index = CodeIndex(codelists, table["code"].dtype)
+    masks = index.masks(table["code"])
+    rows = np.flatnonzero(masks.any(axis=1))
+    return Scan(rows, masks[rows], {id(codes): slot for slot, codes in enumerate(codelists)})
+
+
+####################################################################################################
+# code statistics
+# events per code, and from them the number of events a codelist will match (its cardinality),
+# so the events a coded event query reads can be estimated before it is run; counted once per
+# table from its code column (EventStore.code_histogram), not from a scan
+
+class CodeHistogram:
+    def __init__(self, codes, counts):
+        # codes sorted, counts aligned
+        self.codes = codes
+        self.counts = counts
+
+    @classmethod
+    def from_codes(cls, codes):
+        return cls(*np.unique(codes, return_counts=True))
+
+    # events with any of the codelist's codes
+    def count(self, codes):
+        codes = np.unique(as_codes(codes, self.codes.dtype))
+        if not len(self.codes) or not len(codes):
+            return 0
+        position = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return int(self.counts[position][self.codes[position] == codes].sum())
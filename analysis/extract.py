@@ -0,0 +1,237 @@
+import argparse
+import functools
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from atomic_write import atomic_write
+from event_store import EventStore, arrow_columns, open_tables
+from local_backend import LocalBackend, study_variables
+from result_cache import CACHE_DIR, CachedBackend, ResultCache
+
+####################################################################################################
+# streaming extraction
+# evaluates a study definition against a local event store one patient_id range at a time and
+# appends each chunk to the output as an arrow record batch, so peak memory is bounded by the
+# chunk size rather than the population
+#
+# the event store's feather files are memory-mapped and every table is sorted by patient_id
+# (as EventStore.to_directory writes them), so a chunk's rows are one contiguous slice of each
+# table; the output is an arrow IPC file, i.e. feather v2, readable by arrow::read_feather
+#
+#   python analysis/extract.py --store <event store directory> --output output/extract/input.feather [--workers N]
+#
+# with --workers N > 1 the command line runs extract_sharded (below) instead, which writes the
+# same bytes; either way each chunk of --chunk-size patients is one record batch of the output
+#
+# with --threads N each chunk's independent variables are evaluated on N threads (see
+# scheduler.py); the output is the same, and N × --workers should not exceed the cores available
+#
+# with --ragged each vaccination chain is written as one list column of every dose date (see
+# LocalBackend.to_arrow) rather than as its capped {name}_1_date ... {name}_n_date columns
+#
+# with --cache [DIR] each chunk's variables are read from and stored in a ResultCache (see
+# result_cache.py), so a re-run only evaluates the variables whose definition or codelists
+# changed; a chunk's entries are keyed by its patient range, so they're only reused by runs with
+# the same --chunk-size
+
+CHUNK_SIZE = 100_000
+
+
+# the memory-mapped tables of an event store and their patient_id columns, checked to be sorted
+def sorted_tables(path):
+    tables, digest = open_tables(path)
+    patient_ids = {name: table["patient_id"].to_numpy() for name, table in tables.items()}
+    for name, ids in patient_ids.items():
+        if np.any(ids[1:] < ids[:-1]):
+            raise ValueError(f"{name}.feather is not sorted by patient_id; write it with EventStore.to_directory")
+    return tables, digest, patient_ids
+
+
+# the EventStore of patients start:stop (in patient_id order), sliced from the tables without copying
+def patient_range(tables, digest, patient_ids, start, stop):
+    first, last = patient_ids["patients"][start], patient_ids["patients"][stop - 1]
+    chunk = {}
+    for name, table in tables.items():
+        lower = np.searchsorted(patient_ids[name], first, side="left")
+        upper = np.searchsorted(patient_ids[name], last, side="right")
+        chunk[name] = table.slice(lower, upper - lower)
+    store = EventStore({name: arrow_columns(table) for name, table in chunk.items()})
+    store._fingerprint = hashlib.sha256(f"{digest}:{start}:{stop}".encode()).hexdigest()
+    return store
+
+
+# EventStores of consecutive chunks of at most chunk_size patients: chunks first .. last - 1, or
+# to the end of the store
+def store_chunks(path, chunk_size=CHUNK_SIZE, first=0, last=None):
+    tables, digest, patient_ids = sorted_tables(path)
+    size = len(patient_ids["patients"])
+    stop = size if last is None else min(last * chunk_size, size)
+    for start in range(first * chunk_size, stop, chunk_size):
+        yield patient_range(tables, digest, patient_ids, start, min(start + chunk_size, size))
+
+
+# the number of chunks of at most chunk_size patients in an event store
+def chunk_count(path, chunk_size=CHUNK_SIZE):
+    tables, _ = open_tables(path)
+    return -(-tables["patients"].num_rows // chunk_size)
+
+
+# the extract of each chunk, in order
+def chunk_tables(variables, store_path, chunk_size, index_date, backend, ragged, first=0, last=None):
+    for store in store_chunks(store_path, chunk_size, first, last):
+        yield backend(store, variables, index_date).to_arrow(ragged=ragged)
+
+
+# one table as one record batch (even an empty one, so batches line up with chunks)
+def as_batch(table, schema):
+    import pyarrow as pa
+
+    table = table.cast(schema)
+    return pa.RecordBatch.from_arrays([column.combine_chunks() for column in table.columns], schema=schema)
+
+
+# write each table as one record batch of an arrow IPC file, in the first table's schema; written
+# atomically, so a failed run leaves no partial extract; returns the row count
+def write_batches(tables, output, store_path):
+    import pyarrow as pa
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    options = pa.ipc.IpcWriteOptions(compression="lz4")
+    writer = None
+    rows = 0
+    with atomic_write(output, suffix=".feather") as f:
+        for table in tables:
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(f, schema, options=options)
+            writer.write_batch(as_batch(table, schema))
+            rows += table.num_rows
+        if writer is None:
+            raise ValueError(f"No patients in {store_path}")
+        writer.close()
+    return rows
+
+
+# evaluate variables chunk by chunk, writing each chunk as it is done; returns the row count
+def extract(variables, store_path, output, chunk_size=CHUNK_SIZE, index_date=None, backend=LocalBackend, ragged=False):
+    return write_batches(chunk_tables(variables, store_path, chunk_size, index_date, backend, ragged), output, store_path)
+
+
+####################################################################################################
+# patient-sharded extraction
+# the store's chunks (as extract makes them) are split into as many consecutive runs as there are
+# workers; each worker streams its chunks' batches to a temporary arrow IPC stream beside the
+# output, and the shards' batches are read back memory-mapped and written in chunk order, so
+# workers and the parent hold one chunk at a time and the output is byte-identical to extract's
+# whatever the number of workers (which is at most the number of chunks)
+
+
+# the [first, last) chunks of a shard
+def shard_range(size, shard, shards):
+    return size * shard // shards, size * (shard + 1) // shards
+
+
+# evaluate one shard's chunks in a worker process; returns the path of its arrow IPC stream
+def extract_shard(
+    variables, store_path, shard, shards, directory, chunk_size=CHUNK_SIZE, index_date=None, backend=LocalBackend, ragged=False
+):
+    import pyarrow as pa
+
+    first, last = shard_range(chunk_count(store_path, chunk_size), shard, shards)
+    writer = None
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".arrows", delete=False) as f:
+        try:
+            for table in chunk_tables(variables, store_path, chunk_size, index_date, backend, ragged, first, last):
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_stream(f, schema)
+                writer.write_batch(as_batch(table, schema))
+            writer.close()
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name
+
+
+# the batches of each shard's stream as tables, in shard order; each stream is removed once read
+def shard_tables(futures):
+    import pyarrow as pa
+
+    for future in futures:
+        path = future.result()
+        try:
+            with pa.memory_map(path) as source:
+                for batch in pa.ipc.open_stream(source):
+                    yield pa.Table.from_batches([batch])
+        finally:
+            os.remove(path)
+
+
+def extract_sharded(
+    variables,
+    store_path,
+    output,
+    workers=None,
+    chunk_size=CHUNK_SIZE,
+    index_date=None,
+    backend=LocalBackend,
+    ragged=False,
+):
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunks = chunk_count(store_path, chunk_size)
+    if not chunks:
+        raise ValueError(f"No patients in {store_path}")
+    # every shard gets at least one chunk
+    workers = min(workers or os.cpu_count(), chunks)
+    if workers == 1:
+        return extract(variables, store_path, output, chunk_size, index_date, backend, ragged)
+
+    directory = os.path.dirname(output) or "."
+    os.makedirs(directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                extract_shard, variables, store_path, shard, workers, directory, chunk_size, index_date, backend, ragged
+            )
+            for shard in range(workers)
+        ]
+        try:
+            return write_batches(shard_tables(futures), output, store_path)
+        except BaseException:
+            # the streams of shards that weren't read
+            for future in futures:
+                if not future.cancel() and future.exception() is None and os.path.exists(future.result()):
+                    os.remove(future.result())
+            raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract a study definition from a local event store")
+    parser.add_argument("--store", required=True, help="directory of event store feather files")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument("--output", default="output/extract/input.feather")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--index-date", default=None)
+    parser.add_argument("--workers", type=int, default=1, help="processes to shard patients across")
+    parser.add_argument("--threads", type=int, default=1, help="threads each process evaluates variables on")
+    parser.add_argument("--ragged", action="store_true", help="write each vaccination chain as one list column")
+    parser.add_argument(
+        "--cache", nargs="?", const=CACHE_DIR, default=None, help=f"cache variable results (in {CACHE_DIR} by default)"
+    )
+    args = parser.parse_args()
+    variables = study_variables(args.study)
+    backend = functools.partial(LocalBackend, threads=args.threads)
+    if args.cache:
+        backend = functools.partial(CachedBackend, threads=args.threads, cache=ResultCache(args.cache))
+    if args.workers > 1:
+        rows = extract_sharded(
+            variables, args.store, args.output, args.workers, args.chunk_size, args.index_date, backend, args.ragged
+        )
+    else:
+        rows = extract(variables, args.store, args.output, args.chunk_size, args.index_date, backend, args.ragged)
+    print(f"{rows} patients written to {args.output}")
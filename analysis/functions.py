@@ -1,5 +1,5 @@
 from cohortextractor import patients
-from codelists import *
+import codelists
 
 ####################################################################################################
 # function to add days to a string date
@@ -14,6 +14,7 @@ def days(datestring, days):
 
 ####################################################################################################
 # functio to extract a sequence of vacination dates
+# (the local backend recognises the chain and extracts all n dates in one pass, see local_backend.vaccination_chains)
 def vaccination_date_X(name, index_date, n, product_name_matches=None, target_disease_matches=None):
   # vaccination date, given product_name
   def var_signature(
@@ -53,7 +54,7 @@ def pregnancy(name, index_date, type):
     return {
       # date of last pregnancy code in 36 weeks before index_date
       f"{name}_36wks_date": patients.with_these_clinical_events(
-        preg_primis,
+        codelists.preg_primis,
         returning = "date",
         find_last_match_in_period = True,
         between = between,
@@ -65,7 +66,7 @@ def pregnancy(name, index_date, type):
     return {
       # date of last delivery code recorded in 36 weeks before index_date
       f"{name}_del_date": patients.with_these_clinical_events(
-        pregdel_primis,
+        codelists.pregdel_primis,
         returning = "date",
         find_last_match_in_period = True,
         between = between,
@@ -0,0 +1,217 @@
+import argparse
+import re
+from functools import lru_cache
+
+import numpy as np
+
+####################################################################################################
+# icd-10 codelist index
+# resolves membership of a column of diagnoses in an ICD-10 codelist in one vectorised pass; the
+# diagnoses are factorised first, so the string work is per distinct diagnosis rather than per row
+#
+# matching follows one of three modes (`mode=`):
+# - prefix (the default): as cohortextractor matches hospital diagnoses on TPP, each codelist
+#   entry is a LIKE prefix of the diagnosis as stored (`Spell_Primary_Diagnosis LIKE 'A00%'`), so
+#   A00 covers A000-A009 (and A00.1), but a range entry (A00-A09) or a chapter (I) is read
+#   literally too, and diagnoses are not normalised; the entries, made prefix-free, are sorted,
+#   and the only entry that can be a prefix of a diagnosis is the greatest one not after it
+# - exact: as ONS death certificate causes are matched on TPP (`icd10u IN (...)`)
+# - expanded: NOT how TPP matches, so not for reproducing an extract; codelists mix leaf codes
+#   (A000), 3-character categories (A00), ranges of categories (A00-A09) and whole chapters (I, in
+#   roman numerals), and this mode reads them as a coder would: A00 covers A000-A009, A00-A09
+#   covers every code from A00 to A09X, I covers A00-B99, and diagnoses are normalised first
+#
+# in expanded mode every code is encoded as an integer, base 37 over its first WIDTH characters
+# (digits, then letters, 0 for "no more characters"), so that ordering codes orders their keys and
+# a prefix's codes are exactly the keys between the prefix padded with the lowest and with the
+# highest character; a codelist becomes a few disjoint sorted key intervals, and membership for a
+# column of diagnoses is one searchsorted of their keys against the interval starts
+#
+#   python analysis/icd10.py ICD10_I_codes      summarises what a codelist compiles to
+
+WIDTH = 6
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE = len(ALPHABET) + 1
+HIGHEST = len(ALPHABET)
+
+# the categories of each chapter (WHO ICD-10 2019)
+CHAPTERS = {
+    "I": "A00-B99",
+    "II": "C00-D48",
+    "III": "D50-D89",
+    "IV": "E00-E90",
+    "V": "F00-F99",
+    "VI": "G00-G99",
+    "VII": "H00-H59",
+    "VIII": "H60-H95",
+    "IX": "I00-I99",
+    "X": "J00-J99",
+    "XI": "K00-K93",
+    "XII": "L00-L99",
+    "XIII": "M00-M99",
+    "XIV": "N00-N99",
+    "XV": "O00-O99",
+    "XVI": "P00-P96",
+    "XVII": "Q00-Q99",
+    "XVIII": "R00-R99",
+    "XIX": "S00-T98",
+    "XX": "V01-Y98",
+    "XXI": "Z00-Z99",
+    "XXII": "U00-U99",
+}
+
+MODES = ("prefix", "exact", "expanded")
+
+CODE_RE = re.compile(r"^[A-Z][0-9][0-9A-Z]*$")
+RANGE_RE = re.compile(r"^([A-Z][0-9][0-9A-Z]*)-([A-Z][0-9][0-9A-Z]*)$")
+
+
+class ICD10Error(ValueError):
+    pass
+
+
+# upper case, without dots, spaces and dagger / asterisk marks ("a09.0" -> "A090", "G01*" -> "G01")
+def normalise(code):
+    return re.sub(r"[^0-9A-Z-]", "", str(code).upper()).rstrip("-")
+
+
+# the key of a code padded to WIDTH with `pad` (0 or HIGHEST)
+def encode(code, pad=0):
+    digits = [ALPHABET.index(character) + 1 for character in code[:WIDTH]]
+    digits += [pad] * (WIDTH - len(digits))
+    key = 0
+    for digit in digits:
+        key = key * BASE + digit
+    return key
+
+
+# the inclusive key interval a codelist entry covers
+def entry_interval(entry):
+    code = normalise(entry)
+    code = CHAPTERS.get(code, code)
+    match = RANGE_RE.match(code)
+    if match:
+        first, last = match.groups()
+        if first > last:
+            raise ICD10Error(f"ICD-10 range {entry!r} is backwards")
+        return encode(first), encode(last, HIGHEST)
+    if not CODE_RE.match(code):
+        raise ICD10Error(f"Not an ICD-10 code or range: {entry!r}")
+    return encode(code), encode(code, HIGHEST)
+
+
+class ICD10Index:
+    def __init__(self, codes):
+        intervals = sorted(entry_interval(code[0] if isinstance(code, tuple) else code) for code in codes)
+        # merge overlapping and adjacent intervals (A00 and A00-A09, A01 after A00)
+        starts, ends = [], []
+        for start, end in intervals:
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.entries = len(intervals)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains_keys(self, keys):
+        if not len(self):
+            return np.zeros(len(keys), dtype=bool)
+        position = np.searchsorted(self.starts, keys, side="right") - 1
+        return (position >= 0) & (keys <= self.ends[np.maximum(position, 0)]) & (keys > 0)
+
+    # for each diagnosis (a string, or None / "" for none), whether the codelist covers it
+    def contains(self, diagnoses):
+        positions, distinct = factorise(diagnoses)
+        covered = self.contains_keys(np.array([diagnosis_key(value) for value in distinct], dtype=np.int64))
+        return np.append(covered, False)[positions]
+
+
+# the key of a diagnosis, 0 where it isn't a code (nothing then matches it)
+def diagnosis_key(value):
+    code = normalise(value)
+    return encode(code) if CODE_RE.match(code) else 0
+
+
+# distinct diagnoses as strings, with the position of each diagnosis among them (-1 for none)
+def factorise(diagnoses):
+    import pandas as pd
+
+    positions, distinct = pd.factorize(np.asarray(diagnoses, dtype=object))
+    return positions, np.array([str(value) for value in distinct], dtype=str)
+
+
+class PrefixIndex:
+    def __init__(self, codes):
+        self.entries = len(codes)
+        # an entry with a shorter entry as a prefix matches nothing more
+        prefixes = []
+        for code in sorted(set(codes)):
+            if code and not (prefixes and code.startswith(prefixes[-1])):
+                prefixes.append(code)
+        self.prefixes = np.array(prefixes, dtype=str)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def contains(self, diagnoses):
+        positions, distinct = factorise(diagnoses)
+        covered = np.zeros(len(distinct), dtype=bool)
+        if len(self) and len(distinct):
+            candidate = np.searchsorted(self.prefixes, distinct, side="right") - 1
+            covered = (candidate >= 0) & np.char.startswith(distinct, self.prefixes[np.maximum(candidate, 0)])
+        return np.append(covered, False)[positions]
+
+
+class ExactIndex:
+    def __init__(self, codes):
+        self.entries = len(codes)
+        self.codes = np.unique(np.array([code for code in codes if code], dtype=str))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def contains(self, diagnoses):
+        positions, distinct = factorise(diagnoses)
+        return np.append(np.isin(distinct, self.codes), False)[positions]
+
+
+INDEXES = {"prefix": PrefixIndex, "exact": ExactIndex, "expanded": ICD10Index}
+
+
+# the index of a codelist, compiled once per set of codes and mode
+@lru_cache(maxsize=None)
+def _compile(codes, mode):
+    return INDEXES[mode](codes)
+
+
+def icd10_index(codelist, mode="prefix"):
+    system = getattr(codelist, "system", "icd10")
+    if system != "icd10":
+        raise ICD10Error(f"Expected an ICD-10 codelist, got system {system!r}")
+    if mode not in MODES:
+        raise ICD10Error(f"Unknown ICD-10 matching mode {mode!r}, expected one of {MODES}")
+    return _compile(tuple(code[0] if isinstance(code, tuple) else code for code in codelist), mode)
+
+
+# whether each diagnosis is in an ICD-10 codelist, matched as TPP matches hospital diagnoses unless
+# another mode is given (see the modes above)
+def matches(codelist, diagnoses, mode="prefix"):
+    return icd10_index(codelist, mode).contains(diagnoses)
+
+
+if __name__ == "__main__":
+    import codelists
+
+    parser = argparse.ArgumentParser(description="Compile ICD-10 codelists to prefixes and intervals")
+    parser.add_argument("names", nargs="+", help="codelists in codelists.py")
+    args = parser.parse_args()
+
+    for name in args.names:
+        codelist = codelists.load(name)
+        prefix, expanded = icd10_index(codelist), icd10_index(codelist, "expanded")
+        print(f"{name}: {prefix.entries} entries -> {len(prefix)} prefixes, {len(expanded)} expanded intervals")
@@ -0,0 +1,209 @@
+import numpy as np
+
+from event_store import MISSING_DATE
+
+####################################################################################################
+# sort-merge interval join
+# events sorted by (patient row, date) are joined to one inclusive [lower, upper] day window per
+# patient, where the bounds may be constants or per-patient columns ("elig_date - 1 day",
+# "{index_date} - 252 days")
+#
+# each event is keyed by patient row in the high 32 bits and date in the low 32, so the keys are
+# sorted; the window probes are sorted the same way, so one searchsorted of the probes against
+# the keys (a merge of two sorted sequences) gives every patient's run of events in its window,
+# and first / last / any / count are read off the run ends without materialising the matches
+
+DATE_MIN = np.iinfo(np.int32).min
+DATE_MAX = np.iinfo(np.int32).max
+
+
+class SortedEvents:
+    # groups (patient rows) and dates aligned, sorted by group then date
+    def __init__(self, groups, dates, size):
+        self.size = size
+        self.keys = keys(groups, dates)
+
+    @classmethod
+    def from_rows(cls, rows, patient_rows, dates, size):
+        return cls(patient_rows[rows], dates[rows], size)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # per patient, the positions [start, stop) of the events inside its window
+    def window(self, lower, upper):
+        lower, upper = probes(self.size, lower, upper)
+        start = np.searchsorted(self.keys, lower, side="left")
+        stop = np.searchsorted(self.keys, upper, side="right")
+        # an empty window (lower > upper) gives stop < start
+        return start, np.maximum(stop, start)
+
+    def count(self, lower, upper):
+        start, stop = self.window(lower, upper)
+        return stop - start
+
+    def any(self, lower, upper):
+        start, stop = self.window(lower, upper)
+        return stop > start
+
+    # position of the first event in each window, -1 where there is none
+    def first(self, lower, upper):
+        start, stop = self.window(lower, upper)
+        return np.where(stop > start, start, -1)
+
+    # position of the last event in each window, -1 where there is none; where several events
+    # share the last date the first recorded one is taken, as in the TPP backend
+    def last(self, lower, upper):
+        return self.last_in(*self.window(lower, upper))
+
+    # last (as above) of windows already found with window()
+    def last_in(self, start, stop):
+        found = stop > start
+        if not len(self.keys):
+            return np.full(len(start), -1, dtype=np.int64)
+        last = np.minimum(np.maximum(stop - 1, 0), len(self.keys) - 1)
+        last = np.searchsorted(self.keys, self.keys[last], side="left")
+        return np.where(found, last, -1)
+
+    # the first event, or the last as above
+    def select(self, lower, upper, first=True):
+        return self.first(lower, upper) if first else self.last(lower, upper)
+
+
+####################################################################################################
+# as-of join
+# point-in-time lookups into spell tables (registrations, addresses): which spell, if any, was
+# current for each patient on its own as-of date
+#
+# a patient's spell starts and ends cut its history into elementary segments, and every segment
+# is covered by the same set of spells throughout, so the winning spell of each segment is
+# resolved once when the index is built; a lookup is then one searchsorted of the (patient row,
+# as-of date) probes against the segment starts
+
+class AsOfIndex:
+    # spells as groups (patient rows), starts and ends (a spell covers start <= day < end);
+    # overlapping spells are resolved by latest start, then latest end, then those not marked
+    # `last`, then the first recorded
+    def __init__(self, groups, starts, ends, size, last=None):
+        self.size = size
+        groups = np.asarray(groups, dtype=np.int64)
+        start_keys = keys(groups, starts)
+        end_keys = keys(groups, ends)
+        boundaries = np.sort(np.concatenate([start_keys, end_keys]))
+        self.keys = boundaries[np.concatenate([[True], boundaries[1:] != boundaries[:-1]])[: len(boundaries)]]
+        # segment j runs from keys[j] up to keys[j + 1]; spell i covers segments
+        # [first[i], stop[i]) (none where its end is not after its start)
+        first = np.searchsorted(self.keys, start_keys)
+        stop = np.maximum(np.searchsorted(self.keys, end_keys), first)
+        counts = stop - first
+        spells = np.repeat(np.arange(len(groups)), counts)
+        offsets = np.arange(len(spells)) - np.repeat(np.cumsum(counts) - counts, counts)
+        segments = np.repeat(first, counts) + offsets
+        if last is None:
+            last = np.zeros(len(groups), dtype=bool)
+        order = np.lexsort(
+            (
+                spells,
+                np.asarray(last)[spells],
+                -np.asarray(ends, dtype=np.int64)[spells],
+                -np.asarray(starts, dtype=np.int64)[spells],
+                segments,
+            )
+        )
+        segments, spells = segments[order], spells[order]
+        winners = np.ones(len(segments), dtype=bool)
+        winners[1:] = segments[1:] != segments[:-1]
+        # the winning spell of each segment, -1 for gaps between spells and after the last one
+        self.spells = np.full(len(self.keys), -1, dtype=np.int64)
+        self.spells[segments[winners]] = spells[winners]
+
+    def __len__(self):
+        return len(self.keys)
+
+    # per patient, the spell current on its as-of date (a constant or a per-patient column), or -1
+    def lookup(self, dates):
+        patients = np.arange(self.size, dtype=np.int64)
+        dates = np.clip(np.broadcast_to(np.asarray(dates, dtype=np.int64), self.size), DATE_MIN, DATE_MAX)
+        position = np.searchsorted(self.keys, keys(patients, dates), side="right") - 1
+        if not len(self.keys):
+            return np.full(self.size, -1, dtype=np.int64)
+        # a position before the patient's first boundary lands on an earlier patient's last
+        # segment, which never has a spell
+        return np.where(position >= 0, self.spells[np.maximum(position, 0)], -1)
+
+
+####################################################################################################
+# registration coverage
+# a sweep over each patient's registration spells (sorted by start) that coalesces them into
+# merged coverage intervals once, so that continuous registration, single-practice registration
+# and deregistration can be asked for any per-patient dates without resolving the spells again
+#
+# with keys as above the sweep is a running maximum of the end keys: a key never exceeds those of
+# later patients, so the running maximum at a spell is the latest end among its own patient's
+# spells so far, and a spell opens a new interval where it starts after that maximum (a spell
+# starting on the day another ends continues it, as ends are exclusive)
+#
+# queries are one pass over the intervals (or spells) with each patient's bounds gathered
+# alongside, which streams through memory where a binary search per patient would not
+
+class Coverage:
+    # spells as groups (patient rows), starts and ends (a spell covers start <= day < end), sorted
+    # by group then start
+    def __init__(self, groups, starts, ends, size):
+        self.size = size
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self.starts = np.asarray(starts)
+        self.ends = np.asarray(ends)
+        start_keys = keys(self.groups, self.starts)
+        reach = np.maximum.accumulate(keys(self.groups, self.ends)) if len(self.groups) else start_keys
+        opens = np.ones(len(self.groups), dtype=bool)
+        opens[1:] = start_keys[1:] > reach[:-1]
+        closes = np.append(opens[1:], True)[: len(self.groups)]
+        # merged intervals [interval_starts, interval_ends), in patient then date order
+        self.interval_groups = self.groups[opens]
+        self.interval_starts = self.starts[opens]
+        self.interval_ends = (reach[closes] & 0xFFFFFFFF) + MISSING_DATE
+        # per patient, the end of its last interval (its latest spell end)
+        last = np.append(self.interval_groups[1:] != self.interval_groups[:-1], True)[: len(self)]
+        self.last_end = np.full(size, MISSING_DATE, dtype=np.int64)
+        self.last_end[self.interval_groups[last]] = self.interval_ends[last]
+
+    def __len__(self):
+        return len(self.interval_groups)
+
+    # registered on every day from lower to upper (inclusive), across any number of practices
+    def continuous(self, lower, upper):
+        return covered(self.size, self.interval_groups, self.interval_starts, self.interval_ends, lower, upper)
+
+    # registered with one practice (a single spell) on every day from lower to upper (inclusive)
+    def single_practice(self, lower, upper):
+        return covered(self.size, self.groups, self.starts, self.ends, lower, upper)
+
+    # per patient, the day it deregistered from every practice (the end of its last coverage
+    # interval), as days, with found False for patients without spells
+    def deregistered(self):
+        return self.last_end, self.last_end != MISSING_DATE
+
+
+# per group, whether one of the intervals [starts, ends) contains all of [lower, upper]
+def covered(size, groups, starts, ends, lower, upper):
+    if np.ndim(lower):
+        lower = np.asarray(lower)[groups]
+    if np.ndim(upper):
+        upper = np.asarray(upper)[groups]
+    hit = (starts <= lower) & (ends > upper) & (np.asarray(lower) <= upper)
+    result = np.zeros(size, dtype=bool)
+    result[groups[hit]] = True
+    return result
+
+
+# keys of each patient's [lower, upper] day bounds
+def probes(size, lower, upper):
+    patients = np.arange(size, dtype=np.int64)
+    lower = np.clip(np.broadcast_to(np.asarray(lower, dtype=np.int64), size), DATE_MIN, DATE_MAX)
+    upper = np.clip(np.broadcast_to(np.asarray(upper, dtype=np.int64), size), DATE_MIN, DATE_MAX)
+    return keys(patients, lower), keys(patients, upper)
+
+
+def keys(groups, dates):
+    return (np.asarray(groups, dtype=np.int64) << 32) | (np.asarray(dates, dtype=np.int64) - MISSING_DATE)
@@ -0,0 +1,848 @@
+import re
+import threading
+
+import numpy as np
+
+import scheduler
+from event_store import MISSING_DATE, OPEN_END_DATE, from_days, scan_codes, to_days
+from interval_join import AsOfIndex, Coverage, SortedEvents
+from planner import Planner
+from ragged import Ragged
+from rules import Column, column_to_arrow, compile_categorised_as, compile_expression, is_iso_date, parse, names_in
+
+####################################################################################################
+# local backend
+# evaluates study definition variables (the `(query_type, query_args)` tuples returned by
+# `patients.*`) against a local EventStore instead of the TPP database
+
+# query types whose codelist is matched against an event table
+EVENT_TABLES = {
+    "with_these_clinical_events": "clinical_events",
+    "with_these_medications": "medications",
+}
+
+DATE_EXPRESSION_RE = re.compile(
+    r"^\s*(?P<name>\d{4}-\d{2}-\d{2}|[A-Za-z_][A-Za-z0-9_]*)"
+    r"\s*(?:(?P<operator>[+-])\s*(?P<quantity>\d+)\s*(?P<units>days?|months?|years?))?\s*$"
+)
+
+NEVER = np.iinfo(np.int32).max
+
+# the rule type (see rules.TYPES) of the values this backend returns for each variable, so that
+# satisfying / categorised_as formulas can be type-checked before anything is evaluated
+RETURNING_VALUE_TYPES = {
+    "binary_flag": "bool",
+    "date": "date",
+    "date_of_death": "date",
+    "number_of_matches_in_period": "int",
+    "numeric_value": "float",
+    "category": "str",
+    "code": "str",
+    "nuts1_region_name": "str",
+    "stp_code": "str",
+    "msoa": "str",
+    "pseudo_id": "int",
+    "index_of_multiple_deprivation": "int",
+    "rural_urban_classification": "int",
+}
+
+QUERY_VALUE_TYPES = {
+    "all": "bool",
+    "sex": "str",
+    "age_as_of": "int",
+    "registered_as_of": "bool",
+    "registered_with_one_practice_between": "bool",
+    "date_deregistered_from_all_supported_practices": "date",
+    "value_from": "date",
+}
+
+
+# rule type of a variable's values, None where it can't be known from the definition
+def declared_type(query_type, query_args):
+    if query_type in QUERY_VALUE_TYPES:
+        return QUERY_VALUE_TYPES[query_type]
+    if query_type == "categorised_as":
+        labels = list(query_args["category_definitions"])
+        if set(labels) <= {0, 1}:
+            return "bool"
+        if all(isinstance(label, str) and is_iso_date(label) for label in labels):
+            return "date"
+        if all(isinstance(label, int) for label in labels):
+            return "int"
+        return "str"
+    if query_type == "fixed_value":
+        return None
+    return RETURNING_VALUE_TYPES.get(query_args.get("returning", "binary_flag"))
+
+
+# pull variables nested inside `satisfying` / `categorised_as` up to the top level, marking
+# them hidden (as cohortextractor's flatten_nested_covariates does)
+def flatten_variables(variables):
+    flattened = {}
+    hidden = set()
+    items = list(variables.items())
+    while items:
+        name, (query_type, query_args) = items.pop(0)
+        if query_args.get("extra_columns"):
+            query_args = dict(query_args)
+            extra_columns = query_args.pop("extra_columns")
+            items.insert(0, (name, (query_type, query_args)))
+            hidden.update(extra_columns)
+            items[:0] = extra_columns.items()
+        else:
+            if name in flattened:
+                raise ValueError(f"Duplicate columns named '{name}'")
+            flattened[name] = (query_type, query_args)
+    for name, (query_type, query_args) in flattened.items():
+        flattened[name] = (query_type, dict(query_args, hidden=query_args.get("hidden") or name in hidden))
+    return flattened
+
+
+# groups of coded event variables that select events the same way (codelist, first or last,
+# ignore_missing_values) and so can be evaluated together whatever they return and whatever
+# their period; a variable whose period depends (even indirectly) on another member of its group
+# is left to be evaluated on its own
+def fusable_groups(definitions, dependencies):
+    groups = {}
+    for name, (query_type, query_args) in definitions.items():
+        if query_type not in EVENT_TABLES:
+            continue
+        key = (
+            query_type,
+            id(query_args["codelist"]),
+            bool(query_args.get("find_first_match_in_period")),
+            bool(query_args.get("ignore_missing_values")),
+        )
+        groups.setdefault(key, []).append(name)
+    def upstream(name, seen):
+        for dependency in dependencies(name):
+            if dependency not in seen:
+                seen.add(dependency)
+                upstream(dependency, seen)
+        return seen
+
+    fused = []
+    for names in groups.values():
+        names = [name for name in names if not upstream(name, set()) & set(names)]
+        if len(names) > 1:
+            fused.append(names)
+    return fused
+
+
+CHAIN_RE = re.compile(r"^\s*(?P<name>[A-Za-z_][A-Za-z0-9_]*)\s*\+\s*(?P<days>\d+)\s*days?\s*$")
+
+
+# list column name for a chain, e.g. covid_vax_1_date -> covid_vax_dates
+def ragged_name(name):
+    return re.sub(r"_1_date$", "", name) + "_dates"
+
+
+# (previous variable, minimum gap in days) of a chained vaccination period, e.g.
+# "covid_vax_1_date + 1 days"; (None, None) for anything else
+def chain_gap(expression):
+    match = CHAIN_RE.match(expression or "")
+    if not match:
+        return None, None
+    return match.group("name"), int(match.group("days"))
+
+
+# chains of first-match vaccination queries, each on or after the previous one's date plus a
+# gap, with the same target disease and product name, in dose order
+def vaccination_chains(definitions):
+    def chainable(query_type, query_args):
+        return (
+            query_type == "with_tpp_vaccination_record"
+            and query_args.get("find_first_match_in_period")
+            and period(query_args)[0]
+            and period(query_args)[1] is None
+            and query_args.get("returning", "binary_flag") in ("date", "binary_flag")
+        )
+
+    def matches(query_args):
+        return (
+            to_list(query_args.get("target_disease_matches")),
+            to_list(query_args.get("product_name_matches")),
+        )
+
+    following = {}
+    for name, (query_type, query_args) in definitions.items():
+        previous, _ = chain_gap(period(query_args)[0])
+        if not chainable(query_type, query_args) or previous not in definitions:
+            continue
+        if not chainable(*definitions[previous]) or matches(definitions[previous][1]) != matches(query_args):
+            continue
+        # a dose's date only feeds the next dose when it is a date
+        if definitions[previous][1].get("returning") != "date" or previous in following:
+            continue
+        following[previous] = name
+    chains = []
+    for name in set(following) - set(following.values()):
+        names = [name]
+        while names[-1] in following:
+            names.append(following[names[-1]])
+        chains.append(names)
+    return chains
+
+
+# the variables of a study definition module (e.g. "study_definition")
+def study_variables(module_name="study_definition"):
+    import importlib
+
+    study = importlib.import_module(module_name).study
+    return study.covariate_definitions
+
+
+# (start, end) date expressions of a query's period, None meaning unbounded
+def period(query_args):
+    between = query_args.get("between")
+    if between:
+        return tuple(between)
+    return (query_args.get("on_or_after"), query_args.get("on_or_before"))
+
+
+class LocalBackend:
+    def __init__(self, store, variables, index_date=None, threads=1):
+        self.store = store
+        self.definitions = flatten_variables(variables)
+        self.index_date = index_date
+        # threads evaluate() and to_arrow() run independent variables on (see scheduler.py)
+        self.threads = threads
+        self.size = store.size
+        self.results = {}
+        # the date of the event each event-based variable selected, for `date_of`
+        self.match_dates = {}
+        # the event row each coded event variable selected (-1 for none), for `event_record`
+        self.selected = {}
+        self.scans = {}
+        # spell table name -> AsOfIndex, shared by every as-of variable on the table
+        self.as_of_indexes = {}
+        # merged registration spells, shared by every registration variable
+        self.registrations = None
+        self.lock = threading.Lock()
+        self.planner = Planner(self)
+        # variable name -> the names of all variables evaluated together with it
+        self.fused = {}
+        for names in fusable_groups(self.definitions, self.dependencies):
+            for name in names:
+                self.fused[name] = names
+        # variable name -> the chain of vaccination dates it belongs to
+        self.chains = {}
+        for names in vaccination_chains(self.definitions):
+            for name in names:
+                self.chains[name] = names
+        self.check_formulas()
+
+    # type-check every satisfying / categorised_as formula against the variables it uses;
+    # raises rules.RuleTypeError (or KeyError for an undefined variable)
+    def check_formulas(self):
+        types = {name: declared_type(*definition) for name, definition in self.definitions.items()}
+        for name, (query_type, query_args) in self.definitions.items():
+            if query_type != "categorised_as":
+                continue
+            for definition in query_args["category_definitions"].values():
+                if definition.strip() == "DEFAULT":
+                    continue
+                compiled = compile_expression(definition)
+                undefined = [dependency for dependency in compiled.names if dependency not in types]
+                if undefined:
+                    raise KeyError(f"{name} refers to undefined variables {undefined}")
+                # variables of unknown type are checked when evaluated
+                if all(types[dependency] for dependency in compiled.names):
+                    compiled.check({dependency: types[dependency] for dependency in compiled.names})
+
+    # names of the output columns (excluding hidden variables and the population)
+    def output_names(self):
+        return [
+            name
+            for name, (_, query_args) in self.definitions.items()
+            if not query_args.get("hidden") and name != "population"
+        ]
+
+    # names this variable needs evaluated first
+    def dependencies(self, name):
+        query_type, query_args = self.definitions[name]
+        names = set()
+        if query_type == "categorised_as":
+            for definition in query_args["category_definitions"].values():
+                names |= names_in(parse(definition))
+        if query_type == "value_from":
+            names.add(query_args["source"])
+        for expression in period(query_args) + (
+            query_args.get("reference_date"),
+            query_args.get("date"),
+            query_args.get("start_date"),
+            query_args.get("end_date"),
+        ):
+            match = DATE_EXPRESSION_RE.match(expression) if isinstance(expression, str) else None
+            if match and match.group("name") in self.definitions:
+                names.add(match.group("name"))
+        return names
+
+    def column(self, name):
+        if name not in self.results:
+            query_type, query_args = self.definitions[name]
+            try:
+                method = getattr(self, f"patients_{query_type}")
+            except AttributeError:
+                raise NotImplementedError(f"The local backend does not support {query_type}")
+            self.results[name] = method(name, **query_args)
+        return self.results[name]
+
+    def evaluate(self, names=None):
+        names = self.output_names() if names is None else names
+        scheduler.run(self, self.threads, names)
+        return {name: self.column(name) for name in names}
+
+    # rows of the population, in patient_id order
+    def population(self):
+        if "population" not in self.definitions:
+            return np.arange(self.size)
+        values, missing = self.column("population")
+        return np.flatnonzero(values.astype(bool) & ~missing)
+
+    # the extract as an arrow table: patient_id then each output column, population rows only;
+    # with ragged=True each vaccination chain ({name}_1_date ... {name}_n_date) is written as one
+    # list column {name}_dates holding every date in the chain, uncapped
+    def to_arrow(self, names=None, ragged=False):
+        import pyarrow as pa
+
+        names = self.output_names() if names is None else names
+        scheduler.run(self, self.threads, names + (["population"] if "population" in self.definitions else []))
+        rows = self.population()
+        arrays = {"patient_id": pa.array(self.store.patient_ids[rows])}
+        for name in names:
+            if ragged and name in self.chains:
+                if name == self.chains[name][0]:
+                    arrays[ragged_name(name)] = self.ragged_chain(self.chains[name]).take(rows).to_arrow()
+                continue
+            values, missing = self.column(name)
+            arrays[name] = column_to_arrow(Column(values[rows], missing[rows]))
+        return pa.table(arrays)
+
+    # every matching event date of a coded event or vaccination variable in its period
+    def ragged_events(self, name):
+        query_type, query_args = self.definitions[name]
+        if query_type in EVENT_TABLES:
+            table_name = EVENT_TABLES[query_type]
+            rows = self.codelist_rows(table_name, query_args["codelist"], query_args.get("ignore_missing_values"))
+        elif query_type == "with_tpp_vaccination_record":
+            table_name = "vaccinations"
+            rows = self.vaccination_rows(query_args.get("target_disease_matches"), query_args.get("product_name_matches"))
+        else:
+            raise ValueError(f"{name} is not an event variable")
+        table = self.store[table_name]
+        patient_rows = self.store.patient_rows(table_name)
+        rows = self.in_period(rows, patient_rows, table["date"], query_args)
+        return Ragged.from_groups(patient_rows[rows], table["date"][rows], self.size)
+
+    # every date of a vaccination chain, not capped at the chain's length
+    def ragged_chain(self, names):
+        table = self.store["vaccinations"]
+        query_args = self.definitions[names[0]][1]
+        rows = self.vaccination_rows(query_args.get("target_disease_matches"), query_args.get("product_name_matches"))
+        start, missing = self.date_expression(period(query_args)[0])
+        start = np.where(missing, NEVER, start)
+        gaps = [chain_gap(period(self.definitions[name][1])[0])[1] for name in names[1:]]
+        patients = self.store.patient_rows("vaccinations")[rows]
+        return chain_events(patients, table["date"][rows], self.size, start, gaps)
+
+    ################################################################################################
+    # dates
+
+    # evaluate a date expression to (days, missing): scalars for fixed dates,
+    # per-patient arrays for expressions on other columns
+    def date_expression(self, expression):
+        match = DATE_EXPRESSION_RE.match(expression)
+        if not match:
+            raise ValueError(f"Cannot parse date expression: {expression}")
+        name = match.group("name")
+        if name == "index_date":
+            name = self.index_date
+        if name in self.definitions:
+            values, missing = self.column(name)
+            days = to_days(values).astype(np.int64)
+            missing = missing | (days == MISSING_DATE)
+        else:
+            days, missing = int(np.datetime64(name, "D").astype(np.int64)), False
+        if match.group("operator"):
+            quantity = int(match.group("quantity")) * (1 if match.group("operator") == "+" else -1)
+            days = shift_days(days, quantity, match.group("units"))
+        return days, missing
+
+    # inclusive per-patient [lower, upper] day bounds of a period; patients whose bound is a
+    # NULL column value get an empty period; as in the TPP backend's SQL, events with a NULL date
+    # fail any bound (date <= upper is not true of NULL) but an unbounded period matches them
+    def period_bounds(self, query_args):
+        start, end = period(query_args)
+        lower, upper = np.iinfo(np.int32).min, NEVER
+        empty = False
+        if start is not None:
+            lower, missing = self.date_expression(start)
+            empty = empty | missing
+        elif end is not None:
+            lower = MISSING_DATE + 1
+        if end is not None:
+            upper, missing = self.date_expression(end)
+            empty = empty | missing
+        if np.any(empty):
+            lower = np.where(empty, NEVER, lower)
+            upper = np.where(empty, np.iinfo(np.int32).min, upper)
+        return lower, upper
+
+    ################################################################################################
+    # coded events
+
+    # the event table a coded event variable queries, None for other variables
+    def event_table(self, name):
+        return EVENT_TABLES.get(self.definitions[name][0])
+
+    # scan a table once for the codelists of every variable that queries it
+    def scan(self, table_name):
+        # variables may be evaluated from several threads (see scheduler.py); the scan is the
+        # expensive shared step, so it is built under a lock
+        with self.lock:
+            if table_name not in self.scans:
+                codelists = {}
+                for query_type, query_args in self.definitions.values():
+                    if EVENT_TABLES.get(query_type) == table_name:
+                        codelists[id(query_args["codelist"])] = query_args["codelist"]
+                self.scans[table_name] = scan_codes(self.store[table_name], list(codelists.values()))
+        return self.scans[table_name]
+
+    def patients_with_these_clinical_events(self, name, **query_args):
+        return self.coded_events(name, "clinical_events", **query_args)
+
+    def patients_with_these_medications(self, name, **query_args):
+        return self.coded_events(name, "medications", **query_args)
+
+    def coded_events(
+        self,
+        name,
+        table_name,
+        codelist,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        ignore_missing_values=False,
+        date_format=None,
+        **query_args,
+    ):
+        if name in self.fused:
+            self.fused_coded_events(self.fused[name])
+            return self.results[name]
+        table = self.store[table_name]
+        rows = self.codelist_rows(table_name, codelist, ignore_missing_values)
+        events = SortedEvents.from_rows(rows, self.store.patient_rows(table_name), table["date"], self.size)
+        lower, upper = self.period_bounds(query_args)
+        if returning == "number_of_matches_in_period":
+            return Column(events.count(lower, upper), np.zeros(self.size, dtype=bool))
+        position = events.select(lower, upper, first=bool(find_first_match_in_period))
+        selected = gather(rows, position, -1)
+        return self.event_values(name, table, codelist, returning, selected, date_format)
+
+    # event rows matching a codelist, from the table's shared scan
+    def codelist_rows(self, table_name, codelist, ignore_missing_values=False):
+        table = self.store[table_name]
+        scan = self.scan(table_name)
+        rows = scan.rows_for(scan.slots[id(codelist)])
+        if ignore_missing_values:
+            rows = rows[table["numeric_value"][rows] != 0]
+        return rows
+
+    # events a coded event variable reads: its codelist's events within its period
+    def events_read(self, name):
+        table_name = self.event_table(name)
+        if table_name is None:
+            return None
+        query_args = self.definitions[name][1]
+        rows = self.codelist_rows(table_name, query_args["codelist"], query_args.get("ignore_missing_values"))
+        events = SortedEvents.from_rows(rows, self.store.patient_rows(table_name), self.store[table_name]["date"], self.size)
+        return int(events.count(*self.period_bounds(query_args)).sum())
+
+    # the `returning` value of each patient's selected event row (-1 for none)
+    def event_values(self, name, table, codelist, returning, selected, date_format=None):
+        self.selected[name] = selected
+        found = selected >= 0
+        match_dates = gather(table["date"], selected, MISSING_DATE)
+        self.match_dates[name] = match_dates
+
+        if returning == "binary_flag":
+            return Column(found, np.zeros(self.size, dtype=bool))
+        if returning == "date":
+            return date_column(match_dates, date_format)
+        if returning == "numeric_value":
+            return Column(gather(table["numeric_value"], selected, 0.0), ~found)
+        if returning == "code":
+            return Column(gather(table["code"], selected, table["code"].dtype.type()), ~found)
+        if returning == "category":
+            if not getattr(codelist, "has_categories", False):
+                raise ValueError(
+                    "Cannot return categories because the supplied codelist does not have any categories defined"
+                )
+            categories = category_lookup(codelist, table["code"].dtype)
+            values = categories(gather(table["code"], selected, table["code"].dtype.type()))
+            return Column(np.where(found, values, ""), ~found)
+        raise ValueError(f"Unsupported `returning` value: {returning}")
+
+    # evaluate variables that select events from the same codelist the same way together:
+    # the codelist's rows are taken and keyed once, identical periods are merged (so bmi_date and
+    # bmi_value_temp share one selection), and each distinct period (astrxm1/2/3) is one
+    # interval join from which flags/counts/first/last are all read off
+    def fused_coded_events(self, names):
+        query_type, query_args = self.definitions[names[0]]
+        table_name = EVENT_TABLES[query_type]
+        table = self.store[table_name]
+        rows = self.codelist_rows(table_name, query_args["codelist"], query_args.get("ignore_missing_values"))
+        events = SortedEvents.from_rows(rows, self.store.patient_rows(table_name), table["date"], self.size)
+        first = bool(query_args.get("find_first_match_in_period"))
+
+        windows = {}
+        for name in names:
+            member_args = self.definitions[name][1]
+            expressions = period(member_args)
+            if expressions not in windows:
+                windows[expressions] = events.window(*self.period_bounds(dict(between=expressions)))
+            start, stop = windows[expressions]
+            returning = member_args.get("returning", "binary_flag")
+            if returning == "number_of_matches_in_period":
+                self.results[name] = Column(stop - start, np.zeros(self.size, dtype=bool))
+                continue
+            if first:
+                position = np.where(stop > start, start, -1)
+            else:
+                position = events.last_in(start, stop)
+            self.results[name] = self.event_values(
+                name, table, query_args["codelist"], returning, gather(rows, position, -1), member_args.get("date_format")
+            )
+
+    # date, numeric value, code and (for categorised codelists) category of the event a
+    # coded event variable selected, all read from the one lookup
+    def event_record(self, name):
+        query_type, query_args = self.definitions[name]
+        self.column(name)
+        if name not in self.selected:
+            raise ValueError(f"{name} does not select a single event")
+        table = self.store[EVENT_TABLES[query_type]]
+        codelist = query_args["codelist"]
+        returnings = ["date", "code"] + ["numeric_value"] * ("numeric_value" in table)
+        returnings += ["category"] * bool(getattr(codelist, "has_categories", False))
+        return {
+            returning: self.event_values(name, table, codelist, returning, self.selected[name])
+            for returning in returnings
+        }
+
+    # rows (sorted) whose date falls in the query's period for their patient
+    def in_period(self, rows, patient_rows, dates, query_args):
+        lower, upper = self.period_bounds(query_args)
+        event_dates = dates[rows]
+        if np.ndim(lower):
+            lower = lower[patient_rows[rows]]
+        if np.ndim(upper):
+            upper = upper[patient_rows[rows]]
+        return rows[(event_dates >= lower) & (event_dates <= upper)]
+
+    ################################################################################################
+    # vaccinations
+
+    def patients_with_tpp_vaccination_record(
+        self,
+        name,
+        target_disease_matches=None,
+        product_name_matches=None,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        date_format=None,
+        **query_args,
+    ):
+        if name in self.chains:
+            self.vaccination_chain(self.chains[name])
+            return self.results[name]
+        table = self.store["vaccinations"]
+        rows = self.vaccination_rows(target_disease_matches, product_name_matches)
+        events = SortedEvents.from_rows(rows, self.store.patient_rows("vaccinations"), table["date"], self.size)
+        position = events.select(*self.period_bounds(query_args), first=bool(find_first_match_in_period))
+        selected = gather(rows, position, -1)
+        found = selected >= 0
+        match_dates = gather(table["date"], selected, MISSING_DATE)
+        self.match_dates[name] = match_dates
+        if returning == "binary_flag":
+            return Column(found, np.zeros(self.size, dtype=bool))
+        if returning == "date":
+            return date_column(match_dates, date_format)
+        raise ValueError(f"Unsupported `returning` value: {returning}")
+
+    def vaccination_rows(self, target_disease_matches=None, product_name_matches=None):
+        table = self.store["vaccinations"]
+        keep = np.ones(len(table), dtype=bool)
+        if target_disease_matches:
+            keep &= np.isin(table["target_disease"], to_list(target_disease_matches))
+        if product_name_matches:
+            keep &= np.isin(table["product_name"], to_list(product_name_matches))
+        return np.flatnonzero(keep)
+
+    # evaluate a chain of vaccination dates (as built by functions.vaccination_date_X) in one
+    # pass over the matching records rather than one dependent query per dose
+    def vaccination_chain(self, names):
+        table = self.store["vaccinations"]
+        query_args = self.definitions[names[0]][1]
+        rows = self.vaccination_rows(query_args.get("target_disease_matches"), query_args.get("product_name_matches"))
+        patient_rows = self.store.patient_rows("vaccinations")
+        start, missing = self.date_expression(period(query_args)[0])
+        start = np.where(missing, NEVER, start)
+        gaps = [chain_gap(period(self.definitions[name][1])[0])[1] for name in names[1:]]
+        event_dates = nth_event_dates(patient_rows[rows], table["date"][rows], self.size, start, gaps)
+        for name, dates in zip(names, event_dates):
+            member_args = self.definitions[name][1]
+            self.match_dates[name] = dates
+            if member_args.get("returning", "binary_flag") == "date":
+                self.results[name] = date_column(dates, member_args.get("date_format"))
+            else:
+                self.results[name] = Column(dates != MISSING_DATE, np.zeros(self.size, dtype=bool))
+
+    ################################################################################################
+    # patient demographics
+
+    def patients_all(self, name, **query_args):
+        return Column(np.ones(self.size, dtype=bool), np.zeros(self.size, dtype=bool))
+
+    def patients_sex(self, name, **query_args):
+        sex = np.asarray(self.store["patients"]["sex"], dtype=str)
+        return Column(sex, sex == "")
+
+    def patients_age_as_of(self, name, reference_date, **query_args):
+        reference, reference_missing = self.date_expression(reference_date)
+        date_of_birth = self.store["patients"]["date_of_birth"]
+        ages = age_in_years(date_of_birth, reference)
+        return Column(ages, (date_of_birth == MISSING_DATE) | reference_missing)
+
+    def patients_died_from_any_cause(self, name, returning="binary_flag", date_format=None, **query_args):
+        died = self.store["patients"]["date_of_death"].astype(np.int64)
+        lower, upper = self.period_bounds(query_args)
+        found = (died != MISSING_DATE) & (died >= lower) & (died <= upper)
+        self.match_dates[name] = np.where(found, died, MISSING_DATE)
+        if returning == "binary_flag":
+            return Column(found, np.zeros(self.size, dtype=bool))
+        if returning == "date_of_death":
+            return date_column(self.match_dates[name], date_format)
+        raise ValueError(f"Unsupported `returning` value: {returning}")
+
+    ################################################################################################
+    # registrations and addresses
+
+    def patients_registered_as_of(self, name, reference_date, **query_args):
+        date, missing = self.date_expression(reference_date)
+        date = np.where(missing, np.iinfo(np.int32).min, date)
+        return Column(self.coverage().continuous(date, date), np.zeros(self.size, dtype=bool))
+
+    def patients_registered_with_one_practice_between(self, name, start_date, end_date, **query_args):
+        start, start_missing = self.date_expression(start_date)
+        end, end_missing = self.date_expression(end_date)
+        start = np.where(start_missing, np.iinfo(np.int32).min, start)
+        end = np.where(end_missing, NEVER, end)
+        return Column(self.coverage().single_practice(start, end), np.zeros(self.size, dtype=bool))
+
+    # the day the patient left their last practice (the end of their last registration, as in the
+    # TPP backend, so a patient who has since re-registered has not deregistered)
+    def patients_date_deregistered_from_all_supported_practices(self, name, date_format=None, **query_args):
+        last_end, found = self.coverage().deregistered()
+        start, end = period(query_args)
+        bounds = dict(between=(start or "1900-01-01", end or "3000-01-01"))
+        lower, upper = self.period_bounds(bounds)
+        found &= (last_end >= lower) & (last_end <= upper)
+        return date_column(np.where(found, last_end, MISSING_DATE), date_format)
+
+    def coverage(self):
+        with self.lock:
+            if self.registrations is None:
+                table = self.store["registrations"]
+                self.registrations = Coverage(
+                    self.store.patient_rows("registrations"), table["start_date"], table["end_date"], self.size
+                )
+        return self.registrations
+
+    def patients_registered_practice_as_of(self, name, date, returning=None, **query_args):
+        return self.spell_as_of("registrations", date, returning)
+
+    def patients_address_as_of(self, name, date, returning=None, round_to_nearest=None, **query_args):
+        values, missing = self.spell_as_of("addresses", date, returning)
+        if round_to_nearest:
+            # halves round up, as SQL ROUND does (np.round rounds them to even); -1 is "no postcode"
+            rounded = np.floor(values / round_to_nearest + 0.5) * round_to_nearest
+            values = np.where(values >= 0, rounded, values).astype(np.int64)
+        return Column(values, missing)
+
+    # the value of `returning` from the spell current on a per-patient date; overlapping spells
+    # are resolved as in the TPP backend: latest start, then latest end, then (for addresses)
+    # "NPC" postcodes last, then the first recorded
+    def spell_as_of(self, table_name, date, returning):
+        table = self.store[table_name]
+        if returning not in table:
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        as_of, as_of_missing = self.date_expression(date)
+        as_of = np.where(as_of_missing, np.iinfo(np.int32).min, as_of)
+        chosen = self.as_of_index(table_name).lookup(as_of)
+        values = gather(table[returning], chosen, table[returning].dtype.type())
+        return Column(values, chosen < 0)
+
+    def as_of_index(self, table_name):
+        with self.lock:
+            if table_name not in self.as_of_indexes:
+                table = self.store[table_name]
+                # TPP only breaks ties between overlapping spells on postcode for addresses
+                no_postcode = (table["msoa"] == "NPC") if table_name == "addresses" and "msoa" in table else None
+                self.as_of_indexes[table_name] = AsOfIndex(
+                    self.store.patient_rows(table_name), table["start_date"], table["end_date"], self.size, no_postcode
+                )
+        return self.as_of_indexes[table_name]
+
+    ################################################################################################
+    # derived variables
+
+    def patients_categorised_as(self, name, category_definitions, **query_args):
+        columns = {}
+        for definition in category_definitions.values():
+            for dependency in names_in(parse(definition)):
+                columns[dependency] = self.column(dependency)
+        result = compile_categorised_as(category_definitions)(columns, self.size)
+        if set(category_definitions) == {0, 1}:
+            # `satisfying`
+            return Column(result.values == 1, np.zeros(self.size, dtype=bool))
+        return result
+
+    def patients_value_from(self, name, source, returning="date", date_format=None, **query_args):
+        if returning != "date":
+            raise NotImplementedError(f"The local backend does not support value_from returning {returning}")
+        self.column(source)
+        return date_column(self.match_dates[source], date_format)
+
+    def patients_fixed_value(self, name, value, **query_args):
+        return Column(np.full(self.size, value), np.zeros(self.size, dtype=bool))
+
+
+####################################################################################################
+# kernels
+
+# for each patient row in `who`, the position of the first event on or after its bound (days),
+# or -1; events must be in patient then date order with keys from event_keys
+def next_events(keys, patients, who, bound):
+    probe = (who.astype(np.int64) << 32) | (np.clip(bound.astype(np.int64), MISSING_DATE, NEVER) - MISSING_DATE)
+    position = np.searchsorted(keys, probe, side="left")
+    within = position < len(keys)
+    hit = np.zeros(len(who), dtype=bool)
+    hit[within] = patients[position[within]] == who[within]
+    return np.where(hit, position, -1)
+
+
+def event_keys(patients, dates):
+    return (np.asarray(patients, dtype=np.int64) << 32) | (np.asarray(dates, dtype=np.int64) - MISSING_DATE)
+
+
+# per patient, the first event date on or after start, then for each gap the first event date at
+# least that many days after the previous one; events must be in patient then date order
+def nth_event_dates(patients, dates, size, start, gaps):
+    keys = event_keys(patients, dates)
+    everyone = np.arange(size, dtype=np.int64)
+    bound = np.broadcast_to(np.asarray(start, dtype=np.int64), size)
+    event_dates = []
+    for gap in [0] + list(gaps):
+        position = next_events(keys, patients, everyone, bound + gap)
+        bound = gather(dates, position, MISSING_DATE).astype(np.int64)
+        event_dates.append(bound)
+        # nobody goes on to a later dose after a missing one
+        bound = np.where(bound == MISSING_DATE, NEVER, bound)
+    return event_dates
+
+
+# every date of an uncapped chain as a Ragged: the first event on or after start, then the next
+# at least a gap later and so on, the last gap repeating once gaps run out
+def chain_events(patients, dates, size, start, gaps):
+    keys = event_keys(patients, dates)
+    who = np.arange(size, dtype=np.int64)
+    bound = np.broadcast_to(np.asarray(start, dtype=np.int64), size)
+    gaps = [0] + list(gaps or [1])
+    found_patients, found_dates = [], []
+    dose = 0
+    while len(who):
+        position = next_events(keys, patients, who, bound + gaps[min(dose, len(gaps) - 1)])
+        hit = position >= 0
+        who, position = who[hit], position[hit]
+        bound = dates[position].astype(np.int64)
+        found_patients.append(who)
+        found_dates.append(bound)
+        dose += 1
+    found_patients = np.concatenate(found_patients)
+    # doses were found in date order, so a stable sort on patient keeps each history ordered
+    order = np.argsort(found_patients, kind="stable")
+    return Ragged.from_groups(found_patients[order], np.concatenate(found_dates)[order], size)
+
+
+# values at positions, fill where a position is -1 (as every position is when values is empty)
+def gather(values, positions, fill):
+    selected = values[np.maximum(positions, 0)] if len(values) else values.dtype.type()
+    return np.where(positions >= 0, selected, fill)
+
+
+def date_column(days, date_format=None):
+    days = np.asarray(days)
+    missing = days == MISSING_DATE
+    dates = from_days(days)
+    if date_format == "YYYY-MM":
+        dates = dates.astype("datetime64[M]").astype("datetime64[D]")
+    elif date_format == "YYYY":
+        dates = dates.astype("datetime64[Y]").astype("datetime64[D]")
+    return Column(dates, missing)
+
+
+# shift days by a number of days, months or years
+def shift_days(days, quantity, units):
+    if units.startswith("day"):
+        return days + quantity
+    dates = np.asarray(days).astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    day_of_month = dates - months.astype("datetime64[D]")
+    months = months + (quantity if units.startswith("month") else 12 * quantity)
+    shifted = months.astype("datetime64[D]") + day_of_month
+    # clamp to the end of the shorter month, e.g. 31 Jan + 1 month
+    month_end = (months + 1).astype("datetime64[D]") - 1
+    shifted = np.minimum(shifted, month_end).astype(np.int64)
+    return shifted if np.ndim(shifted) else int(shifted)
+
+
+# completed years between date of birth and reference date (both in days); as in the TPP
+# backend someone born on 29 February turns a year older on 28 February in non-leap years
+def age_in_years(date_of_birth, reference):
+    born = np.where(date_of_birth == MISSING_DATE, 0, date_of_birth).astype(np.int64)
+    on = np.broadcast_to(np.asarray(reference, dtype=np.int64), born.shape)
+    years = (
+        from_days(on).astype("datetime64[Y]").astype(np.int64)
+        - from_days(born).astype("datetime64[Y]").astype(np.int64)
+    )
+    return years - (shift_days(born, years, "years") > on)
+
+
+def category_lookup(codelist, dtype):
+    import pandas as pd
+
+    codes = np.array([code for code, _ in codelist], dtype=object)
+    if np.dtype(dtype).kind in "iu":
+        keep = np.array([str(code).isdigit() for code in codes], dtype=bool)
+        codes = codes[keep].astype(np.int64)
+    else:
+        keep = np.ones(len(codes), dtype=bool)
+    categories = np.array([category for _, category in codelist], dtype=str)[keep]
+    index = pd.Index(codes)
+
+    def lookup(values):
+        position = index.get_indexer(values)
+        return gather(categories, position, "")
+
+    return lookup
+
+
+def to_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
@@ -0,0 +1,86 @@
+import numpy as np
+
+from event_store import MISSING_DATE
+
+####################################################################################################
+# ragged per-patient event dates
+# a CSR layout for variable-length histories (e.g. every vaccination date rather than
+# covid_vax_1_date ... covid_vax_n_date): offsets[i]:offsets[i + 1] are patient i's positions in a
+# flat array of int32 epoch days, in date order, so nothing is padded for the long tail
+#
+# written to feather as an arrow large_list<date32> column: its offsets are int64, as here, so a
+# column of more than 2^31 dates is written rather than overflowing
+
+
+class Ragged:
+    def __init__(self, offsets, values):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int32)
+
+    # from values grouped by patient row (groups must be sorted)
+    @classmethod
+    def from_groups(cls, groups, values, size):
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(groups, minlength=size), out=offsets[1:])
+        return cls(offsets, values)
+
+    @classmethod
+    def from_arrow(cls, array):
+        import pyarrow as pa
+
+        if isinstance(array, pa.ChunkedArray):
+            array = pa.concat_arrays(array.chunks)
+        offsets = array.offsets.to_numpy().astype(np.int64)
+        values = array.values.view(pa.int32()).to_numpy(zero_copy_only=False)[offsets[0] : offsets[-1]]
+        return cls(offsets - offsets[0], values)
+
+    def to_arrow(self):
+        import pyarrow as pa
+
+        values = pa.array(self.values, type=pa.int32()).view(pa.date32())
+        return pa.LargeListArray.from_arrays(pa.array(self.offsets, type=pa.int64()), values)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # the histories of the given patient rows
+    def take(self, rows):
+        counts = self.counts()[rows]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(self.offsets[:-1][rows] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return Ragged(offsets, self.values[positions])
+
+    # number of events per patient
+    def counts(self):
+        return np.diff(self.offsets)
+
+    # patient row of every value
+    def rows(self):
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    # the k-th (1-based) date of every patient, MISSING_DATE where there are fewer than k
+    def kth(self, k):
+        counts = self.counts()
+        has = counts >= k
+        position = np.minimum(self.offsets[:-1] + k - 1, max(len(self.values) - 1, 0))
+        values = self.values[position] if len(self.values) else np.zeros(len(self), dtype=np.int32)
+        return np.where(has, values, MISSING_DATE)
+
+    # days between each event and the one before it, per patient
+    def intervals(self):
+        rows = self.rows()
+        same = rows[1:] == rows[:-1]
+        differences = np.diff(self.values.astype(np.int64))[same]
+        return Ragged.from_groups(rows[1:][same], differences, len(self))
+
+    # number of events strictly before each patient's date (days; scalar or per patient)
+    def count_before(self, days):
+        keys = (self.rows().astype(np.int64) << 32) | (self.values.astype(np.int64) - MISSING_DATE)
+        days = np.broadcast_to(np.asarray(days, dtype=np.int64), len(self))
+        probes = (np.arange(len(self), dtype=np.int64) << 32) | (days - MISSING_DATE)
+        return np.searchsorted(keys, probes, side="left") - self.offsets[:-1]
+
+    # the k-th date before each patient's date, MISSING_DATE where fewer than k came before
+    def kth_before(self, k, days):
+        return np.where(self.count_before(days) >= k, self.kth(k), MISSING_DATE)
@@ -0,0 +1,174 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from local_backend import LocalBackend
+from rules import Column
+
+####################################################################################################
+# per-variable result cache
+# each variable's result column is stored under a content hash of
+# - its definition (query type and arguments, with parameters such as ref_ar already resolved)
+# - the sha of every codelist it uses (from codelists/codelists.json)
+# - the event store it was evaluated against
+# - the hashes of the variables it depends on
+# so changing one parameter or one codelist only recomputes the variables downstream of it
+#
+# entries are .npz files; the least recently used are evicted once the cache outgrows max_bytes.
+# storing and evicting hold an exclusive lock on the cache's .lock file, so extractions sharing a
+# cache (threads or processes) don't evict under each other's feet
+#
+# results with object arrays aren't cached: npz would pickle them, and entries are read with
+# allow_pickle=False
+
+CACHE_DIR = "output/cache/variables"
+MAX_BYTES = 2 * 1024**3
+
+
+# a json-able, order-independent form of query arguments
+def canonical(value):
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    if hasattr(value, "system") and isinstance(value, list):
+        return {"codelist": codelist_digest(value), "system": value.system}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+# the codelist's csv sha where it was read from codelists/, otherwise a hash of its codes
+def codelist_digest(codelist):
+    sha = getattr(codelist, "sha", None)
+    if sha:
+        return sha
+    return hashlib.sha1(repr(sorted(map(repr, codelist))).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+    # the arrays stored under key, or None
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with np.load(filename, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # the modification time is the entry's last use; the entry may have been evicted since
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return arrays
+
+    # an exclusive lock on the cache, across threads and processes
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.path, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # store arrays under key; returns False (storing nothing) for arrays npz can't hold unpickled
+    def put(self, key, arrays):
+        if any(np.asarray(array).dtype == object for array in arrays.values()):
+            return False
+        # write atomically so concurrent extractions never read a partial entry; a .tmp file until it
+        # is in place, so eviction never sees it
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False) as f:
+            np.savez(f, **arrays)
+        with self.locked():
+            os.replace(f.name, self.filename(key))
+            self.evict()
+        return True
+
+    # callers hold the lock
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.path):
+            if filename.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.path, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# a local backend that reads unchanged variables from the cache and stores the rest
+class CachedBackend(LocalBackend):
+    def __init__(self, store, variables, index_date=None, threads=1, cache=None):
+        super().__init__(store, variables, index_date, threads)
+        self.cache = cache or ResultCache()
+        self.keys = {}
+        self.hits = set()
+        self.stored = set()
+
+    def key(self, name):
+        if name not in self.keys:
+            query_type, query_args = self.definitions[name]
+            content = {
+                "query_type": query_type,
+                "query_args": canonical({key: value for key, value in query_args.items() if key != "hidden"}),
+                "index_date": self.index_date,
+                "store": self.store.fingerprint(),
+                "dependencies": {dependency: self.key(dependency) for dependency in sorted(self.dependencies(name))},
+            }
+            encoded = json.dumps(content, sort_keys=True).encode()
+            self.keys[name] = hashlib.sha256(encoded).hexdigest()
+        return self.keys[name]
+
+    def column(self, name):
+        if name in self.results:
+            return self.results[name]
+        key = self.key(name)
+        arrays = self.cache.get(key)
+        if arrays is not None:
+            self.hits.add(name)
+            if "match_dates" in arrays:
+                self.match_dates[name] = arrays["match_dates"]
+            if "selected" in arrays:
+                self.selected[name] = arrays["selected"]
+            self.results[name] = Column(arrays["values"], arrays["missing"])
+            return self.results[name]
+        result = super().column(name)
+        # fused groups and vaccination chains fill in several results at once; only this
+        # variable's own are stored, as other threads may be filling in theirs (see scheduler.py)
+        for computed in self.fused.get(name) or self.chains.get(name) or [name]:
+            if computed in self.results and computed not in self.hits and computed not in self.stored:
+                self.store_result(computed)
+        return result
+
+    def store_result(self, name):
+        self.stored.add(name)
+        values, missing = self.results[name]
+        arrays = {"values": values, "missing": missing}
+        if name in self.match_dates:
+            arrays["match_dates"] = self.match_dates[name]
+        if name in self.selected:
+            arrays["selected"] = self.selected[name]
+        self.cache.put(self.key(name), arrays)
@@ -0,0 +1,934 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+####################################################################################################
+# local evaluator for the rule language used in analysis/lib/*.csv
+# (the same limited SQL dialect that cohortextractor accepts in `categorised_as` and `satisfying`)
+
+# a nullable column: `values` holds the data, `missing` flags SQL NULLs
+Column = namedtuple("Column", ["values", "missing"])
+
+# AST nodes
+Name = namedtuple("Name", ["name"])
+Literal = namedtuple("Literal", ["value"])
+Default = namedtuple("Default", [])
+Not = namedtuple("Not", ["operand"])
+BoolOp = namedtuple("BoolOp", ["op", "operands"])
+Compare = namedtuple("Compare", ["op", "left", "right"])
+BinOp = namedtuple("BinOp", ["op", "left", "right"])
+
+
+class RuleSyntaxError(ValueError):
+    pass
+
+
+TOKEN_RE = re.compile(
+    r"""
+    \s*(?:
+      (?P<number>\d+(?:\.\d*)?)
+    | '(?P<string>[^']*)'
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>>=|<=|!=|<>|==|=|<|>|\+|-|\*|/|\(|\))
+    )""",
+    re.VERBOSE,
+)
+
+KEYWORDS = {"AND", "OR", "NOT", "DEFAULT"}
+
+COMPARISONS = {
+    "=": np.equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<>": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+ARITHMETIC = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+}
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise RuleSyntaxError(
+                f"Unexpected character at {position} in: {expression}"
+            )
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value in KEYWORDS:
+            kind = "keyword"
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        tokens.append((kind, value))
+    return tokens
+
+
+# recursive descent parser, precedence from loosest to tightest:
+# OR, AND, NOT, comparison, + -, * /
+class Parser:
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, kind, value):
+        if self.take() != (kind, value):
+            raise RuleSyntaxError(f"Expected '{value}' in: {self.expression}")
+
+    def parse(self):
+        if self.tokens == [("keyword", "DEFAULT")]:
+            return Default()
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise RuleSyntaxError(
+                f"Unexpected token '{self.peek()[1]}' in: {self.expression}"
+            )
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else BoolOp("OR", tuple(operands))
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else BoolOp("AND", tuple(operands))
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return Not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_sum()
+        kind, value = self.peek()
+        if kind == "op" and value in COMPARISONS:
+            self.take()
+            return Compare(value, left, self.parse_sum())
+        return left
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while self.peek()[0] == "op" and self.peek()[1] in ("+", "-"):
+            node = BinOp(self.take()[1], node, self.parse_product())
+        return node
+
+    def parse_product(self):
+        node = self.parse_atom()
+        while self.peek()[0] == "op" and self.peek()[1] in ("*", "/"):
+            node = BinOp(self.take()[1], node, self.parse_atom())
+        return node
+
+    def parse_atom(self):
+        kind, value = self.take()
+        if kind == "number" or kind == "string":
+            return Literal(value)
+        if kind == "name":
+            return Name(value)
+        if (kind, value) == ("op", "("):
+            node = self.parse_or()
+            self.expect("op", ")")
+            return node
+        if (kind, value) == ("op", "-"):
+            return BinOp("-", Literal(0), self.parse_atom())
+        raise RuleSyntaxError(f"Unexpected token '{value}' in: {self.expression}")
+
+
+# parse a rule string once, repeated rules share the same AST
+@lru_cache(maxsize=None)
+def parse(expression):
+    return Parser(expression).parse()
+
+
+# names of the columns a rule refers to
+def names_in(node):
+    if isinstance(node, Name):
+        return {node.name}
+    if isinstance(node, (Not,)):
+        return names_in(node.operand)
+    if isinstance(node, BoolOp):
+        return set().union(*(names_in(operand) for operand in node.operands))
+    if isinstance(node, (Compare, BinOp)):
+        return names_in(node.left) | names_in(node.right)
+    return set()
+
+
+####################################################################################################
+# column kernels
+
+# wrap a plain array as a nullable column, treating NaN / NaT / None as NULL
+def as_column(values):
+    if isinstance(values, Column):
+        return values
+    values = np.asarray(values)
+    if values.dtype.kind in "fmM":
+        missing = np.isnan(values)
+    elif values.dtype.kind == "O":
+        missing = np.fromiter((value is None for value in values), bool, len(values))
+    else:
+        missing = np.zeros(len(values), dtype=bool)
+    return Column(values, missing)
+
+
+# the "empty" value of each column type, as used by cohortextractor for implicit comparisons
+def is_empty(values):
+    kind = values.dtype.kind
+    if kind in "mM":
+        return np.isnat(values)
+    if kind in "US":
+        return values == values.dtype.type()
+    if kind == "O":
+        return np.fromiter((not value for value in values), bool, len(values))
+    return values == 0
+
+
+# coerce a scalar literal to the type of the column it is compared against
+def coerce(scalar, values):
+    kind = values.dtype.kind
+    if kind == "M" and isinstance(scalar, str):
+        return np.datetime64(scalar, "D")
+    if kind in "iuf" and isinstance(scalar, str):
+        return float(scalar)
+    if kind in "US" and not isinstance(scalar, str):
+        return str(scalar)
+    return scalar
+
+
+# evaluate a value expression to a Column (or a scalar for constant subexpressions)
+def evaluate_value(node, columns):
+    if isinstance(node, Literal):
+        return node.value
+    if isinstance(node, Name):
+        try:
+            return as_column(columns[node.name])
+        except KeyError:
+            raise KeyError(f"Unknown column: {node.name}")
+    if isinstance(node, BinOp):
+        left = evaluate_value(node.left, columns)
+        right = evaluate_value(node.right, columns)
+        function = ARITHMETIC[node.op]
+        if not isinstance(left, Column) and not isinstance(right, Column):
+            return function(left, right).item()
+        return Column(function(_values(left), _values(right)), _missing(left, right))
+    return evaluate_condition(node, columns)
+
+
+# evaluate a boolean expression to a Column of bools with three-valued logic
+def evaluate_condition(node, columns):
+    if isinstance(node, Default):
+        raise RuleSyntaxError("DEFAULT can only be used as a whole rule")
+    if isinstance(node, (Name, Literal, BinOp)):
+        # a bare reference is an implicit "IS NOT NULL AND != empty" test, so is never NULL
+        value = evaluate_value(node, columns)
+        if not isinstance(value, Column):
+            return bool(value)
+        return Column(~(value.missing | is_empty(value.values)), np.zeros_like(value.missing))
+    if isinstance(node, Compare):
+        left = evaluate_value(node.left, columns)
+        right = evaluate_value(node.right, columns)
+        if isinstance(left, Column) and not isinstance(right, Column):
+            right = coerce(right, left.values)
+        elif isinstance(right, Column) and not isinstance(left, Column):
+            left = coerce(left, right.values)
+        result = COMPARISONS[node.op](_values(left), _values(right))
+        if not isinstance(left, Column) and not isinstance(right, Column):
+            return bool(result)
+        missing = _missing(left, right)
+        return Column(result & ~missing, missing)
+    if isinstance(node, Not):
+        operand = evaluate_condition(node.operand, columns)
+        if not isinstance(operand, Column):
+            return not operand
+        return Column(~operand.values & ~operand.missing, operand.missing)
+    if isinstance(node, BoolOp):
+        operands = [evaluate_condition(operand, columns) for operand in node.operands]
+        return _kleene(node.op, operands)
+    raise RuleSyntaxError(f"Cannot evaluate {node}")
+
+
+def _values(value):
+    return value.values if isinstance(value, Column) else value
+
+
+def _missing(*values):
+    masks = [value.missing for value in values if isinstance(value, Column)]
+    return np.logical_or.reduce(masks) if len(masks) > 1 else masks[0].copy()
+
+
+# SQL AND / OR: a definite FALSE (AND) or TRUE (OR) wins over NULL
+def _kleene(op, operands):
+    constants = [operand for operand in operands if not isinstance(operand, Column)]
+    operands = [operand for operand in operands if isinstance(operand, Column)]
+    if op == "AND" and not all(constants):
+        return False if not operands else _constant(operands[0], False)
+    if op == "OR" and any(constants):
+        return True if not operands else _constant(operands[0], True)
+    if not operands:
+        return op == "AND"
+    known = [operand.values | operand.missing for operand in operands]
+    missing = np.logical_or.reduce([operand.missing for operand in operands])
+    if op == "AND":
+        # no operand is definitely false
+        not_false = np.logical_and.reduce(known)
+        return Column(not_false & ~missing, not_false & missing)
+    is_true = np.logical_or.reduce([operand.values for operand in operands])
+    return Column(is_true, ~is_true & missing)
+
+
+def _constant(like, value):
+    return Column(np.full(len(like.values), value), np.zeros(len(like.values), dtype=bool))
+
+
+# rows where a condition is definitely TRUE
+def satisfied(condition, size):
+    if not isinstance(condition, Column):
+        return np.full(size, bool(condition))
+    return condition.values & ~condition.missing
+
+
+####################################################################################################
+# rule sets
+
+# evaluate a `patients.satisfying` expression, returning a bool array (NULL counts as not satisfied)
+def evaluate_satisfying(expression, columns, size=None):
+    return compile_expression(expression)(columns, size)
+
+
+# evaluate an ordered `patients.categorised_as` dict: first matching rule wins,
+# "DEFAULT" catches everyone else wherever it appears in the dict
+def evaluate_categorised_as(definitions, columns, size=None):
+    size = _size(columns) if size is None else size
+    nodes = [parse(definition) for definition in definitions.values()]
+    return labels_column(list(definitions.keys()), first_match(nodes, columns, size))
+
+
+# position of the first rule each row satisfies (-1 for none)
+def first_match(nodes, columns, size):
+    index = np.full(size, -1, dtype=np.int64)
+    unassigned = np.ones(size, dtype=bool)
+    default = None
+    for position, node in enumerate(nodes):
+        if isinstance(node, Default):
+            default = position
+            continue
+        hit = compile_node(node)(columns, size) & unassigned
+        index[hit] = position
+        unassigned &= ~hit
+    if default is not None:
+        index[unassigned] = default
+    return index
+
+
+# map category positions back to labels, -1 meaning no category matched
+def labels_column(labels, index):
+    missing = index < 0
+    if all(isinstance(label, str) and is_iso_date(label) for label in labels):
+        table = np.array(labels, dtype="datetime64[D]")
+    else:
+        table = np.array(labels)
+    if missing.any():
+        values = table[np.where(missing, 0, index)]
+        if table.dtype.kind == "M":
+            values[missing] = np.datetime64("NaT")
+    else:
+        values = table[index]
+    return Column(values, missing)
+
+
+def is_iso_date(value):
+    return re.fullmatch(r"\d{4}-\d{2}-\d{2}", value) is not None
+
+
+def _size(columns):
+    for values in columns.values():
+        return len(_values(values))
+    raise ValueError("Cannot infer the number of rows from an empty set of columns")
+
+
+####################################################################################################
+# compiled expressions
+# a rule is parsed and type-checked once and then turned into a single generated python function
+# of numpy calls over (values, missing) pairs: no tree walk per evaluation, literals are coerced
+# to their column's type up front, and NULL masks are only carried where a NULL can occur
+# (three-valued logic as in evaluate_condition, which remains the reference semantics)
+#
+# kernels are memoized by expression text and, within that, by the types of the columns used,
+# so repeated evaluations (chunks, parameter sweeps) never parse or generate code again
+
+TYPES = ("bool", "int", "float", "date", "str")
+NUMERIC = ("bool", "int", "float")
+
+
+class RuleTypeError(ValueError):
+    pass
+
+
+# rule type of an array
+def value_type(values):
+    kind = np.asarray(values).dtype.kind
+    if kind == "b":
+        return "bool"
+    if kind in "iu":
+        return "int"
+    if kind == "f":
+        return "float"
+    if kind in "mM":
+        return "date"
+    return "str"
+
+
+# a generated (values, missing) pair: code for each (missing None where never NULL), or a
+# python constant for literals and folded subexpressions
+Value = namedtuple("Value", ["type", "values", "missing", "constant"])
+
+_NOTHING = object()
+
+
+class _Generator:
+    def __init__(self, expression, types):
+        self.expression = expression
+        self.types = types
+        self.lines = []
+        self.namespace = {"np": np, "as_column": as_column, "is_empty": is_empty}
+        self.loaded = {}
+
+    def error(self, message):
+        return RuleTypeError(f"{message} in: {self.expression}")
+
+    def emit(self, code):
+        name = f"t{len(self.lines)}"
+        self.lines.append(f"{name} = {code}")
+        return name
+
+    def constant(self, value):
+        name = f"k{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def load(self, name):
+        if name not in self.types:
+            raise self.error(f"Unknown column '{name}'")
+        if name not in self.loaded:
+            position = len(self.loaded)
+            self.lines.append(f"v{position}, m{position} = as_column(columns[{name!r}])")
+            self.loaded[name] = Value(self.types[name], f"v{position}", f"m{position}", _NOTHING)
+        return self.loaded[name]
+
+    def either_missing(self, *values):
+        masks = [value.missing for value in values if value.missing is not None]
+        if not masks:
+            return None
+        return masks[0] if len(masks) == 1 else self.emit(" | ".join(masks))
+
+    def value(self, node):
+        if isinstance(node, Literal):
+            kind = "str" if isinstance(node.value, str) else "float" if isinstance(node.value, float) else "int"
+            return Value(kind, self.constant(node.value), None, node.value)
+        if isinstance(node, Name):
+            return self.load(node.name)
+        if isinstance(node, BinOp):
+            left, right = self.value(node.left), self.value(node.right)
+            if left.type not in NUMERIC or right.type not in NUMERIC:
+                raise self.error(f"Cannot apply '{node.op}' to {left.type} and {right.type}")
+            kind = "float" if "float" in (left.type, right.type) or node.op == "/" else "int"
+            function = ARITHMETIC[node.op]
+            if left.constant is not _NOTHING and right.constant is not _NOTHING:
+                result = function(left.constant, right.constant).item()
+                return Value(kind, self.constant(result), None, result)
+            values = self.emit(f"np.{function.__name__}({left.values}, {right.values})")
+            return Value(kind, values, self.either_missing(left, right), _NOTHING)
+        condition = self.condition(node)
+        if condition.constant is not _NOTHING:
+            return Value("bool", self.constant(condition.constant), None, condition.constant)
+        return condition
+
+    # coerce a literal to the type of the column it is compared against (as coerce() does)
+    def coerce(self, literal, kind):
+        value = literal.constant
+        try:
+            if kind == "date":
+                if not isinstance(value, str):
+                    raise ValueError
+                value = np.datetime64(value, "D")
+            elif kind in NUMERIC and isinstance(value, str):
+                value = float(value)
+            elif kind == "str" and not isinstance(value, str):
+                value = str(value)
+        except ValueError:
+            raise self.error(f"Cannot compare a {kind} column with {literal.constant!r}")
+        return Value(kind, self.constant(value), None, value)
+
+    def condition(self, node):
+        if isinstance(node, Default):
+            raise RuleSyntaxError(f"DEFAULT can only be used as a whole rule: {self.expression}")
+        if isinstance(node, (Name, Literal, BinOp)):
+            # a bare reference is an implicit "IS NOT NULL AND != empty" test, so is never NULL
+            value = self.value(node)
+            if value.constant is not _NOTHING:
+                return Value("bool", None, None, bool(value.constant))
+            if value.type == "bool" and value.missing is None:
+                return Value("bool", value.values, None, _NOTHING)
+            if value.type == "date":
+                empty = f"np.isnat({value.values})"
+            elif value.type == "str":
+                empty = f"is_empty({value.values})"
+            else:
+                empty = f"({value.values} == 0)"
+            if value.missing is not None:
+                empty = f"{value.missing} | {empty}"
+            return Value("bool", self.emit(f"~({empty})"), None, _NOTHING)
+        if isinstance(node, Compare):
+            left, right = self.value(node.left), self.value(node.right)
+            function = COMPARISONS[node.op]
+            if left.constant is not _NOTHING and right.constant is not _NOTHING:
+                return Value("bool", None, None, bool(function(left.constant, right.constant)))
+            if left.constant is not _NOTHING:
+                left = self.coerce(left, right.type)
+            elif right.constant is not _NOTHING:
+                right = self.coerce(right, left.type)
+            elif not (left.type == right.type or (left.type in NUMERIC and right.type in NUMERIC)):
+                raise self.error(f"Cannot compare {left.type} with {right.type}")
+            values = self.emit(f"np.{function.__name__}({left.values}, {right.values})")
+            missing = self.either_missing(left, right)
+            if missing is not None:
+                values = self.emit(f"{values} & ~{missing}")
+            return Value("bool", values, missing, _NOTHING)
+        if isinstance(node, Not):
+            operand = self.condition(node.operand)
+            if operand.constant is not _NOTHING:
+                return Value("bool", None, None, not operand.constant)
+            if operand.missing is None:
+                return Value("bool", self.emit(f"~{operand.values}"), None, _NOTHING)
+            return Value("bool", self.emit(f"~{operand.values} & ~{operand.missing}"), operand.missing, _NOTHING)
+        if isinstance(node, BoolOp):
+            return self.kleene(node.op, [self.condition(operand) for operand in node.operands])
+        raise RuleSyntaxError(f"Cannot evaluate {node}")
+
+    # SQL AND / OR: a definite FALSE (AND) or TRUE (OR) wins over NULL
+    def kleene(self, op, operands):
+        constants = [operand.constant for operand in operands if operand.constant is not _NOTHING]
+        operands = [operand for operand in operands if operand.constant is _NOTHING]
+        if op == "AND" and not all(constants):
+            return Value("bool", None, None, False)
+        if op == "OR" and any(constants):
+            return Value("bool", None, None, True)
+        if not operands:
+            return Value("bool", None, None, op == "AND")
+        if len(operands) == 1:
+            return operands[0]
+        missing = self.either_missing(*operands)
+        if op == "AND":
+            known = [f"({operand.values} | {operand.missing})" if operand.missing else operand.values for operand in operands]
+            not_false = self.emit(" & ".join(known))
+            if missing is None:
+                return Value("bool", not_false, None, _NOTHING)
+            return Value("bool", self.emit(f"{not_false} & ~{missing}"), self.emit(f"{not_false} & {missing}"), _NOTHING)
+        is_true = self.emit(" | ".join(operand.values for operand in operands))
+        if missing is None:
+            return Value("bool", is_true, None, _NOTHING)
+        return Value("bool", is_true, self.emit(f"~{is_true} & {missing}"), _NOTHING)
+
+    # source of `kernel(columns, size) -> Column` for the condition
+    def generate(self, node):
+        result = self.condition(node)
+        if result.constant is not _NOTHING:
+            returned = f"np.full(size, {result.constant}), np.zeros(size, dtype=bool)"
+        elif result.missing is None:
+            returned = f"{result.values}, np.zeros(size, dtype=bool)"
+        else:
+            returned = f"{result.values}, {result.missing}"
+        body = "".join(f"    {line}\n" for line in self.lines)
+        return f"def kernel(columns, size):\n{body}    return Column({returned})\n"
+
+
+class CompiledExpression:
+    def __init__(self, node, expression):
+        self.node = node
+        self.expression = expression
+        self.names = sorted(names_in(node))
+        self.kernels = {}
+
+    # check the expression against column types (name -> one of TYPES); raises RuleTypeError
+    def check(self, types):
+        _Generator(self.expression, types).generate(self.node)
+
+    def source(self, types):
+        return _Generator(self.expression, types).generate(self.node)
+
+    def kernel(self, types):
+        key = tuple(types.get(name) for name in self.names)
+        if key not in self.kernels:
+            generator = _Generator(self.expression, {name: kind for name, kind in zip(self.names, key) if kind})
+            source = generator.generate(self.node)
+            generator.namespace["Column"] = Column
+            exec(compile(source, f"<rule: {self.expression}>", "exec"), generator.namespace)
+            self.kernels[key] = generator.namespace["kernel"]
+        return self.kernels[key]
+
+    # the condition as a three-valued Column
+    def condition(self, columns, size=None):
+        size = _size(columns) if size is None else size
+        types = {name: value_type(_values(columns[name])) for name in self.names if name in columns}
+        return self.kernel(types)(columns, size)
+
+    # rows where the condition is definitely TRUE
+    def __call__(self, columns, size=None):
+        values, missing = self.condition(columns, size)
+        return values & ~missing
+
+
+# compile a satisfying expression (or one categorised_as rule) once per expression text
+@lru_cache(maxsize=None)
+def compile_expression(expression):
+    return CompiledExpression(fold_constants(parse(expression)), expression)
+
+
+# compile an already parsed (or rewritten) rule
+@lru_cache(maxsize=None)
+def compile_node(node):
+    return CompiledExpression(node, repr(node))
+
+
+####################################################################################################
+# decision tables
+# most group rules are thresholds on a few numeric columns plus boolean flags, so an ordered rule
+# set can be precomputed over the cells those thresholds cut the columns into; a row is then
+# categorised with one lookup instead of one pass per rule
+
+# the largest table worth building before falling back to the generic evaluator
+MAX_CELLS = 1 << 16
+
+
+# fold constant arithmetic such as "32844*1/5" into a single literal
+def fold_constants(node):
+    if isinstance(node, BinOp):
+        left, right = fold_constants(node.left), fold_constants(node.right)
+        if isinstance(left, Literal) and isinstance(right, Literal):
+            return Literal(ARITHMETIC[node.op](left.value, right.value).item())
+        return BinOp(node.op, left, right)
+    if isinstance(node, Compare):
+        return Compare(node.op, fold_constants(node.left), fold_constants(node.right))
+    if isinstance(node, Not):
+        return Not(fold_constants(node.operand))
+    if isinstance(node, BoolOp):
+        return BoolOp(node.op, tuple(fold_constants(operand) for operand in node.operands))
+    return node
+
+
+# record how a rule uses each column: bare flag, numeric thresholds or category literals;
+# returns False if the rule contains anything else (column-to-column comparisons, arithmetic)
+def collect_uses(node, uses):
+    if isinstance(node, Literal):
+        return True
+    if isinstance(node, Name):
+        _use(uses, node.name)["flag"] = True
+        return True
+    if isinstance(node, Not):
+        return collect_uses(node.operand, uses)
+    if isinstance(node, BoolOp):
+        return all([collect_uses(operand, uses) for operand in node.operands])
+    if isinstance(node, Compare):
+        if isinstance(node.left, Name) and isinstance(node.right, Literal):
+            name, value = node.left.name, node.right.value
+        elif isinstance(node.right, Name) and isinstance(node.left, Literal):
+            name, value = node.right.name, node.left.value
+        else:
+            return False
+        if isinstance(value, str):
+            if node.op not in ("=", "==", "!=", "<>"):
+                return False
+            _use(uses, name)["category"].add(value)
+        else:
+            _use(uses, name)["numeric"].add(value)
+        return True
+    return False
+
+
+def _use(uses, name):
+    return uses.setdefault(name, {"flag": False, "numeric": set(), "category": set()})
+
+
+# a column cut into cells: truthiness (flag), intervals between thresholds (numeric),
+# or one cell per literal plus "other" (category); every dimension has a NULL cell last
+class Dimension:
+    def __init__(self, name, kind, points=()):
+        self.name = name
+        self.kind = kind
+        self.points = sorted(points)
+        if kind == "flag":
+            self.size = 2
+        elif kind == "numeric":
+            self.size = 2 * len(self.points) + 2
+        else:
+            self.size = len(self.points) + 2
+
+    # one representative value per cell, used to evaluate the rules when building the table
+    def representatives(self):
+        if self.kind == "flag":
+            return Column(np.array([0, 1]), np.zeros(2, dtype=bool))
+        missing = np.zeros(self.size, dtype=bool)
+        missing[-1] = True
+        if self.kind == "numeric":
+            points = np.array(self.points, dtype=float)
+            bounds = np.concatenate([[points[0] - 1], points, [points[-1] + 1]])
+            values = np.zeros(self.size)
+            values[0:-1:2] = (bounds[:-1] + bounds[1:]) / 2
+            values[1:-1:2] = points
+            return Column(values, missing)
+        # a string longer than every literal stands in for any other value
+        other = "~" * (max(len(point) for point in self.points) + 1)
+        return Column(np.array(self.points + [other, ""]), missing)
+
+    # cell of each row
+    def cells(self, column):
+        values, missing = column
+        if self.kind == "flag":
+            return (~(missing | is_empty(values))).astype(np.intp)
+        if self.kind == "numeric":
+            if values.dtype.kind in "iub" and len(values):
+                # small integer ranges (ages) are cheaper through a per-value lookup table
+                low, high = int(values.min()), int(values.max())
+                if high - low <= MAX_CELLS:
+                    cells = self.numeric_cells(np.arange(low, high + 1))[values - low]
+                    cells[missing] = self.size - 1
+                    return cells
+            cells = self.numeric_cells(values)
+        else:
+            points = [coerce(point, values) for point in self.points]
+            if values.dtype.kind == "U" and values.dtype.itemsize <= 12:
+                # short labels (jcvi_group) compare faster packed into one integer each
+                width = values.dtype.itemsize // 4
+                packed = packed_strings(np.array(points, dtype=values.dtype))
+                # literals longer than the column cannot match (and must not be truncated)
+                points = [key if len(point) <= width else -1 for key, point in zip(packed, points)]
+                values = packed_strings(values)
+            cells = np.full(len(values), len(points), dtype=np.intp)
+            for position, point in enumerate(points):
+                cells[values == point] = position
+        cells[missing] = self.size - 1
+        return cells
+
+    def numeric_cells(self, values):
+        points = np.array(self.points, dtype=float)
+        below = np.searchsorted(points, values, side="left")
+        exact = points[np.minimum(below, len(points) - 1)] == values
+        return 2 * below + (exact & (below < len(points)))
+
+
+# pack strings of up to three characters into int64s (21 bits per code point)
+def packed_strings(values):
+    width = values.dtype.itemsize // 4
+    codes = values.view(np.uint32).reshape(len(values), width).astype(np.int64)
+    packed = np.zeros(len(values), dtype=np.int64)
+    for position in range(width):
+        packed |= codes[:, position] << (21 * position)
+    return packed
+
+
+class DecisionTable:
+    def __init__(self, labels, dimensions, opaque, table):
+        self.labels = labels
+        self.dimensions = dimensions
+        self.opaque = opaque
+        self.table = table
+
+    def __call__(self, columns, size=None):
+        size = _size(columns) if size is None else size
+        columns = dict(columns)
+        # rules that could not be tabulated are evaluated generically and enter as flags
+        for name, expression in self.opaque.items():
+            columns[name] = Column(compile_expression(expression)(columns, size), np.zeros(size, dtype=bool))
+        flat = np.zeros(size, dtype=np.intp)
+        for dimension in self.dimensions:
+            flat *= dimension.size
+            flat += dimension.cells(as_column(columns[dimension.name]))
+        return labels_column(self.labels, self.table[flat])
+
+
+# fallback for rule sets with no useful table
+class GenericRules:
+    def __init__(self, definitions):
+        self.labels = list(definitions.keys())
+        self.nodes = [parse(definition) for definition in definitions.values()]
+
+    def __call__(self, columns, size=None):
+        size = _size(columns) if size is None else size
+        return labels_column(self.labels, first_match(self.nodes, columns, size))
+
+
+# compile an ordered categorised_as dict into a DecisionTable, or a GenericRules fallback
+def compile_categorised_as(definitions):
+    return _compile(tuple(definitions.items()))
+
+
+@lru_cache(maxsize=None)
+def _compile(items):
+    labels = [label for label, _ in items]
+    nodes = []
+    uses = {}
+    opaque = {}
+    for position, (label, definition) in enumerate(items):
+        node = fold_constants(parse(definition))
+        rule_uses = {}
+        if not isinstance(node, Default) and not collect_uses(node, rule_uses):
+            # keep the rule's place in the order but evaluate it generically
+            name = f"__rule_{position}"
+            opaque[name] = definition
+            node = Name(name)
+            rule_uses = {name: {"flag": True, "numeric": set(), "category": set()}}
+        for name, use in rule_uses.items():
+            merged = _use(uses, name)
+            merged["flag"] |= use["flag"]
+            merged["numeric"] |= use["numeric"]
+            merged["category"] |= use["category"]
+        nodes.append(node)
+
+    dimensions = []
+    for name, use in uses.items():
+        if use["numeric"] and use["category"]:
+            return GenericRules(dict(items))
+        if use["numeric"]:
+            # truthiness of a numeric column is decided by its cell once 0 is a threshold
+            points = use["numeric"] | ({0} if use["flag"] else set())
+            dimensions.append(Dimension(name, "numeric", points))
+        elif use["category"]:
+            points = use["category"] | ({""} if use["flag"] else set())
+            dimensions.append(Dimension(name, "category", points))
+        else:
+            dimensions.append(Dimension(name, "flag"))
+
+    shape = [dimension.size for dimension in dimensions]
+    cells = int(np.prod(shape))
+    if cells > MAX_CELLS:
+        return GenericRules(dict(items))
+    grid = np.indices(shape).reshape(len(shape), cells)
+    representatives = {}
+    for dimension, cell in zip(dimensions, grid):
+        values, missing = dimension.representatives()
+        representatives[dimension.name] = Column(values[cell], missing[cell])
+    table = first_match(nodes, representatives, cells)
+    return DecisionTable(labels, dimensions, opaque, table)
+
+
+# compile a satisfying expression; the result returns a bool array like evaluate_satisfying
+def compile_satisfying(expression):
+    rules = compile_categorised_as({1: expression, 0: "DEFAULT"})
+    return lambda columns, size=None: rules(columns, size).values == 1
+
+
+####################################################################################################
+# the group definitions written by the design action
+
+def read_group_definitions(lib_dir="analysis/lib"):
+    from study_metadata import load_metadata
+
+    metadata = load_metadata(lib_dir)
+    return metadata.atrisk_group, metadata.dict_jcvi, metadata.dict_elig
+
+
+# re-derive atrisk_group, jcvi_group and elig_date from their component columns
+def derive_groups(columns, lib_dir="analysis/lib"):
+    str_atrisk, dict_jcvi, dict_elig = read_group_definitions(lib_dir)
+    columns = dict(columns)
+    size = _size(columns)
+    atrisk_group = compile_satisfying(str_atrisk)(columns, size)
+    columns["atrisk_group"] = Column(atrisk_group, np.zeros(size, dtype=bool))
+    columns["jcvi_group"] = compile_categorised_as(dict_jcvi)(columns, size)
+    columns["elig_date"] = compile_categorised_as(dict_elig)(columns, size)
+    return {name: columns[name] for name in ("atrisk_group", "jcvi_group", "elig_date")}
+
+
+####################################################################################################
+# arrow / feather interface
+
+def column_from_arrow(array):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    missing = array.is_null().to_numpy(zero_copy_only=False)
+    if pa.types.is_dictionary(array.type):
+        # decode through the (small) dictionary rather than row by row
+        dictionary = column_from_arrow(array.dictionary).values
+        if len(dictionary) == 0:
+            return Column(np.full(len(array), "", dtype=str), missing)
+        indices = array.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        return Column(dictionary[indices], missing)
+    if pa.types.is_date(array.type) or pa.types.is_timestamp(array.type):
+        days = pc.cast(array, pa.date32()).cast(pa.int32()).fill_null(0)
+        values = days.to_numpy(zero_copy_only=False).astype("datetime64[D]")
+        values[missing] = np.datetime64("NaT")
+    elif pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        values = np.asarray(array.fill_null("").to_numpy(zero_copy_only=False), dtype=str)
+    elif pa.types.is_boolean(array.type):
+        values = array.fill_null(False).to_numpy(zero_copy_only=False)
+    else:
+        values = array.fill_null(0).to_numpy(zero_copy_only=False)
+    return Column(values, missing)
+
+
+def column_to_arrow(column, like=None):
+    import pyarrow as pa
+
+    values = column.values
+    if values.dtype.kind == "M":
+        values = values.astype("datetime64[D]")
+    array = pa.array(values, mask=column.missing)
+    if like is not None:
+        if pa.types.is_dictionary(like):
+            array = array.cast(like.value_type).dictionary_encode()
+        else:
+            array = array.cast(like)
+    return array
+
+
+def read_feather_columns(path, names=None):
+    from pyarrow import feather
+
+    table = feather.read_table(path, columns=names)
+    return {name: column_from_arrow(table[name]) for name in table.column_names}
+
+
+# replace the derived group columns of an extract table, keeping its column types
+def rederive_table(table, lib_dir="analysis/lib"):
+    columns = {name: column_from_arrow(table[name]) for name in table.column_names}
+    for name, column in derive_groups(columns, lib_dir).items():
+        like = table.schema.field(name).type if name in table.column_names else None
+        array = column_to_arrow(column, like)
+        if name in table.column_names:
+            table = table.set_column(table.column_names.index(name), name, array)
+        else:
+            table = table.append_column(name, array)
+    return table
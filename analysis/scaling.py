@@ -0,0 +1,169 @@
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+####################################################################################################
+# scaling harness
+# writes synthetic event stores (synthetic_store.py) of increasing size, runs the full study
+# definition against each one with extract.py, and records for every step
+# - wall-clock time, user and system cpu time
+# - peak resident memory
+# - bytes read and written (block i/o as counted by the kernel, so page-cache hits are free)
+# and then plots each against the number of patients
+#
+# each step runs in its own process and is measured with os.wait4, so the numbers are the
+# step's alone; the scaling exponent between consecutive sizes (1.0 is linear) shows where the
+# pipeline stops scaling
+#
+#   python analysis/scaling.py --sizes 100000 1000000 10000000 30000000
+
+SIZES = [100_000, 1_000_000, 10_000_000]
+OUTPUT = "output/scaling"
+BLOCK = 512
+
+
+# run a command to completion; returns its measurements
+def measure(command):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, ["analysis", env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return {
+        "seconds": seconds,
+        "user": usage.ru_utime,
+        "system": usage.ru_stime,
+        # ru_maxrss is in kilobytes on linux and bytes on macos
+        "peak_rss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "read_bytes": usage.ru_inblock * BLOCK,
+        "written_bytes": usage.ru_oublock * BLOCK,
+    }
+
+
+def directory_bytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def run_size(size, output, generator_arguments, extract_arguments, keep=True):
+    store = os.path.join(output, "stores", str(size))
+    generated = os.path.join(store, "generated.json")
+    # a store written with the same arguments is reused
+    step = {"patients": size}
+    previous = None
+    if os.path.exists(generated):
+        with open(generated) as f:
+            previous = json.load(f)
+    if previous and previous["arguments"] == generator_arguments:
+        step["generate"] = previous["measurements"]
+    else:
+        command = [sys.executable, "analysis/synthetic_store.py", "--size", str(size), "--output", store]
+        step["generate"] = measure(command + generator_arguments)
+        with open(generated, "w") as f:
+            json.dump({"arguments": generator_arguments, "measurements": step["generate"]}, f)
+    step["store_bytes"] = directory_bytes(store)
+
+    extract = os.path.join(output, "extracts", f"{size}.feather")
+    command = [sys.executable, "analysis/extract.py", "--store", store, "--output", extract]
+    step["extract"] = measure(command + extract_arguments)
+    step["extract_bytes"] = os.path.getsize(extract)
+    if not keep:
+        os.remove(extract)
+    return step
+
+
+# log-log slope of each measurement between consecutive sizes
+def exponents(steps, stage, key):
+    slopes = []
+    for before, after in zip(steps, steps[1:]):
+        x = math.log(after["patients"] / before["patients"])
+        y0, y1 = before[stage][key], after[stage][key]
+        slopes.append(math.log(y1 / y0) / x if y0 > 0 and y1 > 0 else float("nan"))
+    return slopes
+
+
+def report(steps):
+    lines = [f"{'patients':>12} {'stage':8} {'seconds':>9} {'peak MiB':>9} {'read MiB':>9} {'write MiB':>9} {'exp':>5}"]
+    for stage in ("generate", "extract"):
+        slopes = [float("nan")] + exponents(steps, stage, "seconds")
+        for step, slope in zip(steps, slopes):
+            m = step[stage]
+            lines.append(
+                f"{step['patients']:>12,} {stage:8} {m['seconds']:9.2f} {m['peak_rss'] / 2**20:9.1f} "
+                f"{m['read_bytes'] / 2**20:9.1f} {m['written_bytes'] / 2**20:9.1f} {slope:5.2f}"
+            )
+    return "\n".join(lines)
+
+
+# one panel each for time, peak memory and i/o against patients, log-log
+def plot(steps, path):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    patients = [step["patients"] for step in steps]
+    figure, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+    panels = [
+        ("time (s)", [("seconds", "", 1)]),
+        ("peak memory (MiB)", [("peak_rss", "", 2**20)]),
+        ("i/o (MiB)", [("read_bytes", " read", 2**20), ("written_bytes", " written", 2**20)]),
+    ]
+    for axis, (label, series) in zip(axes, panels):
+        for stage in ("generate", "extract"):
+            for key, suffix, scale in series:
+                axis.plot(patients, [step[stage][key] / scale for step in steps], marker="o", label=stage + suffix)
+        # a linear reference through the first extract point
+        first = steps[0]["extract"][series[0][0]] / series[0][2]
+        if first > 0:
+            axis.plot(patients, [first * n / patients[0] for n in patients], "k:", label="linear")
+        axis.set_xscale("log")
+        axis.set_yscale("log")
+        axis.set_xlabel("patients")
+        axis.set_ylabel(label)
+        axis.legend(fontsize="small")
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the study against synthetic stores of increasing size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--background-events", type=float, default=None, help="see synthetic_store.py")
+    parser.add_argument("--prevalence", nargs="*", metavar="CODELIST=SHARE", default=None)
+    parser.add_argument("--workers", type=int, default=1, help="extraction processes")
+    parser.add_argument("--chunk-size", type=int, default=None, help="extraction chunk size")
+    parser.add_argument("--discard-extracts", action="store_true")
+    args = parser.parse_args()
+
+    generator_arguments = ["--seed", str(args.seed)]
+    if args.background_events is not None:
+        generator_arguments += ["--background-events", str(args.background_events)]
+    if args.prevalence:
+        generator_arguments += ["--prevalence", *args.prevalence]
+    extract_arguments = ["--workers", str(args.workers)]
+    if args.chunk_size:
+        extract_arguments += ["--chunk-size", str(args.chunk_size)]
+
+    os.makedirs(os.path.join(args.output, "stores"), exist_ok=True)
+    os.makedirs(os.path.join(args.output, "extracts"), exist_ok=True)
+    steps = []
+    for size in sorted(args.sizes):
+        steps.append(run_size(size, args.output, generator_arguments, extract_arguments, not args.discard_extracts))
+        with open(os.path.join(args.output, "scaling.json"), "w") as f:
+            json.dump(steps, f, indent=2)
+        print(report(steps), flush=True)
+    try:
+        plot(steps, os.path.join(args.output, "scaling.png"))
+    except ImportError:
+        print("matplotlib is not installed; measurements are in scaling.json")
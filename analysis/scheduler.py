@@ -0,0 +1,166 @@
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+####################################################################################################
+# variable scheduler
+# variables refer to each other through date expressions ("elig_date - 1 day") and through the
+# names in satisfying / categorised_as formulas; these references make a DAG which is evaluated in
+# topological order against the local backend, with independent variables run concurrently;
+# LocalBackend.evaluate and to_arrow evaluate through run (on LocalBackend.threads threads)
+#
+# variables the backend evaluates together (fused codelist groups, vaccination chains) form a
+# single node, named after their first member
+#
+# threads rather than processes: the backend's state (event store, scans, results) is shared in
+# memory and the numpy kernels release the GIL
+
+
+class CycleError(ValueError):
+    pass
+
+
+# node of each variable, and the variables of each node
+def units(backend):
+    node_of = {}
+    members = {}
+    for name in backend.definitions:
+        group = backend.fused.get(name) or backend.chains.get(name) or [name]
+        node_of[name] = group[0]
+        members.setdefault(group[0], []).append(name)
+    return node_of, members
+
+
+# node -> the nodes it depends on
+def dependency_graph(backend):
+    node_of, members = units(backend)
+    graph = {node: set() for node in members}
+    for name in backend.definitions:
+        for dependency in backend.dependencies(name):
+            if node_of[dependency] != node_of[name]:
+                graph[node_of[name]].add(node_of[dependency])
+    return graph
+
+
+# the part of a graph the given nodes need: them and everything they depend on
+def needed(graph, nodes):
+    subgraph = {}
+    nodes = list(nodes)
+    while nodes:
+        node = nodes.pop()
+        if node not in subgraph:
+            subgraph[node] = graph[node]
+            nodes.extend(graph[node])
+    return subgraph
+
+
+def topological_order(graph):
+    remaining = {node: len(dependencies) for node, dependencies in graph.items()}
+    dependents = reverse(graph)
+    ready = [node for node, count in remaining.items() if count == 0]
+    order = []
+    while ready:
+        node = ready.pop(0)
+        order.append(node)
+        for dependent in dependents[node]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if len(order) != len(graph):
+        raise CycleError(f"Circular references between {sorted(set(graph) - set(order))}")
+    return order
+
+
+def reverse(graph):
+    dependents = {node: [] for node in graph}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].append(node)
+    return dependents
+
+
+# the chain of dependencies with the largest total duration, which bounds the wall-clock time
+# however many workers there are; returns (nodes, seconds)
+def critical_path(graph, durations):
+    finish = {}
+    previous = {}
+    for node in topological_order(graph):
+        start = 0.0
+        for dependency in graph[node]:
+            if finish[dependency] > start:
+                start, previous[node] = finish[dependency], dependency
+        finish[node] = start + durations.get(node, 0.0)
+    if not finish:
+        return [], 0.0
+    node = max(finish, key=finish.get)
+    path = [node]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return path[::-1], finish[node]
+
+
+class Schedule:
+    def __init__(self, graph, members, durations, wall_time):
+        self.graph = graph
+        self.members = members
+        self.durations = durations
+        self.wall_time = wall_time
+
+    def critical_path(self):
+        return critical_path(self.graph, self.durations)
+
+    def report(self):
+        path, seconds = self.critical_path()
+        lines = [
+            f"{len(self.graph)} nodes, {sum(self.durations.values()):.3f}s of work in {self.wall_time:.3f}s",
+            f"critical path ({seconds:.3f}s):",
+        ]
+        for node in path:
+            names = ", ".join(self.members[node])
+            lines.append(f"  {self.durations[node]:8.3f}s  {names}")
+        return "\n".join(lines)
+
+
+# evaluate the variables of the backend (all of them, or the given names and what they need),
+# running independent nodes on `workers` threads
+def run(backend, workers=None, names=None):
+    graph = dependency_graph(backend)
+    node_of, members = units(backend)
+    if names is not None:
+        graph = needed(graph, {node_of[name] for name in names})
+    remaining = {node: len(dependencies) for node, dependencies in graph.items()}
+    dependents = reverse(graph)
+    durations = {}
+
+    def evaluate(node):
+        start = time.perf_counter()
+        for name in members[node]:
+            backend.column(name)
+        return node, time.perf_counter() - start
+
+    topological_order(graph)  # fail early on cycles
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {pool.submit(evaluate, node) for node, count in remaining.items() if count == 0}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, seconds = future.result()
+                durations[node] = seconds
+                for dependent in dependents[node]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        running.add(pool.submit(evaluate, dependent))
+    return Schedule(graph, members, durations, time.perf_counter() - started)
+
+
+# python analysis/scheduler.py <event store directory> [study definition module] [workers]
+if __name__ == "__main__":
+    from event_store import EventStore
+    from local_backend import LocalBackend, study_variables
+
+    store = EventStore.from_directory(sys.argv[1])
+    module = sys.argv[2] if len(sys.argv) > 2 else "study_definition"
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    backend = LocalBackend(store, study_variables(module))
+    print(run(backend, workers).report())
@@ -0,0 +1,256 @@
+import argparse
+import builtins
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+####################################################################################################
+# startup trace
+# imports a study definition with the things it does at import time instrumented:
+# - every module import (the import statement, including the module body)
+# - reads of analysis/lib files (pandas.read_csv, study_metadata.read_csv, json.load)
+# - every codelist load (codelists.load, i.e. `from codelists import x`)
+# - every patients.* variable constructor and StudyDefinition itself
+# each span records its wall time, the bytes it left allocated and its peak allocation (from
+# tracemalloc), and the trace is written as chrome trace json (chrome://tracing, perfetto) or
+# speedscope json (speedscope.app)
+#
+#   python analysis/startup_trace.py study_definition --output output/trace/startup.json
+#   python analysis/startup_trace.py study_definition --format speedscope --output startup.speedscope.json
+
+
+class Tracer:
+    def __init__(self, allocations=True):
+        self.allocations = allocations
+        self.events = []
+        # per open span: [allocated at start, peak so far]
+        self.stack = []
+        self.patched = set()
+        # (object, attribute, original value) of everything patched, to undo on stop
+        self.originals = []
+        self.original_import = None
+
+    def memory(self):
+        return tracemalloc.get_traced_memory() if self.allocations else (0, 0)
+
+    def begin(self, name, category, args=None):
+        current, peak = self.memory()
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        if self.allocations:
+            tracemalloc.reset_peak()
+        self.stack.append([current, current])
+        self.events.append(("B", name, category, time.perf_counter_ns(), args or {}))
+
+    def end(self, name, category):
+        now = time.perf_counter_ns()
+        current, peak = self.memory()
+        start, child_peak = self.stack.pop()
+        peak = max(peak, child_peak)
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        if self.allocations:
+            tracemalloc.reset_peak()
+        args = {"allocated_bytes": current - start, "peak_bytes": peak - start} if self.allocations else {}
+        self.events.append(("E", name, category, now, args))
+
+    # name is a string or a function of the call's arguments
+    def wrap(self, function, name, category, describe=None):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            span = name(*args, **kwargs) if callable(name) else name
+            self.begin(span, category, describe(*args, **kwargs) if describe else None)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end(span, category)
+
+        return traced
+
+    def patch(self, target, attribute, value):
+        self.originals.append((target, attribute, getattr(target, attribute)))
+        setattr(target, attribute, value)
+
+    ################################################################################################
+    # instrumentation
+
+    def start(self):
+        if self.allocations:
+            tracemalloc.start()
+        self.original_import = builtins.__import__
+        self.patch(builtins, "__import__", self.traced_import)
+        self.patch(json, "load", self.wrap(json.load, lambda f, *_, **__: f"json.load {getattr(f, 'name', '')}", "lib"))
+        self.instrument()
+
+    def stop(self):
+        for target, attribute, value in reversed(self.originals):
+            setattr(target, attribute, value)
+        self.originals = []
+        if self.allocations:
+            tracemalloc.stop()
+
+    def traced_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.begin(name, "import")
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.end(name, "import")
+            self.instrument()
+
+    # patch the modules of interest once they have been imported
+    def instrument(self):
+        pandas = sys.modules.get("pandas")
+        if pandas is not None and "pandas" not in self.patched and hasattr(pandas, "read_csv"):
+            self.patched.add("pandas")
+            self.patch(pandas, "read_csv", self.wrap(pandas.read_csv, read_csv_name, "lib"))
+
+        # the lib csvs, parsed when analysis/lib/metadata.json is out of date
+        study_metadata = sys.modules.get("study_metadata")
+        if study_metadata is not None and "study_metadata" not in self.patched and hasattr(study_metadata, "read_csv"):
+            self.patched.add("study_metadata")
+            self.patch(
+                study_metadata,
+                "read_csv",
+                self.wrap(study_metadata.read_csv, lambda path: f"study_metadata.read_csv {path}", "lib"),
+            )
+
+        codelists = sys.modules.get("codelists")
+        if codelists is not None and "codelists" not in self.patched and hasattr(codelists, "load"):
+            self.patched.add("codelists")
+            # __getattr__ looks load up as a global, so `from codelists import x` goes through this
+            load = codelists.load
+
+            def traced_load(name):
+                self.begin(name, "codelist")
+                try:
+                    return load(name)
+                finally:
+                    self.end(name, "codelist")
+
+            self.patch(codelists, "load", traced_load)
+
+        patients = sys.modules.get("cohortextractor.patients")
+        if patients is not None and "patients" not in self.patched:
+            self.patched.add("patients")
+            for name, function in vars(patients).items():
+                if callable(function) and not name.startswith("_") and getattr(function, "__module__", None) == patients.__name__:
+                    self.patch(patients, name, self.wrap(function, f"patients.{name}", "variable", describe_variable))
+
+        cohortextractor = sys.modules.get("cohortextractor")
+        study_definition = getattr(cohortextractor, "StudyDefinition", None)
+        if study_definition is not None and "StudyDefinition" not in self.patched:
+            self.patched.add("StudyDefinition")
+            self.patch(
+                study_definition,
+                "__init__",
+                self.wrap(study_definition.__init__, "StudyDefinition", "study", lambda _, **kwargs: {"variables": len(kwargs)}),
+            )
+
+    ################################################################################################
+    # output
+
+    def spans(self):
+        totals = {}
+        opened = []
+        for phase, name, category, ns, args in self.events:
+            if phase == "B":
+                opened.append(ns)
+            else:
+                key = (category, name)
+                count, seconds, allocated = totals.get(key, (0, 0.0, 0))
+                totals[key] = (count + 1, seconds + (ns - opened.pop()) / 1e9, allocated + args.get("allocated_bytes", 0))
+        return totals
+
+    def chrome_trace(self):
+        origin = self.events[0][3] if self.events else 0
+        events = [
+            {
+                "name": name,
+                "cat": category,
+                "ph": phase,
+                "ts": (ns - origin) / 1000,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": args,
+            }
+            for phase, name, category, ns, args in self.events
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def speedscope(self, title):
+        frames = {}
+        events = []
+        for phase, name, category, ns, _ in self.events:
+            frame = frames.setdefault((category, name), len(frames))
+            events.append({"type": "O" if phase == "B" else "C", "frame": frame, "at": ns})
+        origin = events[0]["at"] if events else 0
+        for event in events:
+            event["at"] = (event["at"] - origin) / 1e6
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": name, "file": category} for category, name in frames]},
+            "profiles": [
+                {
+                    "type": "evented",
+                    "name": title,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": events[-1]["at"] if events else 0,
+                    "events": events,
+                }
+            ],
+            "name": title,
+        }
+
+
+def read_csv_name(*args, **kwargs):
+    return f"pandas.read_csv {kwargs.get('filepath_or_buffer', args[0] if args else '')}"
+
+
+def describe_variable(*args, **kwargs):
+    described = {}
+    if "returning" in kwargs:
+        described["returning"] = str(kwargs["returning"])
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, list) and hasattr(value, "system"):
+            described["codes"] = len(value)
+    return described
+
+
+# import `module` with tracing on; returns the tracer
+def trace(module="study_definition", allocations=True):
+    tracer = Tracer(allocations)
+    tracer.start()
+    try:
+        # through __import__ (unlike importlib.import_module), so the import itself is a span
+        __import__(module)
+    finally:
+        tracer.stop()
+    return tracer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trace what importing a study definition does")
+    parser.add_argument("module", nargs="?", default="study_definition")
+    parser.add_argument("--output", default="output/trace/startup.json")
+    parser.add_argument("--format", choices=["chrome", "speedscope"], default="chrome")
+    parser.add_argument("--no-allocations", action="store_true", help="skip tracemalloc, which slows imports down")
+    parser.add_argument("--top", type=int, default=15, help="slowest spans to print")
+    args = parser.parse_args()
+
+    tracer = trace(args.module, allocations=not args.no_allocations)
+    output = tracer.speedscope(args.module) if args.format == "speedscope" else tracer.chrome_trace()
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(output, f)
+
+    totals = sorted(tracer.spans().items(), key=lambda item: -item[1][1])
+    print(f"{'category':10} {'calls':>6} {'seconds':>9} {'allocated':>12}  name")
+    for (category, name), (count, seconds, allocated) in totals[: args.top]:
+        print(f"{category:10} {count:6} {seconds:9.4f} {allocated:12,}  {name}")
+    print(f"trace written to {args.output}")
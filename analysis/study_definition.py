@@ -4,16 +4,15 @@ from cohortextractor import (
     filter_codes_by_category
 )
 
-# Import codelists.py script
-from codelists import *
-
-import pandas as pd
+# Import codelists (each codelist is only read when imported here)
+from codelists import ethnicity_codes_6
 
 from functions import *
 
 # import the variables for deriving JCVI groups
 from elig_definition import (
     elig_variables, 
+    metadata,
     study_parameters
 )
 
@@ -22,11 +21,7 @@ import numpy as np
 np.random.seed(study_parameters["seed"])
 
 # regions
-regions = pd.read_csv(
-    filepath_or_buffer='./analysis/lib/regions.csv',
-    dtype=str
-)
-ratio_regions = { regions['region'][i] : float(regions['ratio'][i]) for i in regions.index }
+ratio_regions = metadata.ratio_regions
 
 study=StudyDefinition(
 
@@ -0,0 +1,212 @@
+import csv
+import datetime
+import hashlib
+import json
+import os
+
+from atomic_write import atomic_write
+
+####################################################################################################
+# study metadata
+# the study design written to analysis/lib by the design action (study parameters, the at-risk
+# rule, jcvi groups, eligibility dates and region ratios), read with the standard library only so
+# that study definitions start without importing pandas
+#
+# design.R also writes analysis/lib/metadata.json: every source file's md5 plus their parsed
+# contents. it is used while the md5s still match the files, otherwise the files are parsed
+# again for this process only (importing a study definition never writes into the repo); either
+# way the contents are checked against SCHEMA
+#
+#   python analysis/study_metadata.py        rebuilds (and validates) analysis/lib/metadata.json
+
+LIB_DIR = "analysis/lib"
+METADATA = "metadata.json"
+VERSION = 1
+
+# column -> kind for each csv; kinds are checked by check_value
+SCHEMA = {
+    "atrisk_group.csv": {"atrisk_group": "rule"},
+    "jcvi_groups.csv": {"group": "label", "definition": "rule"},
+    "elig_dates.csv": {"date": "date", "description": "rule", "jcvi_groups": "text"},
+    "regions.csv": {"region": "label", "ratio": "ratio"},
+}
+
+PARAMETERS = {
+    "seed": "integer",
+    "ref_age_1": "date",
+    "ref_age_2": "date",
+    "ref_cev": "date",
+    "ref_ar": "date",
+    "pandemic_start": "date",
+    "start_date": "date",
+}
+
+SOURCES = ["study_parameters.json", *SCHEMA]
+
+
+class MetadataError(ValueError):
+    pass
+
+
+def md5(path):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+####################################################################################################
+# parsing and validation
+
+def check_value(kind, value, where):
+    if kind == "integer":
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise MetadataError(f"{where}: expected an integer, got {value!r}")
+        return value
+    if not isinstance(value, str) or not value.strip():
+        raise MetadataError(f"{where}: expected a non-empty {kind}, got {value!r}")
+    if kind == "date":
+        try:
+            datetime.date.fromisoformat(value)
+        except ValueError:
+            raise MetadataError(f"{where}: expected a YYYY-MM-DD date, got {value!r}")
+    if kind == "ratio":
+        try:
+            ratio = float(value)
+        except ValueError:
+            raise MetadataError(f"{where}: expected a number, got {value!r}")
+        if not 0 <= ratio <= 1:
+            raise MetadataError(f"{where}: ratio {ratio} is not between 0 and 1")
+        return ratio
+    return value
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+# check rows (dicts of strings, as read from the csv) against the file's schema; returns the rows
+# with values converted to their kind
+def check_rows(filename, rows):
+    schema = SCHEMA[filename]
+    if not rows:
+        raise MetadataError(f"{filename}: no rows")
+    checked = []
+    for number, row in enumerate(rows, start=1):
+        missing = [column for column in schema if column not in row]
+        if missing:
+            raise MetadataError(f"{filename}: missing columns {missing}")
+        checked.append(
+            {column: check_value(kind, row[column], f"{filename} row {number} {column}") for column, kind in schema.items()}
+        )
+    for column, kind in schema.items():
+        if kind in ("label", "date"):
+            values = [row[column] for row in checked]
+            duplicates = sorted({value for value in values if values.count(value) > 1})
+            if duplicates:
+                raise MetadataError(f"{filename}: duplicate {column} {duplicates}")
+        if kind == "rule":
+            defaults = [number for number, row in enumerate(checked, start=1) if row[column].strip() == "DEFAULT"]
+            if defaults and defaults != [len(checked)]:
+                raise MetadataError(f"{filename}: DEFAULT must be the last row only")
+        if kind == "ratio" and abs(sum(row[column] for row in checked) - 1) > 1e-6:
+            raise MetadataError(f"{filename}: {column}s do not sum to 1")
+    return checked
+
+
+def check_parameters(parameters):
+    missing = [name for name in PARAMETERS if name not in parameters]
+    if missing:
+        raise MetadataError(f"study_parameters.json: missing {missing}")
+    for name, kind in PARAMETERS.items():
+        check_value(kind, parameters[name], f"study_parameters.json {name}")
+    return parameters
+
+
+def check_contents(contents):
+    if contents.get("version") != VERSION:
+        raise MetadataError(f"{METADATA}: expected version {VERSION}, got {contents.get('version')!r}")
+    check_parameters(contents["study_parameters"])
+    if len(contents["atrisk_group"]) != 1:
+        raise MetadataError("atrisk_group.csv: expected exactly one row")
+    for filename in SCHEMA:
+        name = filename[: -len(".csv")]
+        rows = [{column: str(value) for column, value in row.items()} for row in contents[name]]
+        contents[name] = check_rows(filename, rows)
+    return contents
+
+
+# parse the source files in lib_dir
+def parse_lib(lib_dir=LIB_DIR):
+    contents = {"version": VERSION, "sources": {filename: md5(os.path.join(lib_dir, filename)) for filename in SOURCES}}
+    with open(os.path.join(lib_dir, "study_parameters.json")) as f:
+        contents["study_parameters"] = json.load(f)
+    for filename in SCHEMA:
+        contents[filename[: -len(".csv")]] = read_csv(os.path.join(lib_dir, filename))
+    return check_contents(contents)
+
+
+def write_metadata(contents, lib_dir=LIB_DIR):
+    with atomic_write(os.path.join(lib_dir, METADATA), "w", suffix=".json") as f:
+        json.dump(contents, f, indent=2)
+
+
+####################################################################################################
+# loading
+
+class StudyMetadata:
+    def __init__(self, contents):
+        self.study_parameters = contents["study_parameters"]
+        self.atrisk_group = contents["atrisk_group"][0]["atrisk_group"]
+        self.jcvi_groups = contents["jcvi_groups"]
+        self.elig_dates = contents["elig_dates"]
+        self.regions = contents["regions"]
+
+    # group -> definition, in file order (as categorised_as takes it)
+    @property
+    def dict_jcvi(self):
+        return {row["group"]: row["definition"] for row in self.jcvi_groups}
+
+    @property
+    def ratio_jcvi(self):
+        return {row["group"]: 1 / len(self.jcvi_groups) for row in self.jcvi_groups}
+
+    @property
+    def dict_elig(self):
+        return {row["date"]: row["description"] for row in self.elig_dates}
+
+    @property
+    def ratio_elig(self):
+        return {row["date"]: 1 / len(self.elig_dates) for row in self.elig_dates}
+
+    @property
+    def ratio_regions(self):
+        return {row["region"]: row["ratio"] for row in self.regions}
+
+
+_loaded = {}
+
+
+# the metadata in lib_dir, from the artifact while it matches the source files
+def load_metadata(lib_dir=LIB_DIR):
+    if lib_dir in _loaded:
+        return _loaded[lib_dir]
+    contents = None
+    try:
+        with open(os.path.join(lib_dir, METADATA)) as f:
+            contents = json.load(f)
+        sources = contents.get("sources", {})
+        if any(sources.get(filename) != md5(os.path.join(lib_dir, filename)) for filename in SOURCES):
+            contents = None
+        else:
+            contents = check_contents(contents)
+    except (OSError, ValueError, KeyError, TypeError):
+        contents = None
+    if contents is None:
+        contents = parse_lib(lib_dir)
+    _loaded[lib_dir] = StudyMetadata(contents)
+    return _loaded[lib_dir]
+
+
+if __name__ == "__main__":
+    write_metadata(parse_lib())
+    print(f"{os.path.join(LIB_DIR, METADATA)} written")
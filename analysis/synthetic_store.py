@@ -0,0 +1,306 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from event_store import MISSING_DATE, OPEN_END_DATE, TABLES, to_days
+from local_backend import EVENT_TABLES, flatten_variables, study_variables
+from dummy_generator import population_ages
+
+####################################################################################################
+# synthetic event store
+# writes an event store directory (the feather files EventStore.from_directory and extract.py
+# read) at population scale, for seeing how the study behaves at tens of millions of patients
+# rather than the project.yaml dummy population
+#
+# - every codelist the study queries contributes events with codes drawn from the codelist's
+#   csv, for a configurable share of patients (its prevalence)
+# - every patient also gets background events whose codes are in no codelist, which is most of
+#   a real record and most of the rows a scan has to read
+# - registrations, addresses and covid vaccinations follow the shapes the study relies on
+#
+# patients are generated and written in chunks, so memory is bounded by the chunk size; each
+# chunk has its own random stream, so the same seed and chunk size always give the same store
+#
+#   python analysis/synthetic_store.py --size 10000000 --output output/synthetic/10000000
+
+CHUNK_SIZE = 1_000_000
+DEFAULT_PREVALENCE = 0.05
+BACKGROUND_EVENTS = 20
+BACKGROUND_MEDICATIONS = 5
+# further events per patient with a codelist's condition, on top of the first
+EXTRA_EVENTS = 1.5
+
+EVENTS_FROM = to_days(np.array(["2000-01-01"], dtype="datetime64[D]"))[0]
+EVENTS_TO = to_days(np.array(["2022-06-30"], dtype="datetime64[D]"))[0]
+VACCINATIONS_FROM = to_days(np.array(["2020-12-08"], dtype="datetime64[D]"))[0]
+REFERENCE_DATE = to_days(np.array(["2021-01-01"], dtype="datetime64[D]"))[0]
+
+# background codes are drawn above every real snomed / dm+d code
+BACKGROUND_CODES = (10**18, 2 * 10**18)
+
+COVID_PRODUCTS = [
+    "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    "COVID-19 Vac AstraZeneca (ChAdOx1 S recomb) 5x10000000000 viral particles/0.5ml dose sol for inj MDV",
+    "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+]
+MAX_IMD = 32844
+PRACTICES = 6500
+
+
+# codelist name -> (table, codes) for every codelist the study matches against an event table
+def study_codelists(module="study_definition"):
+    import codelists
+
+    variables = flatten_variables(study_variables(module))
+    names = {id(value): name for name, value in vars(codelists).items() if isinstance(value, list)}
+    found = {}
+    for variable, (query_type, query_args) in variables.items():
+        if query_type not in EVENT_TABLES:
+            continue
+        codelist = query_args["codelist"]
+        name = names.get(id(codelist), variable)
+        codes = [code[0] if isinstance(code, tuple) else code for code in codelist]
+        # event codes are stored as int64 (snomed, dm+d); a codelist of other codes (CTV3, say)
+        # would otherwise silently get no events
+        other = [code for code in codes if not str(code).isdigit()]
+        if other:
+            raise ValueError(f"{name} has codes the event store can't hold, such as {other[0]!r}")
+        codes = np.unique(np.array(codes, dtype=np.int64))
+        found[name] = (EVENT_TABLES[query_type], codes)
+    return found
+
+
+def regions(path="analysis/lib/regions.csv"):
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    weights = np.array([float(row["ratio"]) for row in rows])
+    return np.array([row["region"] for row in rows], dtype=object), weights / weights.sum()
+
+
+# draw dates uniformly in [start, stop)
+def uniform_dates(rng, size, start=EVENTS_FROM, stop=EVENTS_TO):
+    return rng.integers(start, stop, size).astype(np.int32)
+
+
+def patients(rng, patient_ids):
+    size = len(patient_ids)
+    ages = population_ages(rng, size)
+    date_of_birth = REFERENCE_DATE - ages * 365 - rng.integers(0, 365, size)
+    died = rng.random(size) < 0.01
+    date_of_death = np.where(died, uniform_dates(rng, size, VACCINATIONS_FROM - 365, EVENTS_TO), MISSING_DATE)
+    return {
+        "patient_id": patient_ids,
+        "date_of_birth": date_of_birth.astype(np.int32),
+        "sex": np.where(rng.random(size) < 0.5, "F", "M").astype(object),
+        "date_of_death": date_of_death.astype(np.int32),
+    }
+
+
+# events for a chunk of patients: (patient_id, date, code) sorted by patient_id then date
+def coded_events(rng, patient_ids, codelists, prevalences, background, default_prevalence=DEFAULT_PREVALENCE):
+    size = len(patient_ids)
+    ids, codes = [], []
+    for name, codelist in codelists.items():
+        if not len(codelist):
+            continue
+        has = rng.random(size) < prevalences.get(name, default_prevalence)
+        counts = np.where(has, 1 + rng.poisson(EXTRA_EVENTS, size), 0)
+        ids.append(np.repeat(patient_ids, counts))
+        codes.append(codelist[rng.integers(0, len(codelist), counts.sum())])
+    counts = rng.poisson(background, size)
+    ids.append(np.repeat(patient_ids, counts))
+    codes.append(rng.integers(*BACKGROUND_CODES, counts.sum(), dtype=np.int64))
+    ids, codes = np.concatenate(ids), np.concatenate(codes)
+    dates = uniform_dates(rng, len(ids))
+    order = np.lexsort((dates, ids))
+    return {"patient_id": ids[order], "date": dates[order], "code": codes[order]}
+
+
+def clinical_events(rng, patient_ids, codelists, prevalences, background, default_prevalence=DEFAULT_PREVALENCE):
+    events = coded_events(rng, patient_ids, codelists, prevalences, background, default_prevalence)
+    # about a third of events carry a value (bmi, blood pressure, ...); 0 is no value
+    size = len(events["code"])
+    valued = rng.random(size) < 0.3
+    events["numeric_value"] = np.where(valued, np.round(rng.lognormal(3, 0.5, size), 1), 0.0)
+    return events
+
+
+# covid doses from 2020-12-08, about 12 weeks apart, plus some influenza records
+def vaccinations(rng, patient_ids):
+    size = len(patient_ids)
+    doses = rng.choice(5, size=size, p=[0.08, 0.04, 0.18, 0.5, 0.2])
+    ids = np.repeat(patient_ids, doses)
+    first = np.repeat(VACCINATIONS_FROM + rng.integers(0, 180, size), doses)
+    dose = np.arange(len(ids)) - np.repeat(np.cumsum(doses) - doses, doses)
+    dates = first + dose * 84 + rng.integers(-7, 28, len(ids)) * (dose > 0)
+    flu = rng.random(size) < 0.4
+    ids = np.concatenate([ids, patient_ids[flu]])
+    dates = np.concatenate([dates, uniform_dates(rng, flu.sum(), VACCINATIONS_FROM - 100, EVENTS_TO)])
+    target_disease = np.array(["SARS-2 CORONAVIRUS"] * len(first) + ["INFLUENZA"] * flu.sum(), dtype=object)
+    product_name = np.concatenate(
+        [np.array(COVID_PRODUCTS, dtype=object)[rng.integers(0, len(COVID_PRODUCTS), len(first))],
+         np.full(flu.sum(), "Influenza vaccine", dtype=object)]
+    )
+    order = np.lexsort((dates, ids))
+    return {
+        "patient_id": ids[order],
+        "date": dates[order].astype(np.int32),
+        "target_disease": target_disease[order],
+        "product_name": product_name[order],
+    }
+
+
+# 1-3 consecutive spells per patient, the last one usually still open
+def spells(rng, patient_ids, largest=3):
+    size = len(patient_ids)
+    counts = 1 + rng.binomial(largest - 1, 0.2, size)
+    ids = np.repeat(patient_ids, counts)
+    last = np.cumsum(counts) - 1
+    # start dates strictly ascending within a patient (the k-th spell is moved on k days, so no
+    # two share a start and none is empty); each spell ends where the next starts
+    start = uniform_dates(rng, len(ids), EVENTS_FROM - 20 * 365, EVENTS_TO - 365)
+    start = start[np.lexsort((start, ids))]
+    start += (np.arange(len(ids)) - np.repeat(last - counts + 1, counts)).astype(np.int32)
+    end = np.empty_like(start)
+    end[:-1] = start[1:]
+    closed = uniform_dates(rng, size, VACCINATIONS_FROM, EVENTS_TO)
+    end[last] = np.where(rng.random(size) < 0.97, OPEN_END_DATE, np.maximum(closed, start[last] + 1))
+    return ids, start, end
+
+
+def registrations(rng, patient_ids, region_names, region_weights):
+    ids, start, end = spells(rng, patient_ids)
+    size = len(ids)
+    practice = rng.integers(1, PRACTICES, size)
+    region = region_names[rng.choice(len(region_names), size=size, p=region_weights)]
+    return {
+        "patient_id": ids,
+        "start_date": start,
+        "end_date": end,
+        "pseudo_id": practice,
+        "nuts1_region_name": region,
+        "stp_code": np.char.add("E540000", (practice % 42).astype(str)).astype(object),
+        "msoa": np.char.add("E0200", (practice % 6791).astype(str)).astype(object),
+    }
+
+
+def addresses(rng, patient_ids):
+    ids, start, end = spells(rng, patient_ids, largest=2)
+    size = len(ids)
+    imd = rng.integers(0, MAX_IMD // 100 + 1, size) * 100
+    imd[rng.random(size) < 0.01] = -1
+    return {
+        "patient_id": ids,
+        "start_date": start,
+        "end_date": end,
+        "index_of_multiple_deprivation": imd,
+        "msoa": np.char.add("E0200", rng.integers(1000, 7791, size).astype(str)).astype(object),
+        "rural_urban_classification": rng.integers(1, 9, size),
+    }
+
+
+def arrow_batch(name, columns):
+    import pyarrow as pa
+
+    dates = TABLES[name]["dates"]
+    arrays = {}
+    for column in TABLES[name]["columns"]:
+        values = columns[column]
+        if column in dates:
+            arrays[column] = pa.array(values, type=pa.int32(), mask=values == MISSING_DATE).view(pa.date32())
+        else:
+            arrays[column] = pa.array(values)
+    return pa.record_batch(list(arrays.values()), names=list(arrays))
+
+
+# write a store of `size` patients to `output`; returns the number of rows in each table
+def write_store(
+    output,
+    size,
+    seed=0,
+    prevalences=None,
+    background=BACKGROUND_EVENTS,
+    background_medications=BACKGROUND_MEDICATIONS,
+    default_prevalence=DEFAULT_PREVALENCE,
+    chunk_size=CHUNK_SIZE,
+    module="study_definition",
+):
+    import pyarrow as pa
+
+    prevalences = prevalences or {}
+    codelists = study_codelists(module)
+    by_table = {
+        table: {name: codes for name, (codelist_table, codes) in codelists.items() if codelist_table == table}
+        for table in EVENT_TABLES.values()
+    }
+    region_names, region_weights = regions()
+    os.makedirs(output, exist_ok=True)
+    writers = {}
+    rows = {name: 0 for name in TABLES}
+    files = {}
+    try:
+        for chunk, first in enumerate(range(0, size, chunk_size)):
+            rng = np.random.default_rng([seed, chunk])
+            patient_ids = np.arange(first + 1, min(first + chunk_size, size) + 1, dtype=np.int64)
+            tables = {
+                "patients": patients(rng, patient_ids),
+                "clinical_events": clinical_events(
+                    rng, patient_ids, by_table["clinical_events"], prevalences, background, default_prevalence
+                ),
+                "medications": coded_events(
+                    rng, patient_ids, by_table["medications"], prevalences, background_medications, default_prevalence
+                ),
+                "vaccinations": vaccinations(rng, patient_ids),
+                "registrations": registrations(rng, patient_ids, region_names, region_weights),
+                "addresses": addresses(rng, patient_ids),
+            }
+            for name, columns in tables.items():
+                batch = arrow_batch(name, columns)
+                if name not in writers:
+                    # uncompressed, so open_tables can memory-map the files
+                    files[name] = pa.OSFile(os.path.join(output, f"{name}.feather"), "wb")
+                    writers[name] = pa.ipc.new_file(files[name], batch.schema)
+                writers[name].write_batch(batch)
+                rows[name] += batch.num_rows
+    finally:
+        for name, writer in writers.items():
+            writer.close()
+            files[name].close()
+    return rows
+
+
+def parse_prevalences(items):
+    prevalences = {}
+    for item in items or []:
+        name, _, value = item.partition("=")
+        prevalences[name] = float(value)
+    return prevalences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a population-scale synthetic event store")
+    parser.add_argument("--size", type=int, required=True, help="number of patients")
+    parser.add_argument("--output", required=True, help="event store directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--study", default="study_definition", help="study definition whose codelists are used")
+    parser.add_argument("--prevalence", nargs="*", metavar="CODELIST=SHARE", help="share of patients with codelist events")
+    parser.add_argument("--default-prevalence", type=float, default=DEFAULT_PREVALENCE)
+    parser.add_argument("--background-events", type=float, default=BACKGROUND_EVENTS)
+    parser.add_argument("--background-medications", type=float, default=BACKGROUND_MEDICATIONS)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    rows = write_store(
+        args.output,
+        args.size,
+        args.seed,
+        parse_prevalences(args.prevalence),
+        args.background_events,
+        args.background_medications,
+        args.default_prevalence,
+        args.chunk_size,
+        args.study,
+    )
+    for name, count in rows.items():
+        print(f"{name:20} {count:>14,} rows")
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the analysis scripts import each other as top-level modules, as when run from the project root
+sys.path.insert(0, os.path.join(ROOT, "analysis"))
+
+
+# codelists and study definitions are read relative to the project root
+@pytest.fixture(autouse=True)
+def project_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+
+# cohortextractor passes on_or_after=X on as between=(X, None)
+def as_between(definitions):
+    converted = {}
+    for name, (query_type, query_args) in definitions.items():
+        query_args = dict(query_args)
+        if query_args.get("on_or_after") is not None:
+            query_args["between"] = (query_args.pop("on_or_after"), query_args.pop("on_or_before", None))
+        converted[name] = (query_type, query_args)
+    return converted
+
+
+# a small synthetic event store, written in several chunks, with most study codelists common
+@pytest.fixture(scope="session")
+def store_path(tmp_path_factory):
+    from synthetic_store import write_store
+
+    path = str(tmp_path_factory.mktemp("store"))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)
+        write_store(path, 3000, seed=1, background=3, background_medications=1, default_prevalence=0.3, chunk_size=1000)
+    return path
+
+
+@pytest.fixture(scope="session")
+def store(store_path):
+    from event_store import EventStore
+
+    return EventStore.from_directory(store_path)
@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmark import CODELISTS, compare, run_benchmark
+
+
+def results(**medians):
+    return {"results": {key: {"median": median} for key, median in medians.items()}}
+
+
+def test_compare_flags_slower_medians(capsys):
+    baseline = results(a=1.0, b=1.0, c=1.0, gone=1.0)
+    current = results(a=1.05, b=1.2, c=0.5, new=9.0)
+    assert compare(baseline, current) == ["b"]
+    assert compare(baseline, current, threshold=0.01) == ["a", "b"]
+    printed = capsys.readouterr().out
+    assert "REGRESSION" in printed
+    assert "gone" not in printed and "new" not in printed
+
+
+# each process runs the benchmark in a fresh interpreter and reports every repeat
+def test_run_benchmark():
+    result = run_benchmark("codelist_load", "ast_primis", 2, 3)
+    assert len(result["seconds"]) == 6
+    assert result["min"] <= result["median"]
+    assert result["peak_rss"] > 0
+
+
+def test_command_line_writes_and_compares_results(tmp_path):
+    output = str(tmp_path / "results.json")
+    benchmark = os.path.join("analysis", "benchmark.py")
+    subprocess.run([sys.executable, benchmark, "--only", "codelist_load", "--output", output], check=True, capture_output=True)
+    with open(output) as f:
+        report = json.load(f)
+    assert sorted(report["results"]) == sorted(f"codelist_load[{name}]" for name in CODELISTS)
+    assert {"commit", "dirty", "machine", "timestamp"} <= set(report)
+    same = subprocess.run([sys.executable, benchmark, "--compare", output, output], capture_output=True)
+    assert same.returncode == 0
@@ -0,0 +1,75 @@
+import mmap
+import os
+import shutil
+
+import pytest
+from cohortextractor import codelist_from_csv as read_csv
+
+import codelist_bundle
+from codelist_bundle import build_bundle, open_bundle
+
+CSVS = {
+    "primis-covid19-vacc-uptake-bmi.csv": ("snomed", "code", None),
+    "opensafely-icd-10-chapter-i.csv": ("icd10", "code", None),
+    "opensafely-ethnicity-snomed-0removed.csv": ("snomed", "snomedcode", "Grouping_6"),
+}
+
+
+@pytest.fixture
+def codelist_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_bundle, "_bundles", {})
+    directory = tmp_path / "codelists"
+    directory.mkdir()
+    for filename in CSVS:
+        shutil.copy(os.path.join("codelists", filename), directory)
+    return str(directory)
+
+
+def entries(codelist):
+    return sorted(code if isinstance(code, tuple) else (code,) for code in codelist)
+
+
+# integer codes, string codes and category columns read back as the csv reader reads them
+def test_bundle_is_memory_mapped_and_matches_the_csvs(codelist_dir):
+    path = os.path.join(codelist_dir, "codelists.bundle")
+    build_bundle(codelist_dir, path)
+    bundle = open_bundle(codelist_dir, path)
+    assert isinstance(bundle.buffer, mmap.mmap)
+    for filename, (system, column, category_column) in CSVS.items():
+        assert bundle.has(filename, column, category_column)
+        codelist = bundle.codelist(filename, system, column, category_column)
+        expected = read_csv(os.path.join(codelist_dir, filename), system, column, category_column)
+        assert entries(codelist) == entries(expected)
+        assert codelist.system == system
+
+
+def test_a_changed_csv_rebuilds_the_bundle(codelist_dir, monkeypatch):
+    path = os.path.join(codelist_dir, "codelists.bundle")
+    filename = "primis-covid19-vacc-uptake-bmi.csv"
+    before = open_bundle(codelist_dir, path)
+    assert 123456 not in before.codes(filename).tolist()
+    with open(path, "rb") as f:
+        content = f.read()
+
+    with open(os.path.join(codelist_dir, filename), "a") as f:
+        f.write("123456,Added\n")
+    monkeypatch.setattr(codelist_bundle, "_bundles", {})
+    after = open_bundle(codelist_dir, path)
+
+    assert 123456 in after.codes(filename).tolist()
+    assert after.shas[filename] != before.shas[filename]
+    with open(path, "rb") as f:
+        assert f.read() != content
+    # unchanged csvs keep their recorded size, mtime and sha
+    assert after.known["opensafely-icd-10-chapter-i.csv"] == before.known["opensafely-icd-10-chapter-i.csv"]
+
+
+def test_an_unwritable_bundle_is_kept_in_memory(codelist_dir, monkeypatch):
+    def refuse(*args, **kwargs):
+        raise PermissionError("read-only")
+
+    monkeypatch.setattr(codelist_bundle, "atomic_write", refuse)
+    path = os.path.join(codelist_dir, "codelists.bundle")
+    bundle = open_bundle(codelist_dir, path)
+    assert not os.path.exists(path)
+    assert bundle.has("primis-covid19-vacc-uptake-bmi.csv")
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+
+import pytest
+
+from conftest import ROOT
+
+
+# a freshly imported codelists module, whatever other tests have read from the shared one
+@pytest.fixture
+def codelists():
+    spec = importlib.util.spec_from_file_location("fresh_codelists", os.path.join(ROOT, "analysis", "codelists.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_importing_reads_no_codelist(codelists):
+    assert codelists.touched() == []
+    assert "ast_primis" in codelists.untouched()
+    assert "ast_primis" not in vars(codelists)
+    assert "ast_primis" in dir(codelists)
+
+
+def test_a_codelist_is_read_on_first_access_and_kept(codelists):
+    first = codelists.ast_primis
+    assert vars(codelists)["ast_primis"] is first
+    assert codelists.ast_primis is first
+    assert codelists.touched() == ["ast_primis"]
+    assert "ast_primis" not in codelists.untouched()
+    assert len(first) > 0
+
+
+def test_combined_codelists_read_their_parts(codelists):
+    combined = codelists.covid_primary_care_probable_combined
+    parts = ["covid_primary_care_positive_test", "covid_primary_care_code", "covid_primary_care_sequalae"]
+    assert codelists.touched() == [*parts, "covid_primary_care_probable_combined"]
+    assert len(combined) == len({code for part in parts for code in getattr(codelists, part)})
+
+
+def test_unknown_names_raise_attribute_error(codelists):
+    with pytest.raises(AttributeError):
+        codelists.no_such_codelist
+    assert not hasattr(codelists, "no_such_codelist")
+    assert codelists.touched() == []
@@ -0,0 +1,62 @@
+import importlib
+import os
+
+import numpy as np
+import pytest
+from pyarrow import feather
+
+from conftest import as_between
+from dummy_generator import DOSE_INTERVAL, DummyGenerator
+from event_store import MISSING_DATE
+from local_backend import flatten_variables, study_variables
+from study_metadata import load_metadata
+
+SIZE = 20_000
+
+# the extract opensafely-cohort-extractor 1.93.3 writes from this study's expectations:
+#   cohortextractor generate_cohort --study-definition study_definition --expectations-population 20 --output-format feather
+EXPECTATIONS_EXTRACT = os.path.join(os.path.dirname(__file__), "data", "expectations_input.feather")
+
+
+def generate(definitions):
+    study = importlib.import_module("study_definition").study
+    return DummyGenerator(
+        definitions,
+        SIZE,
+        getattr(study, "default_expectations", {}),
+        int(load_metadata().study_parameters["seed"]),
+        getattr(study, "index_date", None),
+    )
+
+
+@pytest.mark.parametrize("form", ["on_or_after", "between"])
+def test_second_dose_follows_the_first(form):
+    definitions = flatten_variables(study_variables("study_definition"))
+    if form == "between":
+        definitions = as_between(definitions)
+    generator = generate(definitions)
+    generator.column("covid_vax_disease_2_date")
+    first = generator.match_dates["covid_vax_disease_1_date"].astype(np.int64)
+    second = generator.match_dates["covid_vax_disease_2_date"].astype(np.int64)
+
+    has_second = second != MISSING_DATE
+    assert has_second.sum() > SIZE // 2
+    assert np.all(first[has_second] != MISSING_DATE)
+    intervals = (second - first)[has_second]
+    mean, stddev = DOSE_INTERVAL
+    assert abs(intervals.mean() - mean) < 1
+    assert abs(intervals.std() - stddev) < 1
+    assert intervals.min() >= 1
+
+
+# check_dummy_data in process_extract.R stops on any column whose R class differs from the extract's
+def test_column_types_match_cohortextractor():
+    expected = feather.read_table(EXPECTATIONS_EXTRACT).schema
+    actual = generate(study_variables("study_definition")).to_arrow().schema
+    assert {field.name: field.type for field in actual} == {field.name: field.type for field in expected}
+
+
+# as the baseline dummy_data.R did
+def test_ages_are_shared():
+    table = generate(study_variables("study_definition")).to_arrow()
+    assert table["age_2"].equals(table["age_1"])
@@ -0,0 +1,111 @@
+import math
+import os
+import runpy
+import sys
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from conftest import ROOT, as_between
+from extract import extract, extract_sharded
+from local_backend import flatten_variables, study_variables
+
+SMALL_SIZE = 60
+
+
+@pytest.fixture(scope="module")
+def variables():
+    return as_between(flatten_variables(study_variables("study_definition")))
+
+
+# few enough patients to extract one at a time
+@pytest.fixture(scope="module")
+def small_store_path(tmp_path_factory):
+    from synthetic_store import write_store
+
+    path = str(tmp_path_factory.mktemp("small_store"))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)
+        write_store(path, SMALL_SIZE, seed=2, background=3, background_medications=1, default_prevalence=0.3)
+    return path
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def read_batches(path):
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        return [reader.get_batch(i) for i in range(reader.num_record_batches)]
+
+
+# each chunk is written as its own record batch, and how patients are chunked doesn't change the
+# extract: one chunk of the whole store is the unchunked result
+def test_chunk_size_does_not_change_the_extract(variables, small_store_path, tmp_path):
+    tables = []
+    for chunk_size in (1, 7, SMALL_SIZE):
+        output = str(tmp_path / f"input_{chunk_size}.feather")
+        rows = extract(variables, small_store_path, output, chunk_size)
+        batches = read_batches(output)
+        assert len(batches) == math.ceil(SMALL_SIZE / chunk_size)
+        tables.append(pa.Table.from_batches(batches))
+        assert tables[-1].num_rows == rows > 0
+    assert tables[0].equals(tables[1])
+    assert tables[1].equals(tables[2])
+
+
+def test_command_line_streams_chunks(small_store_path, tmp_path, monkeypatch):
+    output = str(tmp_path / "input.feather")
+    arguments = ["extract.py", "--store", small_store_path, "--output", output, "--chunk-size", "7"]
+    monkeypatch.setattr(sys, "argv", arguments)
+    runpy.run_path(os.path.join(ROOT, "analysis", "extract.py"), run_name="__main__")
+    assert len(read_batches(output)) == math.ceil(SMALL_SIZE / 7)
+
+
+def test_command_line_threads_write_the_same_extract(variables, small_store_path, tmp_path, monkeypatch):
+    streamed, threaded = str(tmp_path / "streamed.feather"), str(tmp_path / "threaded.feather")
+    extract(variables, small_store_path, streamed, 7)
+    arguments = ["extract.py", "--store", small_store_path, "--output", threaded, "--chunk-size", "7", "--threads", "3"]
+    monkeypatch.setattr(sys, "argv", arguments)
+    runpy.run_path(os.path.join(ROOT, "analysis", "extract.py"), run_name="__main__")
+    assert read(threaded) == read(streamed)
+
+
+# shards are runs of whole chunks whose batches are written in chunk order, so the file is the
+# streaming extract's whatever the number of workers
+@pytest.mark.parametrize("chunk_size, workers", [(500, 2), (500, 4), (700, 3)])
+def test_sharded_extract_is_byte_identical_to_streaming(variables, store_path, tmp_path, chunk_size, workers):
+    streamed, sharded = str(tmp_path / "streamed" / "input.feather"), str(tmp_path / "sharded" / "input.feather")
+    assert extract(variables, store_path, streamed, chunk_size) > 0
+    assert extract_sharded(variables, store_path, sharded, workers, chunk_size) > 0
+    assert read(sharded) == read(streamed)
+    # the shards' temporary streams are gone
+    assert os.listdir(tmp_path / "sharded") == ["input.feather"]
+
+
+def test_workers_are_capped_at_the_number_of_chunks(variables, small_store_path, tmp_path):
+    streamed, sharded = str(tmp_path / "streamed.feather"), str(tmp_path / "sharded.feather")
+    extract(variables, small_store_path, streamed, SMALL_SIZE // 2)
+    extract_sharded(variables, small_store_path, sharded, 8, SMALL_SIZE // 2)
+    assert read(sharded) == read(streamed)
+
+
+def test_ragged_extract_holds_every_dose(variables, store_path, tmp_path):
+    capped, ragged = str(tmp_path / "capped.feather"), str(tmp_path / "ragged.feather")
+    extract_sharded(variables, store_path, capped, 2, 1000)
+    extract_sharded(variables, store_path, ragged, 2, 1000, ragged=True)
+    capped, ragged = pa.ipc.open_file(capped).read_all(), pa.ipc.open_file(ragged).read_all()
+
+    assert "covid_vax_disease_1_date" not in ragged.column_names
+    assert ragged.num_rows == capped.num_rows
+    assert pa.types.is_large_list(ragged["covid_vax_disease_dates"].type)
+    doses = ragged["covid_vax_disease_dates"].to_pylist()
+    capped_names = [name for name in capped.column_names if name.startswith("covid_vax_disease_")]
+    assert capped_names
+    for k in range(1, len(capped_names) + 1):
+        expected = capped[f"covid_vax_disease_{k}_date"].to_pylist()
+        assert [dates[k - 1] if len(dates) >= k else None for dates in doses] == expected
+    assert np.array_equal(ragged["patient_id"].to_numpy(), capped["patient_id"].to_numpy())
@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+from icd10 import ICD10Error, ICD10Index, PrefixIndex, diagnosis_key, entry_interval, icd10_index, matches, normalise
+
+
+def covered(entries, diagnoses):
+    return ICD10Index(entries).contains(diagnoses).tolist()
+
+
+def test_leaf_entry_covers_itself_and_longer_codes():
+    assert covered(["A000"], ["A000", "A0001", "A00", "A001", "A01"]) == [True, True, False, False, False]
+
+
+def test_category_entry_covers_its_leaves():
+    assert covered(["A00"], ["A00", "A000", "A009", "A00X", "A01", "A0"]) == [True, True, True, True, False, False]
+
+
+def test_range_entry_covers_every_category_between_its_ends():
+    assert covered(["A00-A09"], ["A00", "A05", "A09", "A099", "A09X", "A10", "B00"]) == [
+        True,
+        True,
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_range_across_letters():
+    assert covered(["S00-T98"], ["R99", "S00", "S99", "T00", "T98", "T981", "T99"]) == [
+        False,
+        True,
+        True,
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_chapter_entry_covers_its_categories():
+    assert covered(["I"], ["A00", "B99", "B999", "C00"]) == [True, True, True, False]
+    assert covered(["IX"], ["I00", "I219", "J00", "H99"]) == [True, True, False, False]
+    # chapter numerals are not codes in their own right
+    assert covered(["I"], ["I21"]) == [False]
+
+
+def test_diagnoses_are_normalised():
+    assert covered(["A09", "G01"], ["a09", "a09.0", " A09.9 ", "G01*", "g01†", "G02*"]) == [
+        True,
+        True,
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_entries_are_normalised():
+    assert covered(["a09.0", "g01*"], ["A090", "G01"]) == [True, True]
+    assert normalise("a09.0") == "A090"
+    assert normalise("G01*") == "G01"
+
+
+def test_missing_and_malformed_diagnoses_match_nothing():
+    assert covered(["I"], [None, "", "123", "ZZ", np.nan]) == [False] * 5
+    assert diagnosis_key(None) == 0
+
+
+def test_overlapping_entries_merge():
+    index = ICD10Index(["A00", "A00-A09", "A01", "A05-A12", "B20"])
+    assert index.entries == 5
+    assert len(index) == 2
+
+
+def test_empty_codelist_matches_nothing():
+    assert covered([], ["A00", None]) == [False, False]
+
+
+def test_bad_entries_are_rejected():
+    with pytest.raises(ICD10Error):
+        entry_interval("A09-A00")
+    with pytest.raises(ICD10Error):
+        entry_interval("not a code")
+
+
+def test_matches_takes_a_codelist():
+    class Codelist(list):
+        system = "icd10"
+
+    assert matches(Codelist([("A00", "Cholera")]), ["A001", "A01"]).tolist() == [True, False]
+    Codelist.system = "snomed"
+    with pytest.raises(ICD10Error):
+        matches(Codelist(["A00"]), ["A00"])
+
+
+# TPP matches hospital diagnoses with LIKE 'entry%' on the code as stored: a range entry only
+# matches itself written out, and a chapter numeral is just a prefix
+def test_prefix_mode_matches_as_tpp_does():
+    codelist = ["A00", "B01-B09", "I"]
+    diagnoses = ["A001", "A00.1", "B05", "B01-B09X", "I219", "A05", "a001", "", None]
+    expected = [True, True, False, True, True, False, False, False, False]
+    assert matches(codelist, diagnoses).tolist() == expected
+    assert matches(codelist, diagnoses, mode="prefix").tolist() == expected
+
+
+def test_prefix_entries_are_made_prefix_free():
+    index = PrefixIndex(["A00", "A001", "A0", "B20", "B2", "B3", "B3"])
+    assert index.entries == 7
+    assert index.prefixes.tolist() == ["A0", "B2", "B3"]
+    assert index.contains(["A", "A0", "A09", "B19", "B2X", "B3", "B4"]).tolist() == [
+        False,
+        True,
+        True,
+        False,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_exact_mode_matches_whole_codes():
+    assert matches(["A00", "B20"], ["A00", "A001", "B20", "B2", None], mode="exact").tolist() == [
+        True,
+        False,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_expanded_mode_reads_ranges_and_chapters():
+    assert matches(["A00-A09", "IX"], ["A05", "a05.1", "I21", "A10"], mode="expanded").tolist() == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    with pytest.raises(ICD10Error):
+        icd10_index(["A00"], mode="like")
@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+
+from event_store import MISSING_DATE, OPEN_END_DATE
+from interval_join import AsOfIndex, Coverage, SortedEvents
+
+####################################################################################################
+# sort-merge interval join
+
+
+# three patients: 0 has events on days 10, 20, 20 (same-day tie) and 30, 1 has none, 2 has day 5
+@pytest.fixture
+def events():
+    return SortedEvents(np.array([0, 0, 0, 0, 2]), np.array([10, 20, 20, 30, 5]), 3)
+
+
+def test_window_bounds_are_inclusive(events):
+    assert events.count(10, 30).tolist() == [4, 0, 0]
+    assert events.count(11, 29).tolist() == [2, 0, 0]
+    assert events.any(5, 5).tolist() == [False, False, True]
+
+
+def test_empty_window(events):
+    assert events.count(30, 10).tolist() == [0, 0, 0]
+    assert events.first(30, 10).tolist() == [-1, -1, -1]
+    assert events.last(30, 10).tolist() == [-1, -1, -1]
+
+
+def test_per_patient_bounds(events):
+    assert events.count(np.array([15, 0, 6]), np.array([25, 100, 100])).tolist() == [2, 0, 0]
+
+
+def test_same_day_ties_take_the_first_recorded(events):
+    assert events.first(11, 25).tolist() == [1, -1, -1]
+    assert events.last(11, 25).tolist() == [1, -1, -1]
+    assert events.last(0, 100).tolist() == [3, -1, 4]
+
+
+def test_unbounded_windows(events):
+    lowest, highest = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+    assert events.count(lowest, highest).tolist() == [4, 0, 1]
+
+
+def test_no_events():
+    events = SortedEvents(np.array([], dtype=np.int64), np.array([], dtype=np.int32), 2)
+    assert events.count(0, 100).tolist() == [0, 0]
+    assert events.first(0, 100).tolist() == [-1, -1]
+    assert events.last(0, 100).tolist() == [-1, -1]
+
+
+def test_matches_brute_force():
+    rng = np.random.default_rng(2)
+    size = 50
+    groups = np.sort(rng.integers(0, size, 400))
+    dates = rng.integers(0, 60, 400)
+    order = np.lexsort((dates, groups))
+    groups, dates = groups[order], dates[order]
+    events = SortedEvents(groups, dates, size)
+    lower, upper = rng.integers(-5, 60, size), rng.integers(-5, 60, size)
+    first, last = events.first(lower, upper), events.last(lower, upper)
+    for patient in range(size):
+        inside = np.flatnonzero((groups == patient) & (dates >= lower[patient]) & (dates <= upper[patient]))
+        assert events.count(lower, upper)[patient] == len(inside)
+        assert first[patient] == (inside[0] if len(inside) else -1)
+        if len(inside):
+            assert last[patient] == inside[dates[inside] == dates[inside].max()][0]
+        else:
+            assert last[patient] == -1
+
+
+####################################################################################################
+# as-of join
+
+
+def test_spell_ends_are_exclusive():
+    index = AsOfIndex(np.array([0, 0]), np.array([10, 20]), np.array([20, 30]), 1)
+    assert [index.lookup(day)[0] for day in (9, 10, 19, 20, 29, 30)] == [-1, 0, 0, 1, 1, -1]
+
+
+def test_open_ended_spells():
+    index = AsOfIndex(np.array([0]), np.array([10]), np.array([OPEN_END_DATE]), 2)
+    assert index.lookup(10**5).tolist() == [0, -1]
+
+
+def test_empty_spells_are_never_current():
+    index = AsOfIndex(np.array([0, 0]), np.array([10, 15]), np.array([20, 15]), 1)
+    assert index.lookup(15).tolist() == [0]
+
+
+def test_overlapping_spells():
+    # latest start wins, then latest end, then those not marked last, then the first recorded
+    starts = np.array([0, 10, 10, 10, 10])
+    ends = np.array([100, 50, 60, 60, 60])
+    index = AsOfIndex(np.zeros(5, dtype=np.int64), starts, ends, 1, last=np.array([False, False, True, False, False]))
+    assert [index.lookup(day)[0] for day in (5, 20, 55, 60)] == [0, 3, 3, 0]
+
+
+def test_per_patient_dates_and_patients_without_spells():
+    index = AsOfIndex(np.array([0, 2]), np.array([10, 10]), np.array([20, 20]), 3)
+    assert index.lookup(np.array([15, 15, 25])).tolist() == [0, -1, -1]
+    assert index.lookup(MISSING_DATE).tolist() == [-1, -1, -1]
+
+
+def test_no_spells():
+    index = AsOfIndex(np.array([], dtype=np.int64), np.array([]), np.array([]), 2)
+    assert index.lookup(10).tolist() == [-1, -1]
+
+
+def test_as_of_matches_brute_force():
+    rng = np.random.default_rng(3)
+    size = 30
+    groups = np.sort(rng.integers(0, size, 120))
+    starts = rng.integers(0, 50, 120)
+    ends = starts + rng.integers(0, 30, 120)
+    last = rng.random(120) < 0.3
+    index = AsOfIndex(groups, starts, ends, size, last)
+    for day in range(-1, 82, 3):
+        found = index.lookup(day)
+        for patient in range(size):
+            current = [
+                spell for spell in np.flatnonzero(groups == patient) if starts[spell] <= day < ends[spell]
+            ]
+            expected = min(current, key=lambda spell: (-starts[spell], -ends[spell], last[spell], spell), default=-1)
+            assert found[patient] == expected
+
+
+####################################################################################################
+# registration coverage
+
+
+def test_adjacent_spells_merge():
+    coverage = Coverage(np.array([0, 0]), np.array([10, 20]), np.array([20, 30]), 1)
+    assert len(coverage) == 1
+    assert coverage.continuous(10, 29).tolist() == [True]
+    assert coverage.continuous(10, 30).tolist() == [False]
+    assert coverage.single_practice(10, 29).tolist() == [False]
+    assert coverage.single_practice(12, 19).tolist() == [True]
+
+
+def test_gaps_and_nested_spells():
+    coverage = Coverage(np.array([0, 0, 0]), np.array([10, 12, 21]), np.array([20, 15, 30]), 1)
+    assert len(coverage) == 2
+    assert coverage.continuous(10, 19).tolist() == [True]
+    assert coverage.continuous(15, 25).tolist() == [False]
+    assert coverage.deregistered()[0].tolist() == [30]
+
+
+def test_open_ended_registration_and_patients_without_spells():
+    coverage = Coverage(np.array([0]), np.array([10]), np.array([OPEN_END_DATE]), 2)
+    assert coverage.continuous(10, 10**5).tolist() == [True, False]
+    last_end, found = coverage.deregistered()
+    assert last_end.tolist() == [OPEN_END_DATE, MISSING_DATE]
+    assert found.tolist() == [True, False]
+
+
+def test_empty_period_is_not_covered():
+    coverage = Coverage(np.array([0]), np.array([10]), np.array([20]), 1)
+    assert coverage.continuous(15, 12).tolist() == [False]
+
+
+def test_no_registrations():
+    coverage = Coverage(np.array([], dtype=np.int64), np.array([]), np.array([]), 2)
+    assert len(coverage) == 0
+    assert coverage.continuous(0, 10).tolist() == [False, False]
+    assert coverage.deregistered()[1].tolist() == [False, False]
+
+
+def test_coverage_matches_brute_force():
+    rng = np.random.default_rng(4)
+    size = 30
+    groups = np.sort(rng.integers(0, size, 100))
+    starts = rng.integers(0, 50, 100)
+    ends = starts + rng.integers(1, 20, 100)
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+    coverage = Coverage(groups, starts, ends, size)
+    lower = rng.integers(0, 60, size)
+    upper = lower + rng.integers(0, 15, size)
+    continuous = coverage.continuous(lower, upper)
+    single = coverage.single_practice(lower, upper)
+    for patient in range(size):
+        spells = np.flatnonzero(groups == patient)
+        days = set()
+        for spell in spells:
+            days |= set(range(starts[spell], ends[spell]))
+        assert continuous[patient] == all(day in days for day in range(lower[patient], upper[patient] + 1))
+        assert single[patient] == any(
+            starts[spell] <= lower[patient] and ends[spell] > upper[patient] for spell in spells
+        )
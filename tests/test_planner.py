@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from conftest import as_between
+from event_store import as_codes
+from local_backend import LocalBackend, flatten_variables
+from planner import format_explain
+
+
+@pytest.fixture(scope="module")
+def variables():
+    from elig_definition import elig_variables
+
+    return as_between(flatten_variables(elig_variables))
+
+
+def test_estimates_count_the_codelist_events(store, variables):
+    backend = LocalBackend(store, variables)
+    estimated = 0
+    for name in variables:
+        table_name = backend.event_table(name)
+        if table_name is None:
+            assert backend.planner.estimated_events(name) is None
+            continue
+        codes = store[table_name]["code"]
+        codelist = as_codes(variables[name][1]["codelist"], codes.dtype)
+        assert backend.planner.estimated_events(name) == np.isin(codes, codelist).sum()
+        estimated += 1
+    assert estimated
+
+
+# explain evaluates each variable as the backend would, and an estimate (events whatever their
+# date) bounds the events actually read in the period
+def test_explain(store, variables):
+    names = list(variables)
+    rows = LocalBackend(store, variables).planner.explain(names)
+    assert [row[0] for row in rows] == names
+
+    backend = LocalBackend(store, variables)
+    for name, strategy, estimated, actual, patients, _ in rows:
+        values, missing = backend.column(name)
+        present = ~missing & (values.astype(bool) if values.dtype == bool else True)
+        assert patients == np.sum(present)
+        if backend.event_table(name) is None:
+            assert estimated is actual is None
+        else:
+            assert strategy == ("fused scan" if name in backend.fused else "scan")
+            assert 0 <= actual <= estimated
+    assert any(row[1] == "fused scan" for row in rows)
+
+    lines = format_explain(rows).splitlines()
+    assert len(lines) == len(rows) + 1
+    assert lines[0].split()[:2] == ["variable", "strategy"]
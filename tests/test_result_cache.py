@@ -0,0 +1,136 @@
+import os
+import runpy
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from cohortextractor import patients
+
+import codelists
+from conftest import ROOT, as_between
+from event_store import EventStore
+from local_backend import LocalBackend, flatten_variables
+from result_cache import CachedBackend, ResultCache
+
+
+def definitions(ast_between=("2010-01-01", "2020-12-31")):
+    variables = dict(
+        population=patients.all(),
+        ast_date=patients.with_these_clinical_events(
+            codelists.ast_primis, returning="date", find_last_match_in_period=True, between=list(ast_between)
+        ),
+        astrx=patients.with_these_medications(codelists.astrx_primis, between=["ast_date", "2021-12-31"]),
+        age=patients.age_as_of("2021-03-31"),
+        flag=patients.satisfying("astrx AND age >= 18"),
+    )
+    return as_between(flatten_variables(variables))
+
+
+def evaluate(store, cache, variables):
+    backend = CachedBackend(store, variables, cache=cache)
+    return backend, {name: backend.column(name) for name in backend.output_names()}
+
+
+def same(expected, actual):
+    for name, (values, missing) in expected.items():
+        assert np.array_equal(missing, actual[name].missing)
+        assert np.array_equal(values[~missing], actual[name].values[~missing])
+
+
+def test_unchanged_variables_are_read_back(store, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    first, expected = evaluate(store, cache, definitions())
+    assert not first.hits
+    second, actual = evaluate(store, cache, definitions())
+    assert second.hits == set(expected)
+    same(expected, actual)
+    uncached = LocalBackend(store, definitions())
+    same({name: uncached.column(name) for name in expected}, actual)
+
+
+def test_a_changed_definition_misses_with_its_dependents(store, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    evaluate(store, cache, definitions())
+    backend, _ = evaluate(store, cache, definitions(ast_between=("2015-01-01", "2020-12-31")))
+    assert backend.hits == {"age"}
+
+
+def test_a_changed_store_misses(store, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    evaluate(store, cache, definitions())
+    tables = {name: dict(table.columns) for name, table in store.tables.items()}
+    tables["clinical_events"]["date"] = tables["clinical_events"]["date"].copy()
+    tables["clinical_events"]["date"][0] -= 1
+    backend, _ = evaluate(EventStore(tables), cache, definitions())
+    assert not backend.hits
+
+
+def entry(size):
+    return {"values": np.zeros(size, dtype=np.int64), "missing": np.zeros(size, dtype=bool)}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10**9)
+    for key in "abc":
+        cache.put(key, entry(1000))
+    size = os.path.getsize(cache.filename("a"))
+    # a before b before c, then a is used again
+    for age, key in enumerate("cba"):
+        os.utime(cache.filename(key), ns=(10**18 - age * 10**9,) * 2)
+    assert cache.get("a") is not None
+    cache.max_bytes = 3 * size
+    cache.put("d", entry(1000))
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".npz")) == ["a.npz", "c.npz", "d.npz"]
+
+
+def test_object_arrays_are_not_stored(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert not cache.put("key", {"values": np.array(["a", None], dtype=object)})
+    assert cache.get("key") is None
+
+
+def write_entries(path, worker, count, max_bytes):
+    cache = ResultCache(path, max_bytes=max_bytes)
+    for number in range(count):
+        cache.put(f"{worker}-{number}", entry(1000))
+        cache.get(f"{worker}-{number // 2}")
+    return True
+
+
+# two processes storing into (and evicting from) one cache at once
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path)
+    ResultCache(path).put("probe", entry(1000))
+    size = os.path.getsize(ResultCache(path).filename("probe"))
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(write_entries, path, worker, 50, 10 * size) for worker in range(2)]
+        assert all(future.result() for future in futures)
+    cache = ResultCache(path)
+    names = os.listdir(path)
+    assert not [name for name in names if name.endswith(".tmp")]
+    entries = [name[: -len(".npz")] for name in names if name.endswith(".npz")]
+    assert 0 < len(entries) <= 10
+    for key in entries:
+        assert np.array_equal(cache.get(key)["values"], np.zeros(1000, dtype=np.int64))
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# extract.py --cache writes the same extract, and a re-run stores nothing new
+def test_extract_command_line_cache(store_path, tmp_path, monkeypatch):
+    cache = str(tmp_path / "cache")
+    outputs = []
+    for run, options in enumerate([[], ["--cache", cache], ["--cache", cache, "--workers", "2"]]):
+        outputs.append(str(tmp_path / f"input_{run}.feather"))
+        arguments = ["extract.py", "--store", store_path, "--output", outputs[-1], "--chunk-size", "1000", *options]
+        monkeypatch.setattr(sys, "argv", arguments)
+        runpy.run_path(os.path.join(ROOT, "analysis", "extract.py"), run_name="__main__")
+        if run == 1:
+            entries = sorted(os.listdir(cache))
+    assert read(outputs[1]) == read(outputs[0])
+    assert read(outputs[2]) == read(outputs[0])
+    assert len(entries) > 1
+    assert sorted(os.listdir(cache)) == entries
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import rules
+from rules import Column, DecisionTable, compile_categorised_as, compile_expression, compile_satisfying
+
+GROUPS = [
+    "longres_group",
+    "cev_group",
+    "immuno_group",
+    "ckd_group",
+    "resp_group",
+    "asthma_group",
+    "diab_group",
+    "cld_group",
+    "cns_group",
+    "chd_group",
+    "spln_group",
+    "learndis_group",
+    "sevment_group",
+    "sevobese_group",
+]
+SIZE = 50_000
+
+
+def same(expected, actual):
+    assert np.array_equal(expected.missing, actual.missing)
+    assert np.array_equal(expected.values[~expected.missing], actual.values[~actual.missing])
+
+
+# the study's group columns, with ages on and around every threshold and about 10% NULLs
+@pytest.fixture(params=["int", "float"])
+def columns(request):
+    rng = np.random.default_rng(1)
+    age_1 = rng.integers(-5, 110, SIZE)
+    age_2 = rng.integers(-5, 110, SIZE)
+    if request.param == "float":
+        age_1 = age_1 + rng.choice([0, 0.5], SIZE)
+        age_1[rng.random(SIZE) < 0.05] = np.nan
+        columns = {"age_1": age_1, "age_2": age_2.astype(float)}
+    else:
+        columns = {"age_1": Column(age_1, rng.random(SIZE) < 0.05), "age_2": age_2}
+    for name in GROUPS:
+        columns[name] = Column(rng.integers(0, 2, SIZE), rng.random(SIZE) < 0.1)
+    return columns
+
+
+def test_study_rules_compile_to_decision_tables():
+    atrisk, jcvi, elig = rules.read_group_definitions()
+    assert isinstance(compile_categorised_as({1: atrisk, 0: "DEFAULT"}), DecisionTable)
+    assert isinstance(compile_categorised_as(jcvi), DecisionTable)
+    assert isinstance(compile_categorised_as(elig), DecisionTable)
+
+
+def test_decision_tables_match_the_evaluator(columns):
+    atrisk, jcvi, elig = rules.read_group_definitions()
+
+    expected = rules.evaluate_satisfying(atrisk, columns)
+    assert np.array_equal(compile_satisfying(atrisk)(columns), expected)
+    columns["atrisk_group"] = Column(expected, np.zeros(SIZE, dtype=bool))
+
+    expected = rules.evaluate_categorised_as(jcvi, columns)
+    same(expected, compile_categorised_as(jcvi)(columns))
+    columns["jcvi_group"] = expected
+
+    same(rules.evaluate_categorised_as(elig, columns), compile_categorised_as(elig)(columns))
+
+
+# NULL is not satisfied; rows no rule matches get no category
+def test_categorised_as_with_nulls():
+    columns = {"age": Column(np.array([85, 72, 30, 0]), np.array([False, False, False, True]))}
+    definitions = {"old": "age >= 80", "older": "age >= 70"}
+    for values, missing in (
+        rules.evaluate_categorised_as(definitions, columns),
+        compile_categorised_as(definitions)(columns),
+    ):
+        assert missing.tolist() == [False, False, True, True]
+        assert values[:2].tolist() == ["old", "older"]
+
+
+# SQL three-valued logic: comparisons with NULL are NULL, a definite FALSE wins an AND and a
+# definite TRUE wins an OR; a bare name is an implicit "not NULL and not empty" test, never NULL
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("x > 0 AND y > 0", [True, False, None, False, None]),
+        ("x > 0 OR y > 0", [True, True, True, None, None]),
+        ("NOT x > 0", [False, False, False, None, None]),
+        ("x", [True, True, True, False, False]),
+        ("x > 0 AND y", [True, False, False, False, False]),
+        ("x + y > 1", [True, False, None, None, None]),
+    ],
+)
+def test_null_logic(expression, expected):
+    columns = {
+        "x": Column(np.array([1, 1, 1, 0, 0]), np.array([False, False, False, True, True])),
+        "y": Column(np.array([1, 0, 0, 0, 0]), np.array([False, False, True, False, True])),
+    }
+    for values, missing in (
+        rules.evaluate_condition(rules.parse(expression), columns),
+        compile_expression(expression).condition(columns),
+    ):
+        assert [None if null else bool(value) for value, null in zip(values, missing)] == expected
@@ -0,0 +1,80 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+from cohortextractor import patients
+
+import codelists
+from conftest import as_between
+from local_backend import LocalBackend, flatten_variables, study_variables
+from scheduler import CycleError, critical_path, dependency_graph, run, topological_order, units
+
+
+@pytest.fixture(scope="module")
+def variables():
+    return as_between(flatten_variables(study_variables("study_definition")))
+
+
+def test_nodes_follow_date_expressions_and_formulas(store, variables):
+    backend = LocalBackend(store, variables)
+    graph = dependency_graph(backend)
+    node_of, members = units(backend)
+    order = topological_order(graph)
+    assert sorted(order) == sorted(graph)
+    for name in backend.definitions:
+        for dependency in backend.dependencies(name):
+            if node_of[dependency] != node_of[name]:
+                assert order.index(node_of[dependency]) < order.index(node_of[name])
+    # a vaccination chain is one node
+    chain = backend.chains["covid_vax_disease_1_date"]
+    assert members[node_of[chain[-1]]] == chain
+
+
+def test_cycles_are_refused(store):
+    variables = {
+        "ast_date": patients.with_these_clinical_events(
+            codelists.ast_primis, returning="date", between=["astrx_date", "2021-12-31"]
+        ),
+        "astrx_date": patients.with_these_medications(
+            codelists.astrx_primis, returning="date", between=["ast_date", "2021-12-31"]
+        ),
+    }
+    backend = LocalBackend(store, variables)
+    with pytest.raises(CycleError):
+        run(backend)
+    with pytest.raises(CycleError):
+        backend.to_arrow()
+
+
+def test_critical_path():
+    graph = {"a": set(), "b": {"a"}, "c": {"a"}, "d": {"b", "c"}}
+    path, seconds = critical_path(graph, {"a": 1.0, "b": 0.5, "c": 2.0, "d": 1.0})
+    assert path == ["a", "c", "d"]
+    assert seconds == 4.0
+
+
+def test_only_what_the_names_need_is_evaluated(store, variables):
+    backend = LocalBackend(store, variables)
+    schedule = run(backend, 2, ["cev_group"])
+    evaluated = {"cev_group", "severely_clinically_vulnerable", "severely_clinically_vulnerable_date", "less_vulnerable"}
+    assert set(backend.results) == evaluated
+    assert set(schedule.durations) == evaluated
+
+
+# the scheduled, threaded evaluation behind to_arrow is the plain serial one
+@pytest.mark.parametrize("threads", [1, 4])
+def test_scheduled_evaluation_equals_serial(store, variables, threads):
+    serial = LocalBackend(store, variables)
+    expected = {name: serial.column(name) for name in serial.definitions}
+
+    backend = LocalBackend(store, variables, threads=threads)
+    table = backend.to_arrow()
+    assert set(backend.results) == set(expected)
+    for name, (values, missing) in expected.items():
+        assert np.array_equal(backend.results[name].missing, missing)
+        assert np.array_equal(backend.results[name].values[~missing], values[~missing])
+
+    names = serial.output_names()
+    rows = serial.population()
+    assert table.column_names == ["patient_id", *names]
+    assert table["patient_id"].to_pylist() == serial.store.patient_ids[rows].tolist()
+    assert table.equals(pa.Table.from_batches(LocalBackend(store, variables).to_arrow().to_batches()))
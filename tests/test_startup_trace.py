@@ -0,0 +1,75 @@
+import builtins
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+from startup_trace import Tracer, trace
+
+
+def test_spans_nest_and_record_allocations():
+    tracer = Tracer()
+    tracer.start()
+    try:
+        outer = tracer.wrap(lambda: inner(), "outer", "test")
+        inner = tracer.wrap(lambda: bytearray(10**6), "inner", "test")
+        kept = outer()
+    finally:
+        tracer.stop()
+    assert [(phase, name) for phase, name, *_ in tracer.events] == [
+        ("B", "outer"),
+        ("B", "inner"),
+        ("E", "inner"),
+        ("E", "outer"),
+    ]
+    ends = {name: args for phase, name, _, _, args in tracer.events if phase == "E"}
+    assert ends["inner"]["allocated_bytes"] >= len(kept)
+    assert ends["outer"]["peak_bytes"] >= ends["inner"]["peak_bytes"] >= len(kept)
+    totals = tracer.spans()
+    assert totals[("test", "inner")][0] == 1
+
+
+def test_imports_are_traced_and_patches_undone(tmp_path, monkeypatch):
+    (tmp_path / "traced_module.py").write_text("import json\nvalue = json.load(open(__file__ + '.json'))\n")
+    (tmp_path / "traced_module.py.json").write_text("[1, 2, 3]")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    original_import, original_load = builtins.__import__, json.load
+
+    tracer = trace("traced_module", allocations=False)
+
+    assert builtins.__import__ is original_import and json.load is original_load
+    assert sys.modules["traced_module"].value == [1, 2, 3]
+    categories = {key[0] for key in tracer.spans()}
+    assert ("import", "traced_module") in tracer.spans()
+    assert "lib" in categories
+    monkeypatch.delitem(sys.modules, "traced_module")
+
+
+# the study definition in a fresh interpreter: its codelists, variables and StudyDefinition
+def test_study_definition_trace(tmp_path):
+    output = str(tmp_path / "startup.json")
+    subprocess.run(
+        [sys.executable, os.path.join("analysis", "startup_trace.py"), "study_definition", "--output", output],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+    )
+    with open(output) as f:
+        events = json.load(f)["traceEvents"]
+    assert sum(event["ph"] == "B" for event in events) == sum(event["ph"] == "E" for event in events)
+    categories = {event["cat"] for event in events}
+    assert {"import", "codelist", "variable", "study"} <= categories
+    study = [event for event in events if event["cat"] == "study" and event["ph"] == "B"]
+    assert study[0]["args"]["variables"] > 0
+
+    speedscope = str(tmp_path / "startup.speedscope.json")
+    subprocess.run(
+        [sys.executable, os.path.join("analysis", "startup_trace.py"), "--format", "speedscope", "--output", speedscope],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+    )
+    with open(speedscope) as f:
+        profile = json.load(f)["profiles"][0]
+    assert profile["type"] == "evented" and profile["events"]
@@ -0,0 +1,40 @@
+import os
+import shutil
+import stat
+
+import pytest
+
+import study_metadata
+from atomic_write import default_mode
+from study_metadata import LIB_DIR, METADATA, load_metadata, write_metadata
+
+
+def test_stale_metadata_is_parsed_without_writing(tmp_path, monkeypatch):
+    lib_dir = str(tmp_path / "lib")
+    shutil.copytree(LIB_DIR, lib_dir)
+    with open(os.path.join(lib_dir, "regions.csv"), "a") as f:
+        f.write("\n")
+    with open(os.path.join(lib_dir, METADATA), "rb") as f:
+        artifact = f.read()
+    monkeypatch.setattr(study_metadata, "_loaded", {})
+
+    metadata = load_metadata(lib_dir)
+
+    assert metadata.ratio_regions == load_metadata(LIB_DIR).ratio_regions
+    with open(os.path.join(lib_dir, METADATA), "rb") as f:
+        assert f.read() == artifact
+
+
+# the metadata is read by other users, so it isn't left private like a temporary file
+def test_written_metadata_has_the_default_mode(tmp_path):
+    write_metadata({"regions": []}, str(tmp_path))
+    assert stat.S_IMODE(os.stat(tmp_path / METADATA).st_mode) == default_mode()
+    assert [path.name for path in tmp_path.iterdir()] == [METADATA]
+
+
+def test_a_failed_write_keeps_the_old_metadata(tmp_path):
+    write_metadata({"regions": []}, str(tmp_path))
+    with pytest.raises(TypeError):
+        write_metadata({"regions": object()}, str(tmp_path))
+    assert (tmp_path / METADATA).read_text() == '{\n  "regions": []\n}'
+    assert [path.name for path in tmp_path.iterdir()] == [METADATA]
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from cohortextractor import patients
+
+import synthetic_store
+from synthetic_store import spells, study_codelists
+
+
+def test_spells_start_on_distinct_dates_and_are_never_empty():
+    ids, start, end = spells(np.random.default_rng(0), np.arange(1, 20001), largest=5)
+    assert np.all(end > start)
+    same_patient = ids[1:] == ids[:-1]
+    assert np.all(start[1:][same_patient] > start[:-1][same_patient])
+    # each spell ends where the patient's next one starts
+    assert np.array_equal(end[:-1][same_patient], start[1:][same_patient])
+
+
+def test_codelists_the_store_cannot_hold_are_refused(monkeypatch):
+    variables = {"ethnicity": patients.with_these_clinical_events(["Y9930", "XaJQp"], returning="binary_flag")}
+    monkeypatch.setattr(synthetic_store, "study_variables", lambda module: variables)
+    with pytest.raises(ValueError, match="Y9930"):
+        study_codelists()
@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import as_between
+from local_backend import flatten_variables, study_variables, vaccination_chains
+
+
+@pytest.fixture(scope="module")
+def definitions():
+    return flatten_variables(study_variables("study_definition"))
+
+
+def test_study_definition_has_dose_chains(definitions):
+    chains = vaccination_chains(definitions)
+    assert ["covid_vax_disease_1_date", "covid_vax_disease_2_date"] in chains
+
+
+def test_chains_found_from_between_periods(definitions):
+    assert vaccination_chains(as_between(definitions)) == vaccination_chains(definitions)
+
+
+def test_bounded_period_is_not_chained(definitions):
+    converted = as_between(definitions)
+    query_type, query_args = converted["covid_vax_disease_2_date"]
+    converted["covid_vax_disease_2_date"] = (query_type, dict(query_args, between=(query_args["between"][0], "2022-01-01")))
+    assert ["covid_vax_disease_1_date", "covid_vax_disease_2_date"] not in vaccination_chains(converted)